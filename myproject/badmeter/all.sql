@@ -1,4 +1,6 @@
 
+-- This is the default add_topic() function called which in turn
+-- calls the overloading version with parameter now() as text.
 CREATE OR REPLACE FUNCTION add_topic(
     p_topic_title text,
     p_topic_slug text,      -- Will use Django's slugify() function.
@@ -17,6 +19,9 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+-- Overload function add_topic() and add parameter "p_now".
+-- This is so we can feed function add_topic() with custom date for testing.
+-- Date in text format is safe even for external calls from Django.
 CREATE OR REPLACE FUNCTION add_topic(
     p_topic_title text,
     p_topic_slug text,
@@ -27,62 +32,49 @@ CREATE OR REPLACE FUNCTION add_topic(
 AS $$
 DECLARE
     t_now timestamp;
-    t_badmeter_cookie_id int;
     t_badmeter_topic_id int;
 BEGIN
+    -- Function get_timestamp() returns null if p_now has 
+    -- format errors. In that case use now().
     SELECT COALESCE(get_timestamp(p_now), now())
         INTO t_now;
 
-    SELECT id
-        INTO t_badmeter_topic_id
-        FROM badmeter_topic
-        WHERE topic_slug = p_topic_slug;
-
-    -- Add topic if new. Note cookie_id initially NULL.
-    IF t_badmeter_topic_id IS NULL THEN
+    -- Add topic if new. Of racing adds of the same topic_slug only one
+    -- inserts, the unique slug makes the others wait for it and insert
+    -- nothing.
+    IF NOT EXISTS (SELECT 1 FROM badmeter_topic WHERE topic_slug = p_topic_slug) THEN
         INSERT INTO badmeter_topic (
                 topic_title, topic_slug, badmeter, votes_positive,
-                votes_negative, cookie_id, date_created, date_updated)
+                votes_negative, date_created, date_updated)
             VALUES (
                 p_topic_title, p_topic_slug, 50, 0,
-                0, NULL, t_now, t_now)
+                0, t_now, t_now)
+            ON CONFLICT (topic_slug) DO NOTHING
             -- Return newly inserted topic record id.
             RETURNING badmeter_topic.id INTO t_badmeter_topic_id;
+    END IF;
 
-        return_id := t_badmeter_topic_id;
-        status_message := 'badmeter_topic.id';
-    ELSE
+    IF t_badmeter_topic_id IS NULL THEN
         -- Already existing topic no record inserted.
         return_id := -1;
         status_message := 'Already existing topic no record inserted.';
-    END IF;
+    ELSE
+        return_id := t_badmeter_topic_id;
+        status_message := 'badmeter_topic.id';
 
-    -- Check if cookie exists. Note that badmeter_cookie stores counters on
-    -- a per cookie_string AND topic_id basis.
-    SELECT id
-        INTO t_badmeter_cookie_id
-        FROM badmeter_cookie
-        WHERE cookie_string = p_cookie_string
-            AND topic_id = t_badmeter_topic_id;
+        -- Keep record of which voter created this topic, only once the
+        -- topic is in so a lost race adds no voter. Its vote counters on
+        -- the topic wait for its first vote.
+        UPDATE badmeter_topic
+            SET voter_id = add_voter(p_cookie_string, t_now)
+            WHERE id = t_badmeter_topic_id;
 
-    -- Create the badmeter_cookie record if not existing.
-    IF t_badmeter_cookie_id IS NULL THEN
-        INSERT INTO badmeter_cookie (
-                cookie_string, votes_positive, votes_negative, date_created, date_updated, topic_id)
+        -- Log the new topic for the in-process search indexes.
+        INSERT INTO badmeter_topic_event (
+                topic_id, topic_title, topic_slug, event, date_created)
             VALUES (
-                p_cookie_string, 0, 0, t_now, t_now, t_badmeter_topic_id)
-            -- Grab newly inserted cookie record id.
-            RETURNING badmeter_cookie.id INTO t_badmeter_cookie_id;
+                t_badmeter_topic_id, p_topic_title, p_topic_slug, 'add', now());
     END IF;
-
-    -- Now go back to the badmeter_topic table just inserted above and
-    -- update the cookie_id. Keep record of which cookie created
-    -- this topic. Note that badmeter_topic & badmeter_cookie have cyclic
-    -- foreigh-key dependencies.
-    UPDATE badmeter_topic
-        SET cookie_id = t_badmeter_cookie_id
-        WHERE id = t_badmeter_topic_id
-            AND cookie_id IS NULL;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -113,6 +105,17 @@ $$ LANGUAGE plpgsql;
 /*
     Overload add_vote function and add 'p_now' parameter.
     This is for testing purposes so we can feed it a custom date for testing.
+
+    The per cookie AND topic vote state (votes_total, counted, date_voted)
+    lives on the badmeter_cookie row, so the one-vote-per-day and
+    3-vote rules are checks on that one row instead of counts over
+    badmeter_vote. Votes are expected in time order per cookie.
+
+    Concurrent votes of a voter on a topic, e.g. a double submit handled
+    by two workers, queue on the lock of that row and each sees the
+    state the other left. The row itself is added with ON CONFLICT on
+    its unique (voter_id, topic_id) key, so racing first votes share one
+    row. No table locks are taken.
 */
 CREATE OR REPLACE FUNCTION add_vote(
     p_topic_slug text,
@@ -126,24 +129,26 @@ AS $$
 DECLARE
     t_badmeter_cookie_id int;
     t_badmeter_topic_id int;
+    t_badmeter_voter_id int;
+    t_counter_shards int;
+    t_shard int := 0;
     t_now timestamp;
 
-    t_positive int;
-    t_negative int;
-
-    t_positive_sum int;
-    t_negative_sum int;
-
-    t_diff int;
-    t_sum int;
-    t_badmeter int;
+    -- Deltas of counted positive & negative votes from this vote.
+    t_positive_sum int := 0;
+    t_negative_sum int := 0;
 
     t_vote boolean := p_vote::boolean;
+    t_counted boolean;
     t_badmeter_vote_count int;
+    t_date_voted timestamp;
+    t_cookie_date_created timestamp;
+    t_date_created timestamp;
+    t_previous_vote boolean;
 BEGIN
     -- Check if topic exists.
-    SELECT id
-        INTO t_badmeter_topic_id
+    SELECT id, counter_shards
+        INTO t_badmeter_topic_id, t_counter_shards
         FROM badmeter_topic
         WHERE topic_slug = p_topic_slug;
 
@@ -157,129 +162,485 @@ BEGIN
     SELECT COALESCE(get_timestamp(p_now), now())
         INTO t_now;
 
-    -- Check if cookie exists.
-    SELECT id
-        INTO t_badmeter_cookie_id
-        FROM badmeter_cookie
-        WHERE cookie_string = p_cookie_string
-            AND topic_id = t_badmeter_topic_id;
+    t_badmeter_voter_id := add_voter(p_cookie_string, t_now);
 
-    -- RAISE NOTICE 't_badmeter_cookie_id = %', t_badmeter_cookie_id;
+    -- A sharded topic keeps the counters of this voter's votes in one of
+    -- its counter rows, see topic_counters.sql.
+    IF t_counter_shards > 1 THEN
+        t_shard := mod(t_badmeter_voter_id, t_counter_shards);
+    END IF;
 
-    -- Add to badmeter_cookie if cookie is new.
+    -- Check if the voter has counters on this topic. Lock them as they
+    -- hold the vote state.
+    SELECT id, votes_total, date_voted, date_created
+        INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_date_voted, t_cookie_date_created
+        FROM badmeter_cookie
+        WHERE voter_id = t_badmeter_voter_id
+            AND topic_id = t_badmeter_topic_id
+        FOR UPDATE;
+
+    -- Add to badmeter_cookie on the first vote of the voter on this topic.
+    -- A racing first vote that added the row first leaves nothing to
+    -- insert; lock its row instead once it commits.
     IF t_badmeter_cookie_id IS NULL THEN
         INSERT INTO badmeter_cookie (
-                cookie_string, votes_positive, votes_negative, date_created, date_updated, topic_id)
+                voter_id, votes_positive, votes_negative, votes_total,
+                counted, date_voted, date_created, date_updated, topic_id)
             VALUES (
-                p_cookie_string, 0, 0, t_now, t_now, t_badmeter_topic_id)
+                t_badmeter_voter_id, 0, 0, 0,
+                FALSE, NULL, t_now, t_now, t_badmeter_topic_id)
+            ON CONFLICT (voter_id, topic_id) DO NOTHING
             -- Grab newly inserted cookie record id.
-            RETURNING badmeter_cookie.id INTO t_badmeter_cookie_id;
+            RETURNING badmeter_cookie.id, 0, badmeter_cookie.date_created
+                INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_cookie_date_created;
+    END IF;
+
+    IF t_badmeter_cookie_id IS NULL THEN
+        SELECT id, votes_total, date_voted, date_created
+            INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_date_voted, t_cookie_date_created
+            FROM badmeter_cookie
+            WHERE voter_id = t_badmeter_voter_id
+                AND topic_id = t_badmeter_topic_id
+            FOR UPDATE;
     END IF;
 
     -- Enforce one vote per day rule.
-    IF if_allow_add(t_badmeter_topic_id, t_badmeter_cookie_id, t_now::text) THEN
-        INSERT INTO badmeter_vote (
-                topic_id, cookie_id, comment, vote, date_created)
-            VALUES (
-                t_badmeter_topic_id, t_badmeter_cookie_id, p_comment, t_vote, t_now)
-            RETURNING badmeter_vote.id, 'badmeter_vote.id'::text
-                -- return_id should be >= 0 for normal save.
-                INTO return_id, status_message;
-
-        -- Count the total number of votes per this topic.
-        SELECT count(*)
-            INTO t_badmeter_vote_count
-            FROM badmeter_vote
-            WHERE topic_id = t_badmeter_topic_id
-                AND cookie_id = t_badmeter_cookie_id;
-
-        -- On the 3rd or more vote set counted = TRUE.
-        IF t_badmeter_vote_count = 3 THEN
-            UPDATE badmeter_vote SET counted = TRUE
-                WHERE topic_id = t_badmeter_topic_id
-                    AND cookie_id = t_badmeter_cookie_id;
+    IF date_trunc('day', t_date_voted) = date_trunc('day', t_now) THEN
+        return_id := -1;
+        status_message := 'You are limited to one vote per day per topic.';
+        RETURN;
+    END IF;
 
-            SELECT count(*)
-                INTO t_positive_sum
-                FROM badmeter_vote
-                WHERE topic_id = t_badmeter_topic_id
-                    AND cookie_id = t_badmeter_cookie_id
-                    AND vote IS TRUE
-                    AND counted IS TRUE;
+    -- The 3rd or more vote is counted.
+    t_badmeter_vote_count := t_badmeter_vote_count + 1;
+    IF t_badmeter_vote_count >= 3 THEN
+        t_counted := TRUE;
+        IF t_vote IS TRUE THEN
+            t_positive_sum := 1;
+        ELSE
+            t_negative_sum := 1;
+        END IF;
+    END IF;
+
+    INSERT INTO badmeter_vote (
+            topic_id, cookie_id, comment, vote, counted, date_created)
+        VALUES (
+            t_badmeter_topic_id, t_badmeter_cookie_id, p_comment, t_vote, t_counted, t_now)
+        RETURNING badmeter_vote.id, 'badmeter_vote.id'::text
+            -- return_id should be >= 0 for normal save.
+            INTO return_id, status_message;
 
-            SELECT count(*)
-                INTO t_negative_sum
-                FROM badmeter_vote
+    -- Keep the badmeter_topic_daily rollup in step.
+    IF t_counted THEN
+        PERFORM topic_daily_add(t_badmeter_topic_id, t_now, 1, 0, t_shard);
+    ELSE
+        PERFORM topic_daily_add(t_badmeter_topic_id, t_now, 0, 1, t_shard);
+    END IF;
+
+    -- On the 3rd vote the previous 1st & 2nd votes count too. They are
+    -- not older than the cookie row, which bounds the scan to the recent
+    -- monthly partitions of a partitioned badmeter_vote.
+    IF t_badmeter_vote_count = 3 THEN
+        FOR t_date_created, t_previous_vote IN
+            UPDATE badmeter_vote SET counted = TRUE
                 WHERE topic_id = t_badmeter_topic_id
                     AND cookie_id = t_badmeter_cookie_id
-                    AND vote IS NOT TRUE
-                    AND counted IS TRUE;
-
-            -- Update badmeter_topic & badmeter_cookie accordingly.
-            UPDATE badmeter_cookie
-                SET votes_positive = t_positive_sum,
-                    votes_negative = t_negative_sum
-                WHERE id = t_badmeter_cookie_id
-                    AND topic_id = t_badmeter_topic_id;
-
-            UPDATE badmeter_topic
-                SET votes_positive = (votes_positive + t_positive_sum),
-                    votes_negative = (votes_negative + t_negative_sum)
-                WHERE id = t_badmeter_topic_id
-                RETURNING votes_positive, votes_negative
-                    INTO t_positive, t_negative;
-
-        ELSIF t_badmeter_vote_count > 3 THEN
-            UPDATE badmeter_vote SET counted = TRUE
-                WHERE id = return_id;
-
-            -- Update badmeter_topic & badmeter_cookie accordingly.
-            IF t_vote IS TRUE THEN
-                UPDATE badmeter_topic
-                    SET votes_positive = (votes_positive + 1)
-                    WHERE id = t_badmeter_topic_id
-                    RETURNING votes_positive, votes_negative
-                        INTO t_positive, t_negative;
-
-                UPDATE badmeter_cookie
-                    SET votes_positive = (votes_positive + 1)
-                    WHERE id = t_badmeter_cookie_id
-                        AND topic_id = t_badmeter_topic_id;
+                    AND date_created >= t_cookie_date_created
+                    AND counted IS NOT TRUE
+                RETURNING date_created, vote
+        LOOP
+            PERFORM topic_daily_add(t_badmeter_topic_id, t_date_created, 1, -1, t_shard);
+            IF t_previous_vote IS TRUE THEN
+                t_positive_sum := t_positive_sum + 1;
             ELSE
-                UPDATE badmeter_topic
-                    SET votes_negative = (votes_negative + 1)
-                    WHERE id = t_badmeter_topic_id
-                    RETURNING votes_positive, votes_negative
-                        INTO t_positive, t_negative;
-
-                UPDATE badmeter_cookie
-                    SET votes_negative = (votes_negative + 1)
-                    WHERE id = t_badmeter_cookie_id
-                        AND topic_id = t_badmeter_topic_id;
+                t_negative_sum := t_negative_sum + 1;
             END IF;
-        END IF;
+        END LOOP;
+    END IF;
 
-        IF t_badmeter_vote_count >= 3 THEN
-            -- Compute & update badmeter value.
-            t_diff := t_positive - t_negative;
-            t_sum := t_positive + t_negative;
-            -- Prevent divide-by-zero error.
-            IF t_sum = 0 THEN
-                t_sum := 1;
-            END IF;
-            t_badmeter := 50 + floor((t_diff / t_sum::float) * 50);
+    -- Update badmeter_cookie vote state & counters.
+    UPDATE badmeter_cookie
+        SET votes_total = t_badmeter_vote_count,
+            counted = (t_badmeter_vote_count >= 3),
+            date_voted = t_now,
+            votes_positive = (votes_positive + t_positive_sum),
+            votes_negative = (votes_negative + t_negative_sum)
+        WHERE id = t_badmeter_cookie_id;
 
-            UPDATE badmeter_topic
-                SET badmeter = t_badmeter,
-                    date_updated = t_now
-                WHERE id = t_badmeter_topic_id;
-        END IF;
-    ELSE
-        return_id := -1;
-        status_message := 'You are limited to one vote per day per topic.';
+    -- Update badmeter_topic counters & compute the badmeter value.
+    -- date_updated is bumped by uncounted votes too since they show in
+    -- the vote list; it is the version of the cached topic page in
+    -- badmeter.stats_cache and of the vote page ETag. It takes the clock
+    -- time, not t_now, and at least 1 microsecond more than before, so
+    -- every vote changes it even within one transaction. A sharded topic
+    -- adds to its counter row instead, folded into badmeter_topic by
+    -- fold_topic_counters().
+    IF t_counter_shards > 1 THEN
+        INSERT INTO badmeter_topic_counter AS S (
+                topic_id, shard, votes_positive, votes_negative, date_updated)
+            VALUES (
+                t_badmeter_topic_id, t_shard, t_positive_sum, t_negative_sum, clock_timestamp())
+            ON CONFLICT (topic_id, shard) DO UPDATE
+                SET votes_positive = S.votes_positive + EXCLUDED.votes_positive,
+                    votes_negative = S.votes_negative + EXCLUDED.votes_negative,
+                    date_updated = greatest(S.date_updated + interval '1 microsecond',
+                        EXCLUDED.date_updated);
+        RETURN;
     END IF;
+
+    UPDATE badmeter_topic
+        SET votes_positive = (votes_positive + t_positive_sum),
+            votes_negative = (votes_negative + t_negative_sum),
+            badmeter = topic_badmeter(votes_positive + t_positive_sum,
+                votes_negative + t_negative_sum),
+            date_updated = greatest(date_updated + interval '1 microsecond', clock_timestamp())
+        WHERE id = t_badmeter_topic_id;
 END;
 $$ LANGUAGE plpgsql;
+-- The 16-byte md5 digest of a visitor id as kept in badmeter_voter.
+-- Same as badmeter.misc.voter_digest().
+CREATE OR REPLACE FUNCTION voter_digest(
+    p_cookie_string text
+)
+RETURNS bytea
+AS $$
+    SELECT decode(md5(p_cookie_string), 'hex');
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Return the badmeter_voter id of a visitor id, adding it if new. A
+-- request racing to add the same visitor id waits on the unique digest
+-- and then reads the row the other added. The voter row is locked FOR KEY
+-- SHARE until commit, so purge_voters() leaves it to the rows about to
+-- reference it. A voter purged in between is added again. Used by:
+--   add_topic()
+--   add_vote()
+CREATE OR REPLACE FUNCTION add_voter(
+    p_cookie_string text,
+    p_now timestamp
+)
+RETURNS int
+AS $$
+DECLARE
+    t_digest bytea := voter_digest(p_cookie_string);
+    t_badmeter_voter_id int;
+BEGIN
+    LOOP
+        SELECT id
+            INTO t_badmeter_voter_id
+            FROM badmeter_voter
+            WHERE digest = t_digest
+            FOR KEY SHARE;
+        EXIT WHEN t_badmeter_voter_id IS NOT NULL;
+
+        INSERT INTO badmeter_voter (digest, date_created)
+            VALUES (t_digest, p_now)
+            ON CONFLICT (digest) DO NOTHING
+            RETURNING badmeter_voter.id INTO t_badmeter_voter_id;
+        EXIT WHEN t_badmeter_voter_id IS NOT NULL;
+    END LOOP;
+
+    RETURN t_badmeter_voter_id;
+END;
+$$ LANGUAGE plpgsql;
+-- Batched add_vote(). Takes parallel arrays, one element per vote, and
+-- applies the add_vote() rules to all of them set-based in one round
+-- trip and one transaction. Returns one row per vote, in input order,
+-- with the add_vote() return_id & status_message. A vote that add_vote()
+-- would fail on (an invalid vote value, no cookie string, no or a too
+-- long comment) gets return_id -1 and an error without failing the
+-- others. Used by:
+--   badmeter.models.Vote.save_many()
+--
+-- The votes of a voter on a topic are taken in input order, expected to
+-- be time order as for add_vote(). A vote on the day of the voter's
+-- previous vote on the topic, in the table or in the batch, is refused.
+-- When the vote total reaches 3 all the voter's votes on the topic
+-- count. Each voter, vote state row, daily rollup row and topic counter
+-- row is written once per batch, not once per vote. Vote state rows are
+-- locked in id order and topic rows after them, as add_vote() does.
+CREATE OR REPLACE FUNCTION add_votes(
+    p_topic_slugs text[],
+    p_cookie_strings text[],
+    p_comments text[],
+    p_votes text[],
+    p_nows text[]
+)
+RETURNS TABLE(
+    vote_order int,
+    return_id int,
+    status_message text
+) AS $$
+#variable_conflict use_column
+BEGIN
+    -- counter_shards is 0 for topics that are not sharded, so the
+    -- counter_shards <= 1 and > 1 filters below hold for NULL too.
+    CREATE TEMPORARY TABLE add_votes_batch ON COMMIT DROP AS
+        SELECT I.vote_order::int AS vote_order,
+                T.id AS topic_id,
+                COALESCE(T.counter_shards, 0) AS counter_shards,
+                voter_digest(I.cookie_string) AS digest,
+                I.comment,
+                CASE WHEN lower(btrim(I.vote)) IN ('t', 'true', 'y', 'yes', 'on', '1') THEN TRUE
+                    WHEN lower(btrim(I.vote)) IN ('f', 'false', 'n', 'no', 'off', '0') THEN FALSE
+                END AS vote,
+                -- NULL p_now falls back to now() as in add_vote().
+                COALESCE(get_timestamp(I.now), now())::timestamp AS date_created,
+                NULL::int AS cookie_id,
+                NULL::int AS cookie_votes_total,
+                NULL::timestamp AS cookie_date_created,
+                0 AS shard,
+                NULL::boolean AS accepted,
+                NULL::int AS votes_total,
+                NULL::boolean AS counted,
+                NULL::int AS return_id,
+                CASE WHEN I.vote IS NOT NULL
+                        AND lower(btrim(I.vote)) NOT IN ('t', 'true', 'y', 'yes', 'on', '1',
+                            'f', 'false', 'n', 'no', 'off', '0') THEN
+                        concat('Error: invalid input syntax for type boolean: "', I.vote, '"')
+                    WHEN T.id IS NULL THEN
+                        'Error: You Cannot vote on non-existing topic.'
+                    WHEN I.cookie_string IS NULL THEN
+                        'Error: A vote needs a cookie.'
+                    WHEN I.comment IS NULL OR length(I.comment) > 400 THEN
+                        'Error: A comment must have at most 400 characters.'
+                END AS status_message
+            FROM unnest(p_topic_slugs, p_cookie_strings, p_comments, p_votes, p_nows)
+                    WITH ORDINALITY AS I(topic_slug, cookie_string, comment, vote, now, vote_order)
+                LEFT JOIN badmeter_topic T
+                    ON T.topic_slug = I.topic_slug;
+
+    UPDATE add_votes_batch B
+        SET return_id = -1
+        WHERE B.status_message IS NOT NULL;
+
+    -- Voters and their vote state rows, added at their first vote in the
+    -- batch. Racing adds leave them to the other transaction. The voters
+    -- are locked FOR KEY SHARE as in add_voter(), and those purged in
+    -- between added again.
+    LOOP
+        INSERT INTO badmeter_voter (digest, date_created)
+            SELECT DISTINCT ON (B.digest) B.digest, B.date_created
+                FROM add_votes_batch B
+                WHERE B.status_message IS NULL
+                ORDER BY B.digest, B.vote_order
+            ON CONFLICT (digest) DO NOTHING;
+
+        PERFORM 1
+            FROM badmeter_voter W
+            WHERE W.digest IN (
+                    SELECT B.digest
+                        FROM add_votes_batch B
+                        WHERE B.status_message IS NULL)
+            ORDER BY W.id
+            FOR KEY SHARE;
+
+        EXIT WHEN NOT EXISTS (
+            SELECT 1
+                FROM add_votes_batch B
+                WHERE B.status_message IS NULL
+                    AND NOT EXISTS (SELECT 1 FROM badmeter_voter W WHERE W.digest = B.digest));
+    END LOOP;
+
+    INSERT INTO badmeter_cookie (
+            voter_id, votes_positive, votes_negative, votes_total,
+            counted, date_voted, date_created, date_updated, topic_id)
+        SELECT DISTINCT ON (W.id, B.topic_id)
+                W.id, 0, 0, 0, FALSE, NULL, B.date_created, B.date_created, B.topic_id
+            FROM add_votes_batch B, badmeter_voter W
+            WHERE B.status_message IS NULL
+                AND W.digest = B.digest
+            ORDER BY W.id, B.topic_id, B.vote_order
+        ON CONFLICT (voter_id, topic_id) DO NOTHING;
+
+    PERFORM 1
+        FROM badmeter_cookie C
+        WHERE (C.voter_id, C.topic_id) IN (
+                SELECT W.id, B.topic_id
+                    FROM add_votes_batch B, badmeter_voter W
+                    WHERE B.status_message IS NULL
+                        AND W.digest = B.digest)
+        ORDER BY C.id
+        FOR UPDATE;
+
+    -- With the vote state rows locked, a vote is accepted unless it falls
+    -- on the day of the voter's previous vote on the topic: the previous
+    -- one in the batch, or date_voted for the first. votes_total is the
+    -- voter's vote total on the topic after the batch.
+    UPDATE add_votes_batch B
+        SET cookie_id = S.cookie_id,
+            cookie_votes_total = S.cookie_votes_total,
+            cookie_date_created = S.cookie_date_created,
+            shard = S.shard,
+            accepted = S.accepted,
+            votes_total = S.votes_total
+        FROM (
+            SELECT A.*, A.cookie_votes_total
+                    + count(*) FILTER (WHERE A.accepted) OVER (PARTITION BY A.cookie_id) AS votes_total
+                FROM (
+                    SELECT B.vote_order, C.id AS cookie_id, C.votes_total AS cookie_votes_total,
+                            C.date_created::timestamp AS cookie_date_created,
+                            -- A sharded topic keeps the counters of this
+                            -- voter's votes in one of its counter rows.
+                            CASE WHEN B.counter_shards > 1 THEN mod(C.voter_id, B.counter_shards)
+                                ELSE 0 END AS shard,
+                            date_trunc('day', B.date_created) IS DISTINCT FROM date_trunc('day',
+                                COALESCE(lag(B.date_created) OVER (PARTITION BY C.id ORDER BY B.vote_order),
+                                    C.date_voted::timestamp)) AS accepted
+                        FROM add_votes_batch B, badmeter_voter W, badmeter_cookie C
+                        WHERE B.status_message IS NULL
+                            AND W.digest = B.digest
+                            AND C.voter_id = W.id
+                            AND C.topic_id = B.topic_id) A) S
+        WHERE S.vote_order = B.vote_order;
+
+    -- Accepted votes count when the vote total reached 3. Their ids are
+    -- taken in input order, as a loop over add_vote() would.
+    UPDATE add_votes_batch B
+        SET return_id = -1,
+            status_message = 'You are limited to one vote per day per topic.'
+        WHERE B.accepted IS FALSE;
+
+    UPDATE add_votes_batch B
+        SET counted = CASE WHEN B.votes_total >= 3 THEN TRUE END,
+            return_id = N.id,
+            status_message = 'badmeter_vote.id'
+        FROM (
+            SELECT A.vote_order, nextval('badmeter_vote_id_seq')::int AS id
+                FROM (
+                    SELECT vote_order
+                        FROM add_votes_batch
+                        WHERE accepted
+                        ORDER BY vote_order) A) N
+        WHERE N.vote_order = B.vote_order;
+
+    -- Counter deltas, one row per vote: the accepted votes and, of voters
+    -- whose 3rd vote is in the batch, their earlier uncounted votes now
+    -- counted. These are not older than the vote state row, which bounds
+    -- the scan to the recent monthly partitions of a partitioned
+    -- badmeter_vote.
+    CREATE TEMPORARY TABLE add_votes_delta ON COMMIT DROP AS
+        SELECT topic_id, counter_shards, cookie_id, shard, date_created,
+                CASE WHEN counted AND vote IS TRUE THEN 1 ELSE 0 END AS votes_positive,
+                CASE WHEN counted AND vote IS NOT TRUE THEN 1 ELSE 0 END AS votes_negative,
+                CASE WHEN counted THEN 1 ELSE 0 END AS votes_counted,
+                CASE WHEN counted THEN 0 ELSE 1 END AS votes_uncounted
+            FROM add_votes_batch
+            WHERE accepted;
+
+    WITH activated AS (
+        UPDATE badmeter_vote V
+            SET counted = TRUE
+            FROM (
+                SELECT DISTINCT topic_id, counter_shards, cookie_id, shard, cookie_date_created
+                    FROM add_votes_batch
+                    WHERE accepted
+                        AND cookie_votes_total < 3
+                        AND votes_total >= 3) A
+            WHERE V.topic_id = A.topic_id
+                AND V.cookie_id = A.cookie_id
+                AND V.date_created >= A.cookie_date_created
+                AND V.counted IS NOT TRUE
+            RETURNING V.topic_id, A.counter_shards, V.cookie_id, A.shard, V.date_created, V.vote)
+    INSERT INTO add_votes_delta
+        SELECT topic_id, counter_shards, cookie_id, shard, date_created::timestamp,
+                CASE WHEN vote IS TRUE THEN 1 ELSE 0 END,
+                CASE WHEN vote IS NOT TRUE THEN 1 ELSE 0 END,
+                1, -1
+            FROM activated;
+
+    INSERT INTO badmeter_vote (
+            id, topic_id, cookie_id, comment, vote, counted, date_created)
+        SELECT return_id, topic_id, cookie_id, comment, vote, counted, date_created
+            FROM add_votes_batch
+            WHERE accepted
+            ORDER BY vote_order;
+
+    -- Keep the badmeter_topic_daily rollup in step, see topic_daily_add().
+    INSERT INTO badmeter_topic_daily AS D (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        SELECT topic_id, date_created::date, shard, sum(votes_counted),
+                sum(CASE WHEN date_created = date_trunc('day', date_created)
+                    THEN votes_counted ELSE 0 END),
+                sum(votes_uncounted)
+            FROM add_votes_delta
+            GROUP BY topic_id, date_created::date, shard
+            ORDER BY topic_id, date_created::date, shard
+        ON CONFLICT (topic_id, day, shard) DO UPDATE
+            SET votes_counted = D.votes_counted + EXCLUDED.votes_counted,
+                votes_counted_midnight = D.votes_counted_midnight + EXCLUDED.votes_counted_midnight,
+                votes_uncounted = D.votes_uncounted + EXCLUDED.votes_uncounted;
+
+    -- Update badmeter_cookie vote state & counters. date_voted is the
+    -- date of the last accepted vote.
+    UPDATE badmeter_cookie C
+        SET votes_total = A.votes_total,
+            counted = (A.votes_total >= 3),
+            date_voted = A.date_voted,
+            votes_positive = (C.votes_positive + S.votes_positive),
+            votes_negative = (C.votes_negative + S.votes_negative)
+        FROM (
+                SELECT cookie_id, max(votes_total) AS votes_total,
+                        (array_agg(date_created ORDER BY vote_order DESC))[1] AS date_voted
+                    FROM add_votes_batch
+                    WHERE accepted
+                    GROUP BY cookie_id) A,
+            (
+                SELECT cookie_id, sum(votes_positive)::int AS votes_positive,
+                        sum(votes_negative)::int AS votes_negative
+                    FROM add_votes_delta
+                    GROUP BY cookie_id) S
+        WHERE C.id = A.cookie_id
+            AND S.cookie_id = A.cookie_id;
+
+    -- Update badmeter_topic counters & compute the badmeter value, or the
+    -- counter rows of sharded topics. date_updated moves forward as in
+    -- add_vote().
+    PERFORM 1
+        FROM badmeter_topic T
+        WHERE T.id IN (
+                SELECT topic_id
+                    FROM add_votes_delta
+                    WHERE counter_shards <= 1)
+        ORDER BY T.id
+        FOR UPDATE;
+
+    UPDATE badmeter_topic T
+        SET votes_positive = (T.votes_positive + S.votes_positive),
+            votes_negative = (T.votes_negative + S.votes_negative),
+            badmeter = topic_badmeter(T.votes_positive + S.votes_positive,
+                T.votes_negative + S.votes_negative),
+            date_updated = greatest(T.date_updated + interval '1 microsecond', clock_timestamp())
+        FROM (
+            SELECT topic_id, sum(votes_positive)::int AS votes_positive,
+                    sum(votes_negative)::int AS votes_negative
+                FROM add_votes_delta
+                WHERE counter_shards <= 1
+                GROUP BY topic_id) S
+        WHERE T.id = S.topic_id;
+
+    INSERT INTO badmeter_topic_counter AS S (
+            topic_id, shard, votes_positive, votes_negative, date_updated)
+        SELECT topic_id, shard, sum(votes_positive), sum(votes_negative), clock_timestamp()
+            FROM add_votes_delta
+            WHERE counter_shards > 1
+            GROUP BY topic_id, shard
+            ORDER BY topic_id, shard
+        ON CONFLICT (topic_id, shard) DO UPDATE
+            SET votes_positive = S.votes_positive + EXCLUDED.votes_positive,
+                votes_negative = S.votes_negative + EXCLUDED.votes_negative,
+                date_updated = greatest(S.date_updated + interval '1 microsecond',
+                    EXCLUDED.date_updated);
+
+    RETURN QUERY
+        SELECT vote_order, return_id, status_message
+            FROM add_votes_batch
+            ORDER BY vote_order;
+
+    DROP TABLE add_votes_batch;
+    DROP TABLE add_votes_delta;
+END;
+$$ LANGUAGE plpgsql;
 
 -- Provides central storage for application configuration.
 -- Used by:
@@ -300,6 +661,10 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Tell the configuration caches of running Django processes to reload.
+-- See badmeter/configuration.py.
+NOTIFY badmeter_configuration;
+
 -- Get purge date the date when number of votes fall below the quota.
 CREATE OR REPLACE FUNCTION get_purgedate(
     p_topic_slug text,
@@ -316,6 +681,22 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+-- Same by topic id, for callers that already resolved the slug.
+CREATE OR REPLACE FUNCTION get_purgedate(
+    p_topic_id int,
+    OUT purge_date text,
+    OUT vote_needed text)
+AS $$
+BEGIN
+    SELECT *
+        INTO purge_date, vote_needed
+        FROM get_purgedate(
+            p_topic_id,
+            now()::text);
+END;
+$$ LANGUAGE plpgsql;
+
+
 -- Overload function get_purgedate adding a timestamp parameter.
 CREATE OR REPLACE FUNCTION get_purgedate(
     p_topic_slug text,
@@ -323,15 +704,57 @@ CREATE OR REPLACE FUNCTION get_purgedate(
     OUT purge_date text,
     OUT vote_needed text)
 AS $$
+DECLARE
+    t_badmeter_topic_id integer;
+BEGIN
+    SELECT id
+        INTO t_badmeter_topic_id
+        FROM badmeter_topic
+        WHERE topic_slug = p_topic_slug;
+
+    SELECT *
+        INTO purge_date, vote_needed
+        FROM get_purgedate(
+            t_badmeter_topic_id,
+            p_now);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- The id based get_purgedate() doing the work.
+--
+-- The purge date is the end of the first interval_days window, sliding
+-- forward one day at a time from today, that holds less than vote_quota
+-- counted votes. Counted votes per day are read from the
+-- badmeter_topic_daily rollup, summed over its shards, and the window is
+-- then slid over them.
+-- Windows include both their start and end timestamps so votes cast
+-- exactly at midnight are tallied separately for the window ending on
+-- that day.
+CREATE OR REPLACE FUNCTION get_purgedate(
+    p_topic_id int,
+    p_now text,
+    OUT purge_date text,
+    OUT vote_needed text)
+AS $$
 DECLARE
     t_now timestamp;
     t_badmeter_topic_id integer;
     t_start timestamp;
     t_end timestamp;
     t_count int;
-    t_oneday interval := interval '1 day';
     t_interval interval;
     t_quota int;
+    t_days int;
+    t_day int;
+    t_offset int;
+    t_votes int;
+    t_midnight_votes int;
+    t_window_votes int := 0;
+    -- Counted votes per day, and those cast exactly at midnight,
+    -- indexed by days since the first window start.
+    t_day_votes int[] := '{}';
+    t_day_midnight_votes int[] := '{}';
 BEGIN
     -- Get application configuration from central location
     -- in get_configuration().
@@ -346,7 +769,13 @@ BEGIN
     SELECT id, date_created
         INTO t_badmeter_topic_id, t_start
         FROM badmeter_topic
-        WHERE topic_slug = p_topic_slug;
+        WHERE id = p_topic_id;
+
+    IF t_badmeter_topic_id IS NULL THEN
+        -- Non-existing topic has no purge date.
+        vote_needed := t_quota::text;
+        RETURN;
+    END IF;
 
     t_start := date_trunc('day', t_start);
 
@@ -359,29 +788,43 @@ BEGIN
         t_start := t_end - t_interval;
     END IF;
 
-    LOOP
-        RAISE NOTICE 't_start=%',t_start;
-        RAISE NOTICE 't_end=%',t_end;
+    t_days := date_part('day', t_interval)::int;
 
-        -- Count the number of votes during the interval_days period.
-        SELECT count(*)
-            INTO t_count
-            FROM badmeter_vote
-            WHERE date_created >= t_start
-                AND date_created <= t_end
-                AND counted IS TRUE
-                AND topic_id = t_badmeter_topic_id;
+    -- Single pass over the daily rollup of all windows still to come.
+    FOR t_offset, t_votes, t_midnight_votes IN
+        SELECT (day - t_start::date), sum(votes_counted), sum(votes_counted_midnight)
+            FROM badmeter_topic_daily
+            WHERE day >= t_start::date
+                AND topic_id = t_badmeter_topic_id
+            GROUP BY day
+            ORDER BY day
+    LOOP
+        t_day_votes[t_offset] := t_votes;
+        t_day_midnight_votes[t_offset] := t_midnight_votes;
+        IF t_offset < t_days THEN
+            t_window_votes := t_window_votes + t_votes;
+        END IF;
+    END LOOP;
 
-        RAISE NOTICE 't_count=%',t_count;
+    -- Slide the window one day at a time. t_window_votes holds the
+    -- votes of days [t_day, t_day + t_days) and the window also takes
+    -- the midnight votes of its end day.
+    t_day := 0;
+    LOOP
+        t_count := t_window_votes + COALESCE(t_day_midnight_votes[t_day + t_days], 0);
 
         -- If there are not enough votes exit & return the end date.
         EXIT WHEN (t_count < t_quota);
 
         -- Try again on the next interval_days period.
-        t_end := t_end + t_oneday;
-        t_start := t_end - t_interval;
+        t_window_votes := t_window_votes
+            + COALESCE(t_day_votes[t_day + t_days], 0)
+            - COALESCE(t_day_votes[t_day], 0);
+        t_day := t_day + 1;
     END LOOP;
 
+    t_end := t_end + t_day * interval '1 day';
+
     purge_date := to_char(t_end, 'FMMon. DD, YYYY');
     vote_needed := (t_quota - t_count)::text;
 END;
@@ -393,40 +836,58 @@ CREATE OR REPLACE FUNCTION get_status_message(
     OUT status_message text
 ) AS $$
 DECLARE
-    t_badmeter_vote_count int;
     t_badmeter_cookie_id int;
     t_badmeter_topic_id int;
 BEGIN
-    -- Check if topic exists.
     SELECT id
         INTO t_badmeter_topic_id
         FROM badmeter_topic
         WHERE topic_slug = p_topic_slug;
 
-    -- ~ RAISE NOTICE 't_badmeter_topic_id = %', t_badmeter_topic_id;
-    IF t_badmeter_topic_id IS NULL THEN
+    SELECT C.id
+        INTO t_badmeter_cookie_id
+        FROM badmeter_cookie C, badmeter_voter W
+        WHERE W.digest = voter_digest(p_cookie_string)
+            AND C.voter_id = W.id
+            AND C.topic_id = t_badmeter_topic_id;
+
+    SELECT S.status_message
+        INTO status_message
+        FROM get_status_message(t_badmeter_topic_id, t_badmeter_cookie_id) S;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Same by topic and cookie id, for callers that already resolved them.
+-- A NULL p_cookie_id is a cookie that has not voted on the topic.
+-- Used by:
+--   get_visitor_state()
+CREATE OR REPLACE FUNCTION get_status_message(
+    p_topic_id int,
+    p_cookie_id int,
+    OUT status_message text
+) AS $$
+DECLARE
+    t_badmeter_vote_count int;
+    t_badmeter_cookie_id int;
+    t_date_voted timestamp;
+BEGIN
+    -- ~ RAISE NOTICE 'p_topic_id = %', p_topic_id;
+    IF p_topic_id IS NULL THEN
         status_message := 'Non-existing topic. Enter new topic above in "Search/New Topic".';
         -- Makes no sense to continue with a non-existing topic.
         RETURN;
     END IF;
 
-    -- Check if cookie exists.
-    SELECT id
-        INTO t_badmeter_cookie_id
+    -- Check if cookie exists. It keeps the vote count of this topic.
+    SELECT id, COALESCE(votes_total, 0), date_voted
+        INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_date_voted
         FROM badmeter_cookie
-        WHERE cookie_string = p_cookie_string
-            AND topic_id = t_badmeter_topic_id;
+        WHERE id = p_cookie_id;
 
     IF t_badmeter_cookie_id IS NULL THEN
         -- This cookie could not have voted since it does not exist in badmeter_cookie table.
         t_badmeter_vote_count := 0;
-    ELSE
-        -- Count the total number of votes per this topic.
-        SELECT count(*)
-            INTO t_badmeter_vote_count
-            FROM badmeter_vote
-            WHERE topic_id = t_badmeter_topic_id
-                AND cookie_id = t_badmeter_cookie_id;
     END IF;
 
     IF t_badmeter_vote_count = 0 THEN
@@ -436,7 +897,7 @@ BEGIN
     END IF;
 
     -- Enforce one vote per day per topic rule.
-    IF if_allow_add(t_badmeter_topic_id, t_badmeter_cookie_id) THEN
+    IF t_date_voted IS NULL OR date_trunc('day', t_date_voted) <> date_trunc('day', now()) THEN
         status_message := concat(status_message, 'You can vote today. ');
     ELSE
         status_message := concat(status_message, 'You have already voted today. ');
@@ -465,7 +926,219 @@ EXCEPTION
 END;
 $$ LANGUAGE plpgsql;
 
--- Used to enforce one vote per day rule.
+-- The visitor independent part of the vote page: topic stats, purge date
+-- and the first p_limit votes. badmeter.stats_cache keeps it per topic,
+-- versioned by topic_date_updated which add_vote() bumps. Used by:
+--   get_vote_page()
+--   badmeter.stats_cache.TopicStatsCache.refresh()
+--
+-- The topic and purge date columns are repeated on each row; the vote
+-- columns hold one row of list_votes() each. A topic without votes still
+-- returns one row with NULL vote columns.
+CREATE OR REPLACE FUNCTION get_topic_page(
+    p_topic_slug text,
+    p_limit int
+)
+RETURNS TABLE(
+    topic_title text,
+    topic_slug text,
+    topic_badmeter numeric,
+    topic_votes_positive int,
+    topic_votes_negative int,
+    topic_date_created timestamp,
+    topic_date_updated timestamp,
+    purge_date text,
+    vote_needed text,
+    vote_id int,
+    vote_counted boolean,
+    vote_cookie_string text,
+    vote_comment text,
+    vote_vote boolean,
+    vote_date_created timestamp with time zone,
+    vote_votes_negative int,
+    vote_votes_positive int
+) AS $$
+DECLARE
+    t_badmeter_topic_id int;
+BEGIN
+    SELECT A.id
+        INTO t_badmeter_topic_id
+        FROM badmeter_topic A
+        WHERE A.topic_slug = p_topic_slug;
+
+    RETURN QUERY
+        SELECT * FROM get_topic_page(t_badmeter_topic_id, p_limit);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Same by topic id, for callers that already resolved the slug. Used by:
+--   get_vote_page()
+--   badmeter.stats_cache.TopicStatsCache.get_vote_page()
+CREATE OR REPLACE FUNCTION get_topic_page(
+    p_topic_id int,
+    p_limit int
+)
+RETURNS TABLE(
+    topic_title text,
+    topic_slug text,
+    topic_badmeter numeric,
+    topic_votes_positive int,
+    topic_votes_negative int,
+    topic_date_created timestamp,
+    topic_date_updated timestamp,
+    purge_date text,
+    vote_needed text,
+    vote_id int,
+    vote_counted boolean,
+    vote_cookie_string text,
+    vote_comment text,
+    vote_vote boolean,
+    vote_date_created timestamp with time zone,
+    vote_votes_negative int,
+    vote_votes_positive int
+) AS $$
+BEGIN
+    -- The counters of a sharded topic are folded on read.
+    SELECT A.topic_title, A.topic_slug, S.badmeter, S.votes_positive,
+            S.votes_negative, A.date_created, S.date_updated
+        INTO topic_title, topic_slug, topic_badmeter, topic_votes_positive,
+            topic_votes_negative, topic_date_created, topic_date_updated
+        FROM badmeter_topic A, topic_counters(A.id) S
+        WHERE A.id = p_topic_id;
+
+    SELECT P.purge_date, P.vote_needed
+        INTO purge_date, vote_needed
+        FROM get_purgedate(p_topic_id) P;
+
+    -- New topic so no purge-date yet then just get from configuration setting.
+    IF purge_date IS NULL THEN
+        SELECT G.interval_days::text, G.vote_quota::text
+            INTO purge_date, vote_needed
+            FROM get_configuration() G;
+    END IF;
+
+    RETURN QUERY
+        SELECT topic_title, topic_slug, topic_badmeter,
+            topic_votes_positive, topic_votes_negative,
+            topic_date_created, topic_date_updated,
+            purge_date, vote_needed,
+            V.id, V.counted, V.cookie_string, V.comment, V.vote,
+            V.date_created, V.votes_negative, V.votes_positive
+        FROM (SELECT 1) X
+            LEFT JOIN list_votes(p_topic_id, NULL, NULL, p_limit) V ON TRUE;
+END;
+$$ LANGUAGE plpgsql;
+-- get_visitor_state() gained the topic_id and cookie_id columns.
+DROP FUNCTION IF EXISTS get_visitor_state(text, text);
+
+-- The visitor dependent part of the vote page, light enough to run on
+-- every request: the cookie stats and status message, plus the topic
+-- date_updated that tells whether a cached get_topic_page() is current.
+-- topic_date_updated is NULL for a non-existing topic.
+--
+-- The slug and cookie string are resolved here once. topic_id and
+-- cookie_id are returned so the rest of the request calls the id based
+-- functions instead of looking them up again. cookie_id is NULL for a
+-- cookie that has not voted on the topic. Used by:
+--   get_vote_page()
+--   badmeter.stats_cache.TopicStatsCache.get_visitor_state()
+CREATE OR REPLACE FUNCTION get_visitor_state(
+    p_topic_slug text,
+    p_cookie_string text,
+    OUT topic_id int,
+    OUT cookie_id int,
+    OUT topic_date_updated timestamp,
+    OUT cookie_votes_positive int,
+    OUT cookie_votes_negative int,
+    OUT cookie_date_created timestamp,
+    OUT status_message text
+) AS $$
+BEGIN
+    SELECT A.id, greatest(A.date_updated, (SELECT max(S.date_updated)
+                FROM badmeter_topic_counter S
+                WHERE S.topic_id = A.id))
+        INTO topic_id, topic_date_updated
+        FROM badmeter_topic A
+        WHERE A.topic_slug = p_topic_slug;
+
+    SELECT C.id, C.votes_positive, C.votes_negative, C.date_created
+        INTO cookie_id, cookie_votes_positive, cookie_votes_negative, cookie_date_created
+        FROM badmeter_cookie C, badmeter_voter W
+        WHERE W.digest = voter_digest(p_cookie_string)
+            AND C.voter_id = W.id
+            AND C.topic_id = get_visitor_state.topic_id;
+
+    SELECT S.status_message
+        INTO status_message
+        FROM get_status_message(topic_id, cookie_id) S;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS get_vote_page(text, text);
+DROP FUNCTION IF EXISTS get_vote_page(text, text, int);
+
+-- Everything needed to render the stats table and the first p_limit
+-- votes of a topic page in one round trip: get_visitor_state() joined
+-- to get_topic_page() by the topic id it resolved, plus the topic_id and
+-- cookie_id for the rest of the request. Used on a topic stats cache
+-- miss by:
+--   badmeter.stats_cache.TopicStatsCache.get_vote_page()
+--
+-- The topic, cookie, purge date and status columns are repeated on each
+-- row; the vote columns hold one row of list_votes() each. A topic
+-- without votes still returns one row with NULL vote columns.
+CREATE OR REPLACE FUNCTION get_vote_page(
+    p_topic_slug text,
+    p_cookie_string text,
+    p_limit int
+)
+RETURNS TABLE(
+    topic_title text,
+    topic_slug text,
+    topic_badmeter numeric,
+    topic_votes_positive int,
+    topic_votes_negative int,
+    topic_date_created timestamp,
+    topic_date_updated timestamp,
+    cookie_votes_positive int,
+    cookie_votes_negative int,
+    cookie_date_created timestamp,
+    purge_date text,
+    vote_needed text,
+    status_message text,
+    topic_id int,
+    cookie_id int,
+    vote_id int,
+    vote_counted boolean,
+    vote_cookie_string text,
+    vote_comment text,
+    vote_vote boolean,
+    vote_date_created timestamp with time zone,
+    vote_votes_negative int,
+    vote_votes_positive int
+) AS $$
+DECLARE
+    S record;
+BEGIN
+    SELECT * INTO S FROM get_visitor_state(p_topic_slug, p_cookie_string);
+
+    RETURN QUERY
+        SELECT T.topic_title, T.topic_slug, T.topic_badmeter,
+            T.topic_votes_positive, T.topic_votes_negative,
+            T.topic_date_created, T.topic_date_updated,
+            S.cookie_votes_positive, S.cookie_votes_negative, S.cookie_date_created,
+            T.purge_date, T.vote_needed, S.status_message,
+            S.topic_id, S.cookie_id,
+            T.vote_id, T.vote_counted, T.vote_cookie_string, T.vote_comment, T.vote_vote,
+            T.vote_date_created, T.vote_votes_negative, T.vote_votes_positive
+        FROM get_topic_page(S.topic_id, p_limit) T;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Used to enforce one vote per day rule. This is a read without locks,
+-- a vote racing the check can still pass it. add_vote() applies the rule
+-- itself on the locked badmeter_cookie row.
 CREATE OR REPLACE FUNCTION if_allow_add(
     p_badmeter_topic_id int,
     p_badmeter_cookie_id int
@@ -485,6 +1158,7 @@ $$ LANGUAGE plpgsql;
 /*
     Overload if_allow_add function and add 'p_now' parameter.
     This is for testing purposes so we can feed it a custom date for testing.
+    Reads the date of the last vote kept on the badmeter_cookie row.
 */
 CREATE OR REPLACE FUNCTION if_allow_add(
     p_badmeter_topic_id int,
@@ -495,25 +1169,19 @@ RETURNS boolean
 AS $$
 DECLARE
     t_now timestamp;
-    t_now_start timestamp;
-    t_now_end timestamp;
-    t_badmeter_vote_count int;
+    t_date_voted timestamp;
 BEGIN
     SELECT COALESCE(get_timestamp(p_now), now())
         INTO t_now;
 
-    t_now_start := date_trunc('day', t_now);
-    t_now_end := t_now_start + interval '1 day';
-
-    SELECT count(*)
-        INTO t_badmeter_vote_count
-        FROM badmeter_vote
-        WHERE topic_id = p_badmeter_topic_id
-            AND cookie_id = p_badmeter_cookie_id
-            AND date_created >= t_now_start
-            AND date_created < t_now_end;
+    SELECT date_voted
+        INTO t_date_voted
+        FROM badmeter_cookie
+        WHERE id = p_badmeter_cookie_id
+            AND topic_id = p_badmeter_topic_id;
 
-    RETURN (t_badmeter_vote_count = 0);
+    RETURN (t_date_voted IS NULL
+        OR date_trunc('day', t_date_voted) <> date_trunc('day', t_now));
 END;
 $$ LANGUAGE plpgsql;
 
@@ -541,31 +1209,94 @@ $$ LANGUAGE plpgsql;
     'value': obj.topic_slug})
 */
 
+-- The text returning list_votes(p_topic_slug) is replaced by the keyset
+-- paginated version below, as are the versions paging by vote id only.
+DROP FUNCTION IF EXISTS list_votes(text);
+DROP FUNCTION IF EXISTS list_votes(text, int, int);
+DROP FUNCTION IF EXISTS list_votes(int, int, int);
+
+-- List up to p_limit votes of a topic, newest first, older than the vote
+-- (p_before_date, p_before_id), or the newest ones when p_before_id is
+-- NULL. Keyset pagination on (date_created, id) keeps deep pages as cheap
+-- as the first one. The page carries the date_created of its last vote,
+-- so a partitioned badmeter_vote only scans the partitions up to it and
+-- a purged last vote still leads to the next page. cookie_string is the
+-- voter digest in hex. Used by:
+--   badmeter.views.votes_json()
 CREATE OR REPLACE FUNCTION list_votes(
-    p_topic_slug text
+    p_topic_slug text,
+    p_before_date timestamp with time zone,
+    p_before_id int,
+    p_limit int
 )
 RETURNS TABLE(
-    id text,
-    counted text,
+    id int,
+    counted boolean,
     cookie_string text,
     comment text,
-    vote text,
-    date_created text,
+    vote boolean,
+    date_created timestamp with time zone,
     votes_negative int,
     votes_positive int
 ) AS $$
+DECLARE
+    t_badmeter_topic_id int;
 BEGIN
+    SELECT B.id
+        INTO t_badmeter_topic_id
+        FROM badmeter_topic B
+        WHERE B.topic_slug = p_topic_slug;
+
     RETURN QUERY
-        SELECT A.id::text, A.counted::text,
-            C.cookie_string::text, A.comment::text, A.vote::text,
-            to_char(A.date_created, 'FMMonth DD, YYYY HH:MI:SS'),
-            C.votes_negative, C.votes_positive
-        FROM badmeter_vote A, badmeter_topic B, badmeter_cookie C
-        WHERE A.topic_id = B.id
-            AND A.cookie_id = C.id
-            AND B.topic_slug = p_topic_slug
-        ORDER BY A.date_created DESC
-        LIMIT 100 OFFSET 0;
+        SELECT * FROM list_votes(t_badmeter_topic_id, p_before_date, p_before_id, p_limit);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Same by topic id, for callers that already resolved the slug. Used by:
+--   get_topic_page()
+CREATE OR REPLACE FUNCTION list_votes(
+    p_topic_id int,
+    p_before_date timestamp with time zone,
+    p_before_id int,
+    p_limit int
+)
+RETURNS TABLE(
+    id int,
+    counted boolean,
+    cookie_string text,
+    comment text,
+    vote boolean,
+    date_created timestamp with time zone,
+    votes_negative int,
+    votes_positive int
+) AS $$
+DECLARE
+    t_badmeter_topic_id int := p_topic_id;
+BEGIN
+    IF p_before_id IS NULL THEN
+        RETURN QUERY
+            SELECT A.id, A.counted, encode(W.digest, 'hex'), A.comment::text,
+                A.vote, A.date_created, C.votes_negative, C.votes_positive
+            FROM badmeter_vote A, badmeter_cookie C, badmeter_voter W
+            WHERE A.topic_id = t_badmeter_topic_id
+                AND A.cookie_id = C.id
+                AND C.voter_id = W.id
+            ORDER BY A.date_created DESC, A.id DESC
+            LIMIT p_limit;
+    ELSE
+        RETURN QUERY
+            SELECT A.id, A.counted, encode(W.digest, 'hex'), A.comment::text,
+                A.vote, A.date_created, C.votes_negative, C.votes_positive
+            FROM badmeter_vote A, badmeter_cookie C, badmeter_voter W
+            WHERE A.topic_id = t_badmeter_topic_id
+                AND A.date_created <= p_before_date
+                AND (A.date_created, A.id) < (p_before_date, p_before_id)
+                AND A.cookie_id = C.id
+                AND C.voter_id = W.id
+            ORDER BY A.date_created DESC, A.id DESC
+            LIMIT p_limit;
+    END IF;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -595,23 +1326,110 @@ CREATE OR REPLACE FUNCTION purge_one(
 RETURNS void
 AS $$
 BEGIN
-    -- Delete records in badmeter_vote.
-    DELETE FROM badmeter_vote
-        WHERE topic_id = p_badmeter_topic_id;
+    PERFORM purge_many(ARRAY[p_badmeter_topic_id]);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Purge a set of topics given their topic_id's in one statement.
+-- Voters left with no other topic go too, see purge_voters(). Returns one
+-- row per purged topic with its deleted vote and cookie counts. Used by:
+--   purge_one()
+--   purge_scan()
+--   badmeter.purge.purge_stale_topics()
+CREATE OR REPLACE FUNCTION purge_many(
+    p_topic_ids int[]
+)
+RETURNS TABLE(
+    topic_id int,
+    topic_slug text,
+    topic_title text,
+    vote_count int,
+    cookie_count int
+) AS $$
+DECLARE
+    t_voter_ids int[];
+BEGIN
+    SELECT array_agg(X.voter_id)
+        INTO t_voter_ids
+        FROM (
+            SELECT C.voter_id FROM badmeter_cookie C WHERE C.topic_id = ANY(p_topic_ids)
+            UNION
+            SELECT T.voter_id FROM badmeter_topic T WHERE T.id = ANY(p_topic_ids)) X;
 
-    -- Remove badmeter_topic foreignkey dependence on badmeter_cookie.
-    -- This is so we can delete records in badmeter_cookie.
-    UPDATE badmeter_topic
-        SET cookie_id = NULL
-        WHERE id = p_badmeter_topic_id;
+    -- Django creates the foreign keys DEFERRABLE INITIALLY DEFERRED so
+    -- all records can go in one statement and are checked at commit.
+    RETURN QUERY
+        WITH daily AS (
+            DELETE FROM badmeter_topic_daily D
+                WHERE D.topic_id = ANY(p_topic_ids)),
+        counters AS (
+            DELETE FROM badmeter_topic_counter S
+                WHERE S.topic_id = ANY(p_topic_ids)),
+        votes AS (
+            DELETE FROM badmeter_vote V
+                WHERE V.topic_id = ANY(p_topic_ids)
+                RETURNING V.topic_id),
+        cookies AS (
+            DELETE FROM badmeter_cookie C
+                WHERE C.topic_id = ANY(p_topic_ids)
+                RETURNING C.topic_id),
+        topics AS (
+            DELETE FROM badmeter_topic T
+                WHERE T.id = ANY(p_topic_ids)
+                RETURNING T.id, T.topic_slug, T.topic_title),
+        -- Log the purge for the in-process search indexes.
+        events AS (
+            INSERT INTO badmeter_topic_event (
+                    topic_id, topic_title, topic_slug, event, date_created)
+                SELECT P.id, P.topic_title, P.topic_slug, 'purge', now()
+                    FROM topics P)
+        SELECT P.id, P.topic_slug::text, P.topic_title::text,
+                COALESCE(PV.n, 0)::int, COALESCE(PC.n, 0)::int
+            FROM topics P
+                LEFT JOIN (SELECT X.topic_id, count(*) AS n
+                        FROM votes X GROUP BY X.topic_id) PV
+                    ON PV.topic_id = P.id
+                LEFT JOIN (SELECT X.topic_id, count(*) AS n
+                        FROM cookies X GROUP BY X.topic_id) PC
+                    ON PC.topic_id = P.id
+            ORDER BY P.id;
+
+    PERFORM purge_voters(t_voter_ids);
+END;
+$$ LANGUAGE plpgsql;
 
-    -- Delete records in badmeter_cookie.
-    DELETE FROM badmeter_cookie
-        WHERE topic_id = p_badmeter_topic_id;
 
-    -- Delete records in badmeter_topic.
-    DELETE FROM badmeter_topic
-        WHERE id = p_badmeter_topic_id;
+-- Delete the voters of p_voter_ids left with no cookie or topic. A voter
+-- is only checked once it is locked, in a statement of its own, so the
+-- check sees the rows of any add that used it before. Voters locked by
+-- add_voter() or add_votes() for an add still running are kept. Returns
+-- the number of voters deleted. Used by:
+--   purge_many()
+CREATE OR REPLACE FUNCTION purge_voters(
+    p_voter_ids int[]
+)
+RETURNS int
+AS $$
+DECLARE
+    t_locked_ids int[];
+    t_count int;
+BEGIN
+    SELECT array_agg(L.id)
+        INTO t_locked_ids
+        FROM (
+            SELECT W.id
+                FROM badmeter_voter W
+                WHERE W.id = ANY(p_voter_ids)
+                ORDER BY W.id
+                FOR UPDATE SKIP LOCKED) L;
+
+    DELETE FROM badmeter_voter W
+        WHERE W.id = ANY(t_locked_ids)
+            AND NOT EXISTS (SELECT 1 FROM badmeter_cookie C WHERE C.voter_id = W.id)
+            AND NOT EXISTS (SELECT 1 FROM badmeter_topic T WHERE T.voter_id = W.id);
+    GET DIAGNOSTICS t_count = ROW_COUNT;
+    RETURN t_count;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -624,22 +1442,39 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+-- Purge all stale topics in one transaction. Large sites should run
+-- "python manage.py purge_topics" instead, which purges the same
+-- topics in bounded batches each in its own transaction.
 CREATE OR REPLACE FUNCTION purge_scan(
     p_now text
 )
 RETURNS void
 AS $$
+BEGIN
+    PERFORM purge_many(ARRAY(SELECT id FROM list_stale_topics(p_now, NULL)));
+    PERFORM trim_topic_events();
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List topics with less than vote_quota votes within the last
+-- interval_days, among all topics or only those in p_topic_ids.
+-- Topics younger than interval_days are never stale. Used by:
+--   purge_scan()
+--   badmeter.purge.purge_stale_topics()
+CREATE OR REPLACE FUNCTION list_stale_topics(
+    p_now text,
+    p_topic_ids int[]
+)
+RETURNS TABLE(
+    id int
+) AS $$
 DECLARE
     t_now timestamp;
     t_start timestamp;
     t_end timestamp;
-    t_badmeter_topic_id int;
-    t_date_created timestamp;
-    t_topic_slug text;
-    t_badmeter_vote_count int;
-    t_interval interval;    -- := interval '11 days';
-    t_quota int;            -- := 100;
-    -- ~ t_timestamp timestamp;
+    t_interval interval;
+    t_quota int;
 BEGIN
     -- Get application configuration from central location
     -- in get_configuration().
@@ -653,36 +1488,35 @@ BEGIN
     t_end := date_trunc('day', t_now);
     t_start := t_end - t_interval;
 
-    RAISE NOTICE 'start = %', t_start;
-    RAISE NOTICE 'end = %', t_end;
-
-    FOR t_badmeter_topic_id, t_date_created, t_topic_slug IN
-        SELECT id, date_created, topic_slug
-            FROM badmeter_topic
-            ORDER BY id
-    LOOP
-        IF t_now > (date_trunc('day', t_date_created) + t_interval) THEN
-
-            SELECT count(*)
-                INTO t_badmeter_vote_count
-                FROM badmeter_vote
-                WHERE topic_id = t_badmeter_topic_id
-                    AND date_created >= t_start
-                    AND date_created < t_end;
-
-            IF t_badmeter_vote_count < t_quota THEN
-
-                -- ~ RAISE NOTICE 'topic_slug = %', t_topic_slug;
-                -- ~ RAISE NOTICE 't_badmeter_topic_id = %', t_badmeter_topic_id;
-                PERFORM purge_one(t_badmeter_topic_id);
+    -- One grouped pass over the daily rollup. Both dates are
+    -- midnights so the rollup is exact.
+    RETURN QUERY
+        SELECT T.id
+            FROM badmeter_topic T
+                LEFT JOIN (
+                    SELECT D.topic_id, sum(D.votes_counted + D.votes_uncounted) AS votes
+                        FROM badmeter_topic_daily D
+                        WHERE D.day >= t_start::date
+                            AND D.day < t_end::date
+                            AND (p_topic_ids IS NULL OR D.topic_id = ANY(p_topic_ids))
+                        GROUP BY D.topic_id) V
+                    ON V.topic_id = T.id
+            WHERE t_now > (date_trunc('day', T.date_created) + t_interval)
+                AND COALESCE(V.votes, 0) < t_quota
+                AND (p_topic_ids IS NULL OR T.id = ANY(p_topic_ids))
+            ORDER BY T.id;
+END;
+$$ LANGUAGE plpgsql;
 
-                -- ~ RAISE NOTICE 't_date_created = %', t_date_created;
-                -- ~ t_timestamp := date_trunc('day', t_date_created) + t_interval;
-                -- ~ RAISE NOTICE 't_purge_date = %', t_timestamp;
 
-            END IF;
-        END IF;
-    END LOOP;
+-- Trim the topic event log. Search indexes older than this
+-- reload in full (see settings.TOPIC_INDEX_MAX_AGE_SECONDS).
+CREATE OR REPLACE FUNCTION trim_topic_events()
+RETURNS void
+AS $$
+BEGIN
+    DELETE FROM badmeter_topic_event
+        WHERE date_created < now() - interval '1 day';
 END;
 $$ LANGUAGE plpgsql;
 
@@ -705,3 +1539,550 @@ EXCEPTION
         RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
+-- Sharded topic vote counters. A counted vote adds to the badmeter_topic
+-- row of its topic, so the voters of one busy topic queue on that row
+-- lock. Topics opted in with set_counter_shards() spread their counters
+-- over counter_shards badmeter_topic_counter rows instead, and their
+-- badmeter_topic_daily rollup over as many rows per day. add_vote()
+-- picks the row of a vote by its voter id.
+--
+-- The counter rows hold deltas not yet in badmeter_topic. Readers add
+-- them on read with topic_counters(). fold_topic_counters() moves them
+-- into badmeter_topic, run by "python manage.py topic_counters --every".
+
+
+-- The badmeter value of the vote counters. greatest() prevents
+-- divide-by-zero error.
+CREATE OR REPLACE FUNCTION topic_badmeter(
+    p_votes_positive int,
+    p_votes_negative int
+)
+RETURNS numeric
+AS $$
+    SELECT (50 + floor((p_votes_positive - p_votes_negative)
+        / greatest(p_votes_positive + p_votes_negative, 1)::float * 50))::numeric;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- The vote counters of a topic with its pending deltas. Used by:
+--   get_topic_page()
+CREATE OR REPLACE FUNCTION topic_counters(
+    p_topic_id int,
+    OUT badmeter numeric,
+    OUT votes_positive int,
+    OUT votes_negative int,
+    OUT date_updated timestamp
+) AS $$
+DECLARE
+    t_shards int;
+BEGIN
+    SELECT T.badmeter, T.votes_positive + COALESCE(sum(S.votes_positive), 0),
+            T.votes_negative + COALESCE(sum(S.votes_negative), 0),
+            greatest(T.date_updated, max(S.date_updated)), count(S.id)
+        INTO badmeter, votes_positive, votes_negative, date_updated, t_shards
+        FROM badmeter_topic T
+            LEFT JOIN badmeter_topic_counter S
+                ON S.topic_id = T.id
+        WHERE T.id = p_topic_id
+        GROUP BY T.id;
+
+    IF t_shards > 0 THEN
+        badmeter := topic_badmeter(votes_positive, votes_negative);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Move the pending deltas of a topic, or of all topics when NULL, into
+-- badmeter_topic, and the sharded rollup rows of past days into shard 0.
+-- Each counter row is locked only for the statement. Returns the number
+-- of topics folded.
+CREATE OR REPLACE FUNCTION fold_topic_counters(
+    p_topic_id int
+)
+RETURNS int
+AS $$
+DECLARE
+    t_count int;
+BEGIN
+    WITH folded AS (
+        DELETE FROM badmeter_topic_counter S
+            WHERE p_topic_id IS NULL
+                OR S.topic_id = p_topic_id
+            RETURNING S.topic_id, S.votes_positive, S.votes_negative, S.date_updated),
+    deltas AS (
+        SELECT F.topic_id, sum(F.votes_positive)::int AS votes_positive,
+                sum(F.votes_negative)::int AS votes_negative,
+                max(F.date_updated) AS date_updated
+            FROM folded F
+            GROUP BY F.topic_id)
+    UPDATE badmeter_topic T
+        SET votes_positive = T.votes_positive + D.votes_positive,
+            votes_negative = T.votes_negative + D.votes_negative,
+            badmeter = topic_badmeter(T.votes_positive + D.votes_positive,
+                T.votes_negative + D.votes_negative),
+            date_updated = greatest(T.date_updated, D.date_updated)
+        FROM deltas D
+        WHERE T.id = D.topic_id;
+    GET DIAGNOSTICS t_count = ROW_COUNT;
+
+    WITH folded AS (
+        DELETE FROM badmeter_topic_daily R
+            WHERE R.shard > 0
+                AND R.day < current_date
+                AND (p_topic_id IS NULL OR R.topic_id = p_topic_id)
+            RETURNING R.topic_id, R.day, R.votes_counted, R.votes_counted_midnight,
+                R.votes_uncounted)
+    INSERT INTO badmeter_topic_daily AS R (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        SELECT F.topic_id, F.day, 0, sum(F.votes_counted), sum(F.votes_counted_midnight),
+                sum(F.votes_uncounted)
+            FROM folded F
+            GROUP BY F.topic_id, F.day
+        ON CONFLICT (topic_id, day, shard) DO UPDATE
+            SET votes_counted = R.votes_counted + EXCLUDED.votes_counted,
+                votes_counted_midnight = R.votes_counted_midnight + EXCLUDED.votes_counted_midnight,
+                votes_uncounted = R.votes_uncounted + EXCLUDED.votes_uncounted;
+
+    RETURN t_count;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Opt a topic in to p_shards counter rows, or out with 0 or 1. Opting out
+-- folds its pending deltas. Returns FALSE for a non-existing topic.
+CREATE OR REPLACE FUNCTION set_counter_shards(
+    p_topic_slug text,
+    p_shards int
+)
+RETURNS boolean
+AS $$
+DECLARE
+    t_badmeter_topic_id int;
+BEGIN
+    UPDATE badmeter_topic
+        SET counter_shards = CASE WHEN p_shards > 1 THEN p_shards END
+        WHERE topic_slug = p_topic_slug
+        RETURNING id INTO t_badmeter_topic_id;
+
+    IF t_badmeter_topic_id IS NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    IF p_shards <= 1 THEN
+        PERFORM fold_topic_counters(t_badmeter_topic_id);
+    END IF;
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Maintain the badmeter_topic_daily vote rollup. Used by:
+--   add_vote()
+--   python manage.py topic_daily
+--
+-- topic_daily_add() gained the p_shard parameter.
+DROP FUNCTION IF EXISTS topic_daily_add(int, timestamp, int, int);
+
+-- Add deltas to the counted and uncounted totals of the day of
+-- p_date_created. Counted votes cast exactly at midnight are also
+-- tallied in votes_counted_midnight for get_purgedate().
+--
+-- Topics with sharded counters (see topic_counters.sql) keep a row per
+-- day per shard, so readers sum the rows of a day. Other topics only
+-- use shard 0.
+CREATE OR REPLACE FUNCTION topic_daily_add(
+    p_badmeter_topic_id int,
+    p_date_created timestamp,
+    p_counted int,
+    p_uncounted int,
+    p_shard int
+)
+RETURNS void
+AS $$
+DECLARE
+    t_midnight int := 0;
+BEGIN
+    IF p_date_created = date_trunc('day', p_date_created) THEN
+        t_midnight := p_counted;
+    END IF;
+
+    INSERT INTO badmeter_topic_daily AS D (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        VALUES (
+            p_badmeter_topic_id, p_date_created::date, p_shard, p_counted, t_midnight,
+            p_uncounted)
+        ON CONFLICT (topic_id, day, shard) DO UPDATE
+            SET votes_counted = D.votes_counted + p_counted,
+                votes_counted_midnight = D.votes_counted_midnight + t_midnight,
+                votes_uncounted = D.votes_uncounted + p_uncounted;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Rebuild the rollup of one topic, or of all topics when NULL,
+-- from the raw badmeter_vote table.
+CREATE OR REPLACE FUNCTION rebuild_topic_daily(
+    p_badmeter_topic_id int
+)
+RETURNS void
+AS $$
+BEGIN
+    DELETE FROM badmeter_topic_daily
+        WHERE p_badmeter_topic_id IS NULL
+            OR topic_id = p_badmeter_topic_id;
+
+    INSERT INTO badmeter_topic_daily (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        SELECT topic_id, date_created::date, 0,
+                sum(CASE WHEN counted IS TRUE THEN 1 ELSE 0 END),
+                sum(CASE WHEN counted IS TRUE
+                    AND date_created = date_trunc('day', date_created) THEN 1 ELSE 0 END),
+                sum(CASE WHEN counted IS TRUE THEN 0 ELSE 1 END)
+            FROM badmeter_vote
+            WHERE p_badmeter_topic_id IS NULL
+                OR topic_id = p_badmeter_topic_id
+            GROUP BY topic_id, date_created::date;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List the rollup rows that disagree with the raw badmeter_vote table.
+CREATE OR REPLACE FUNCTION verify_topic_daily()
+RETURNS TABLE(
+    topic_id int,
+    day date,
+    votes_counted int,
+    votes_counted_midnight int,
+    votes_uncounted int,
+    expected_counted int,
+    expected_counted_midnight int,
+    expected_uncounted int
+) AS $$
+BEGIN
+    RETURN QUERY
+        SELECT COALESCE(D.topic_id, V.topic_id), COALESCE(D.day, V.day),
+                D.votes_counted, D.votes_counted_midnight, D.votes_uncounted,
+                V.counted, V.counted_midnight, V.uncounted
+            FROM (
+                SELECT R.topic_id, R.day, sum(R.votes_counted)::int AS votes_counted,
+                        sum(R.votes_counted_midnight)::int AS votes_counted_midnight,
+                        sum(R.votes_uncounted)::int AS votes_uncounted
+                    FROM badmeter_topic_daily R
+                    GROUP BY R.topic_id, R.day) D
+                FULL OUTER JOIN (
+                    SELECT A.topic_id, A.date_created::date AS day,
+                            sum(CASE WHEN A.counted IS TRUE THEN 1 ELSE 0 END)::int AS counted,
+                            sum(CASE WHEN A.counted IS TRUE
+                                AND A.date_created = date_trunc('day', A.date_created)
+                                THEN 1 ELSE 0 END)::int AS counted_midnight,
+                            sum(CASE WHEN A.counted IS TRUE THEN 0 ELSE 1 END)::int AS uncounted
+                        FROM badmeter_vote A
+                        GROUP BY A.topic_id, A.date_created::date) V
+                    ON V.topic_id = D.topic_id
+                        AND V.day = D.day
+            WHERE (D.votes_counted, D.votes_counted_midnight, D.votes_uncounted)
+                    IS DISTINCT FROM (V.counted, V.counted_midnight, V.uncounted)
+            ORDER BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
+-- List the vote counters of the given topics that disagree with the raw
+-- badmeter_vote table: badmeter_cookie vote state and counters, topic
+-- counters with their pending shards, and voters with more than one vote
+-- on a topic in a day. Topics whose old vote partitions were dropped
+-- disagree too. Used by:
+--   python manage.py stress_votes
+CREATE OR REPLACE FUNCTION verify_vote_counters(
+    p_topic_ids int[]
+)
+RETURNS TABLE(
+    topic_id int,
+    cookie_id int,
+    problem text
+) AS $$
+BEGIN
+    RETURN QUERY
+        SELECT C.topic_id, C.id, 'cookie counters'::text
+            FROM badmeter_cookie C
+                LEFT JOIN (
+                    SELECT A.cookie_id, count(*)::int AS votes_total,
+                            sum(CASE WHEN A.counted IS TRUE THEN 0 ELSE 1 END)::int AS uncounted,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_positive,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS NOT TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_negative
+                        FROM badmeter_vote A
+                        WHERE A.topic_id = ANY(p_topic_ids)
+                        GROUP BY A.cookie_id) V
+                    ON V.cookie_id = C.id
+            WHERE C.topic_id = ANY(p_topic_ids)
+                AND ((C.votes_total, C.votes_positive, C.votes_negative)
+                        IS DISTINCT FROM (COALESCE(V.votes_total, 0),
+                            COALESCE(V.votes_positive, 0), COALESCE(V.votes_negative, 0))
+                    OR C.counted IS DISTINCT FROM (C.votes_total >= 3)
+                    OR V.uncounted <> CASE WHEN C.votes_total >= 3 THEN 0 ELSE C.votes_total END)
+        UNION ALL
+        SELECT A.topic_id, A.cookie_id, 'more than one vote a day'::text
+            FROM badmeter_vote A
+            WHERE A.topic_id = ANY(p_topic_ids)
+            GROUP BY A.topic_id, A.cookie_id, A.date_created::date
+            HAVING count(*) > 1
+        UNION ALL
+        SELECT T.id, NULL::int, 'topic counters'::text
+            FROM badmeter_topic T
+                CROSS JOIN topic_counters(T.id) S
+                LEFT JOIN (
+                    SELECT A.topic_id,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_positive,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS NOT TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_negative
+                        FROM badmeter_vote A
+                        WHERE A.topic_id = ANY(p_topic_ids)
+                        GROUP BY A.topic_id) V
+                    ON V.topic_id = T.id
+            WHERE T.id = ANY(p_topic_ids)
+                AND ((S.votes_positive, S.votes_negative)
+                        IS DISTINCT FROM (COALESCE(V.votes_positive, 0), COALESCE(V.votes_negative, 0))
+                    OR S.badmeter <> topic_badmeter(S.votes_positive, S.votes_negative))
+        ORDER BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
+-- Monthly range partitions of badmeter_vote on date_created. The table is
+-- converted once by upgrade/004_vote_partitions.sql (PostgreSQL 11 or
+-- later). "python manage.py vote_partitions" then creates the partitions
+-- of the coming months and drops whole months past VOTE_RETENTION_MONTHS
+-- without DELETEs. Partitions are named badmeter_vote_YYYYMM. Rows
+-- outside of them land in badmeter_vote_default. Month bounds are taken
+-- in the session time zone.
+
+
+-- Whether badmeter_vote is partitioned. The functions below do nothing
+-- on the plain table created by "python manage.py migrate".
+CREATE OR REPLACE FUNCTION vote_partitioned()
+RETURNS boolean
+AS $$
+    SELECT COALESCE((
+        SELECT relkind = 'p'
+            FROM pg_class
+            WHERE oid = to_regclass('badmeter_vote')), FALSE);
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION vote_partition_name(
+    p_month timestamp
+)
+RETURNS text
+AS $$
+    SELECT 'badmeter_vote_' || to_char(p_month, 'YYYYMM');
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Create the missing monthly partitions from the month of p_from up to
+-- the month of p_to. Votes of those months kept in badmeter_vote_default
+-- move to their new partition. Returns the created partition names.
+-- Used by:
+--   partition_votes()
+--   badmeter vote_partitions and seed_data commands
+CREATE OR REPLACE FUNCTION create_vote_partitions(
+    p_from timestamp,
+    p_to timestamp
+)
+RETURNS SETOF text
+AS $$
+DECLARE
+    t_month timestamp := date_trunc('month', p_from);
+    t_next timestamp;
+    t_name text;
+BEGIN
+    IF NOT vote_partitioned() THEN
+        RETURN;
+    END IF;
+
+    WHILE t_month <= p_to LOOP
+        t_next := t_month + interval '1 month';
+        t_name := vote_partition_name(t_month);
+
+        IF to_regclass(t_name) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM badmeter_vote_default
+                    WHERE date_created >= t_month
+                        AND date_created < t_next) THEN
+                EXECUTE format('CREATE TABLE %I (LIKE badmeter_vote INCLUDING DEFAULTS)', t_name);
+                EXECUTE format('
+                    WITH moved AS (
+                        DELETE FROM badmeter_vote_default
+                            WHERE date_created >= %L
+                                AND date_created < %L
+                            RETURNING *)
+                    INSERT INTO %I SELECT * FROM moved', t_month, t_next, t_name);
+                EXECUTE format('ALTER TABLE badmeter_vote ATTACH PARTITION %I
+                    FOR VALUES FROM (%L) TO (%L)', t_name, t_month, t_next);
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF badmeter_vote
+                    FOR VALUES FROM (%L) TO (%L)', t_name, t_month, t_next);
+            END IF;
+            RETURN NEXT t_name;
+        END IF;
+
+        t_month := t_next;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List the monthly partitions of badmeter_vote, oldest first.
+CREATE OR REPLACE FUNCTION list_vote_partitions()
+RETURNS TABLE(
+    partition_name text,
+    range_start timestamp,
+    range_end timestamp
+) AS $$
+BEGIN
+    RETURN QUERY
+        SELECT C.relname::text, P.range_start, P.range_start + interval '1 month'
+            FROM pg_inherits I
+                JOIN pg_class C
+                    ON C.oid = I.inhrelid,
+                LATERAL (SELECT to_timestamp(right(C.relname, 6), 'YYYYMM')::timestamp
+                    AS range_start) P
+            WHERE I.inhparent = to_regclass('badmeter_vote')
+                AND C.relname ~ '^badmeter_vote_[0-9]{6}$'
+            ORDER BY P.range_start;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List the partitions whose votes are all older than p_months months
+-- before the month of p_now. Partitions holding any vote of the last
+-- interval_days, which the purge windows may still read, are never
+-- listed.
+CREATE OR REPLACE FUNCTION list_expired_vote_partitions(
+    p_now text,
+    p_months int
+)
+RETURNS TABLE(
+    partition_name text,
+    range_start timestamp,
+    range_end timestamp
+) AS $$
+DECLARE
+    t_now timestamp;
+    t_interval interval;
+BEGIN
+    SELECT interval_days
+        INTO t_interval
+        FROM get_configuration();
+
+    SELECT COALESCE(get_timestamp(p_now), now())
+        INTO t_now;
+
+    RETURN QUERY
+        SELECT P.partition_name, P.range_start, P.range_end
+            FROM list_vote_partitions() P
+            WHERE P.range_end <= date_trunc('month', t_now) - p_months * interval '1 month'
+                AND P.range_end <= date_trunc('day', t_now) - t_interval
+            ORDER BY P.range_start;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Detach and drop one monthly partition with its days of the
+-- badmeter_topic_daily rollup. The vote counters on badmeter_topic and
+-- badmeter_cookie are kept. Returns the bytes freed.
+CREATE OR REPLACE FUNCTION drop_vote_partition(
+    p_partition_name text
+)
+RETURNS bigint
+AS $$
+DECLARE
+    t_start timestamp;
+    t_end timestamp;
+    t_bytes bigint;
+BEGIN
+    SELECT range_start, range_end
+        INTO t_start, t_end
+        FROM list_vote_partitions()
+        WHERE partition_name = p_partition_name;
+
+    IF t_start IS NULL THEN
+        RAISE EXCEPTION 'No badmeter_vote partition %', p_partition_name;
+    END IF;
+
+    t_bytes := pg_total_relation_size(to_regclass(p_partition_name));
+    EXECUTE format('ALTER TABLE badmeter_vote DETACH PARTITION %I', p_partition_name);
+    EXECUTE format('DROP TABLE %I', p_partition_name);
+
+    DELETE FROM badmeter_topic_daily
+        WHERE day >= t_start::date
+            AND day < t_end::date;
+
+    RETURN t_bytes;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Convert the plain badmeter_vote table into a partitioned one, with
+-- partitions from the month of its oldest vote up to p_months_ahead
+-- months ahead. The primary key becomes (id, date_created) as it has to
+-- hold the partition key. Used by:
+--   upgrade/004_vote_partitions.sql
+CREATE OR REPLACE FUNCTION partition_votes(
+    p_months_ahead int
+)
+RETURNS void
+AS $$
+DECLARE
+    t_first timestamp;
+BEGIN
+    IF vote_partitioned() THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE badmeter_vote RENAME TO badmeter_vote_heap;
+    ALTER TABLE badmeter_vote_heap RENAME CONSTRAINT badmeter_vote_pkey TO badmeter_vote_heap_pkey;
+    -- Keep the id sequence when the old table is dropped.
+    ALTER SEQUENCE badmeter_vote_id_seq OWNED BY NONE;
+
+    CREATE TABLE badmeter_vote (
+        id integer NOT NULL DEFAULT nextval('badmeter_vote_id_seq'),
+        topic_id integer NOT NULL,
+        cookie_id integer NOT NULL,
+        comment varchar(400) NOT NULL,
+        vote boolean NULL,
+        counted boolean NULL,
+        date_created timestamp with time zone NOT NULL,
+        PRIMARY KEY (id, date_created)
+    ) PARTITION BY RANGE (date_created);
+
+    CREATE TABLE badmeter_vote_default PARTITION OF badmeter_vote DEFAULT;
+
+    SELECT date_trunc('month', COALESCE(min(date_created), now()))
+        INTO t_first
+        FROM badmeter_vote_heap;
+
+    PERFORM create_vote_partitions(t_first,
+        (now() + p_months_ahead * interval '1 month')::timestamp);
+
+    INSERT INTO badmeter_vote (
+            id, topic_id, cookie_id, comment, vote, counted, date_created)
+        SELECT id, topic_id, cookie_id, comment, vote, counted, date_created
+            FROM badmeter_vote_heap;
+
+    DROP TABLE badmeter_vote_heap;
+    ALTER SEQUENCE badmeter_vote_id_seq OWNED BY badmeter_vote.id;
+
+    -- Indexes and foreign keys after the copy, built once per partition.
+    -- The partition bounds take the place of the date_created index.
+    CREATE INDEX badmeter_vote_cookie_id
+        ON badmeter_vote (cookie_id);
+    CREATE INDEX badmeter_vote_topic_id_cookie_id_date_created
+        ON badmeter_vote (topic_id, cookie_id, date_created);
+    CREATE INDEX badmeter_vote_topic_id_date_created_id
+        ON badmeter_vote (topic_id, date_created, id);
+
+    ALTER TABLE badmeter_vote
+        ADD CONSTRAINT badmeter_vote_topic_id_fk
+            FOREIGN KEY (topic_id) REFERENCES badmeter_topic (id) DEFERRABLE INITIALLY DEFERRED,
+        ADD CONSTRAINT badmeter_vote_cookie_id_fk
+            FOREIGN KEY (cookie_id) REFERENCES badmeter_cookie (id) DEFERRABLE INITIALLY DEFERRED;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,57 @@
+"Thread-safe in-memory LRU cache backend."
+
+from collections import OrderedDict
+try:
+    from django.utils.six.moves import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.synch import RWLock
+
+# Django's locmem backend culls an arbitrary 1/CULL_FREQUENCY of its
+# entries when MAX_ENTRIES is reached. This one keeps its entries in
+# recently used order and only drops the least recently used ones, so
+# the hot topics stay cached. Configure it in settings.CACHES with
+# 'BACKEND': 'badmeter.cache.LRUCache' and OPTIONS MAX_ENTRIES.
+
+_caches = {}
+_expire_info = {}
+_locks = {}
+
+
+class LRUCache(LocMemCache):
+    def __init__(self, name, params):
+        LocMemCache.__init__(self, name, params)
+        self._cache = _caches.setdefault(name, OrderedDict())
+        self._expire_info = _expire_info.setdefault(name, {})
+        self._lock = _locks.setdefault(name, RWLock())
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock.writer():
+            if self._has_expired(key):
+                self._delete(key)
+                return default
+            # Move to the most recently used end.
+            pickled = self._cache.pop(key)
+            self._cache[key] = pickled
+        try:
+            return pickle.loads(pickled)
+        except pickle.PickleError:
+            return default
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        # Re-inserting moves the key to the most recently used end.
+        self._cache.pop(key, None)
+        LocMemCache._set(self, key, value, timeout)
+
+    def _cull(self):
+        if self._cull_frequency == 0:
+            self.clear()
+            return
+        for i in range(max(len(self._cache) // self._cull_frequency, 1)):
+            key, value = self._cache.popitem(last=False)
+            self._expire_info.pop(key, None)
@@ -0,0 +1,198 @@
+from recaptcha.client.captcha import RecaptchaResponse
+from myproject import settings
+from . import metrics
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import Queue
+
+# reCAPTCHA verification client used by TopicModelForm and VoteModelForm.
+#
+# recaptcha.client.captcha.submit() opens a new HTTP connection per call
+# with no timeout, so a slow verifier holds every WSGI worker doing a
+# write. This drop-in submit() instead:
+#   - reuses keep-alive connections from a pool of RECAPTCHA_POOL_SIZE,
+#   - gives up after RECAPTCHA_TIMEOUT_SECONDS,
+#   - opens a circuit breaker after RECAPTCHA_BREAKER_FAILURES failures
+#     in a row, failing fast for RECAPTCHA_BREAKER_RESET_SECONDS before
+#     letting one trial call through,
+#   - records its latency and outcomes in badmeter.metrics.
+# Failures count as invalid captchas so no unverified write gets in.
+#
+# The verifier is RECAPTCHA_VERIFY_URL. Point it at the stub verifier
+# of "python manage.py recaptcha_stub" for tests and load runs.
+
+latency = metrics.histogram('badmeter_recaptcha_verify_seconds',
+    'reCAPTCHA verification round trip seconds.')
+failures = metrics.counter('badmeter_recaptcha_failures_total',
+    'reCAPTCHA verifications that failed or timed out.')
+rejected = metrics.counter('badmeter_recaptcha_breaker_rejected_total',
+    'reCAPTCHA verifications refused by the open circuit breaker.')
+
+UNAVAILABLE = 'recaptcha-not-reachable'
+
+
+class CircuitBreaker(object):
+    """
+    Closed until failure_limit failures in a row, then open for
+    reset_seconds, then half open: one trial call closes or reopens it.
+    """
+    def __init__(self, failure_limit, reset_seconds):
+        self.failure_limit = failure_limit
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.time() - self._opened_at >= self.reset_seconds:
+                # Half open: let this call through, hold the others.
+                self._opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_limit:
+                self._opened_at = time.time()
+
+
+class VerifyClient(object):
+    """
+    Keep-alive pooled POST client of the reCAPTCHA verify API.
+    """
+    def __init__(self, verify_url=None, timeout=None, pool_size=None,
+            failure_limit=None, reset_seconds=None):
+        url = urlparse.urlsplit(verify_url or settings.RECAPTCHA_VERIFY_URL)
+        self.connection_class = (httplib.HTTPSConnection if url.scheme == 'https'
+            else httplib.HTTPConnection)
+        self.host = url.netloc
+        self.path = url.path
+        self.timeout = settings.RECAPTCHA_TIMEOUT_SECONDS if timeout is None else timeout
+        self.breaker = CircuitBreaker(
+            settings.RECAPTCHA_BREAKER_FAILURES if failure_limit is None else failure_limit,
+            settings.RECAPTCHA_BREAKER_RESET_SECONDS if reset_seconds is None else reset_seconds)
+        self._pool = Queue.LifoQueue(pool_size or settings.RECAPTCHA_POOL_SIZE)
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait(), True
+        except Queue.Empty:
+            return self.connection_class(self.host, timeout=self.timeout), False
+
+    def _put_connection(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    def _request(self, connection, body):
+        connection.request('POST', self.path, body, {
+            'Content-type': 'application/x-www-form-urlencoded',
+            'User-agent': 'reCAPTCHA Python'})
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def _post(self, body):
+        connection, reused = self._get_connection()
+        try:
+            status, data = self._request(connection, body)
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise
+            # The server may have closed an idle keep-alive connection.
+            # Retry once on a fresh one.
+            connection = self.connection_class(self.host, timeout=self.timeout)
+            try:
+                status, data = self._request(connection, body)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+        self._put_connection(connection)
+        if status != 200:
+            raise httplib.HTTPException('verify returned HTTP %d' % status)
+        return data
+
+    def submit(self, recaptcha_challenge_field, recaptcha_response_field,
+            private_key, remoteip):
+        """
+        Same as recaptcha.client.captcha.submit().
+        """
+        if not (recaptcha_response_field and recaptcha_challenge_field):
+            return RecaptchaResponse(is_valid=False, error_code='incorrect-captcha-sol')
+
+        if not self.breaker.allow():
+            rejected.inc()
+            return RecaptchaResponse(is_valid=False, error_code=UNAVAILABLE)
+
+        def encode_if_necessary(s):
+            if isinstance(s, unicode):
+                return s.encode('utf-8')
+            return s
+
+        body = urllib.urlencode({
+            'privatekey': encode_if_necessary(private_key),
+            'remoteip': encode_if_necessary(remoteip),
+            'challenge': encode_if_necessary(recaptcha_challenge_field),
+            'response': encode_if_necessary(recaptcha_response_field)})
+
+        started = time.time()
+        try:
+            return_values = self._post(body).splitlines()
+        except (httplib.HTTPException, socket.error):
+            failures.inc()
+            self.breaker.failure()
+            return RecaptchaResponse(is_valid=False, error_code=UNAVAILABLE)
+        finally:
+            latency.observe(time.time() - started)
+
+        self.breaker.success()
+        if return_values and return_values[0] == 'true':
+            return RecaptchaResponse(is_valid=True)
+        return RecaptchaResponse(is_valid=False,
+            error_code=return_values[1] if len(return_values) > 1 else None)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = VerifyClient()
+        return _client
+
+
+def use_verifier(verify_url):
+    """
+    Send later submit() calls to verify_url, e.g. the stub verifier of a
+    load run.
+    """
+    global _client
+    with _client_lock:
+        _client = VerifyClient(verify_url)
+        return _client
+
+
+def submit(recaptcha_challenge_field, recaptcha_response_field, private_key, remoteip):
+    return get_client().submit(recaptcha_challenge_field, recaptcha_response_field,
+        private_key, remoteip)
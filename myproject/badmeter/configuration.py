@@ -0,0 +1,93 @@
+from django.db import connection
+from myproject import settings
+from . import db
+import threading
+import time
+
+# Process-local cache of get_configuration().
+#
+# The configuration is the body of the get_configuration() stored function
+# so it only changes when sql/get_configuration.sql (or all.sql) is
+# reloaded. That file ends with NOTIFY badmeter_configuration. Each process
+# keeps a dedicated psycopg2 connection listening on the channel. Checking
+# it is a non-blocking poll() of data the server already pushed, so a
+# cached read costs no database round trip. Should the notification be
+# missed (listener down, or not PostgreSQL) the cache still reloads after
+# CONFIGURATION_CACHE_SECONDS.
+
+CHANNEL = 'badmeter_configuration'
+
+
+class ConfigurationCache(object):
+    """
+    Cached (interval_days, vote_quota) of get_configuration().
+    """
+    def __init__(self, ttl_seconds=None, listen=None):
+        self.ttl_seconds = (settings.CONFIGURATION_CACHE_SECONDS
+            if ttl_seconds is None else ttl_seconds)
+        self.listen = settings.CONFIGURATION_LISTEN if listen is None else listen
+        self._lock = threading.Lock()
+        self._listener = None
+        self._values = None
+        self._loaded_at = 0
+
+    @property
+    def interval_days(self):
+        return self.get()[0]
+
+    @property
+    def vote_quota(self):
+        return self.get()[1]
+
+    def invalidate(self):
+        self._values = None
+
+    def get(self):
+        """
+        Return (interval_days as text, vote_quota).
+        """
+        with self._lock:
+            if self._notified() or self._values is None \
+                    or time.time() - self._loaded_at >= self.ttl_seconds:
+                self._load()
+            return self._values
+
+    def _load(self):
+        # Listen before reading so a reload in between is not missed.
+        self._connect()
+        self._values = db.fetchone('get_configuration')
+        self._loaded_at = time.time()
+
+    def _connect(self):
+        if self._listener is not None or not self.listen or connection.vendor != 'postgresql':
+            return
+        import psycopg2
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+        database = settings.DATABASES['default']
+        try:
+            listener = psycopg2.connect(
+                database=database['NAME'], user=database['USER'],
+                password=database['PASSWORD'], host=database['HOST'] or None,
+                port=database['PORT'] or None)
+            listener.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            listener.cursor().execute('LISTEN %s' % CHANNEL)
+        except psycopg2.Error:
+            # Fall back to the TTL until the next load retries.
+            return
+        self._listener = listener
+
+    def _notified(self):
+        if self._listener is None:
+            return False
+        import psycopg2
+        try:
+            self._listener.poll()
+        except psycopg2.Error:
+            self._listener = None
+            return True
+        notified = bool(self._listener.notifies)
+        del self._listener.notifies[:]
+        return notified
+
+
+configuration = ConfigurationCache()
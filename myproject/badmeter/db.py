@@ -0,0 +1,220 @@
+from django.db import connection
+from django.db.backends.signals import connection_created
+from myproject import settings
+from . import metrics
+import re
+import threading
+import time
+
+try:
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+# Stored function calls, declared once and run as prepared statements.
+#
+# Each call site used to send its own "SELECT ... FROM add_vote(%s, ...)"
+# text, parsed and planned again by PostgreSQL on every request. Here
+# each call is declared once with its parameter types. On first use on a
+# database connection it is sent as PREPARE and EXECUTE in the same round
+# trip, then only EXECUTE by name for the life of the connection. Keep
+# connections open across requests (CONN_MAX_AGE in settings.DATABASES)
+# for this to pay off. DB_PREPARED_STATEMENTS = False, or a database other
+# than PostgreSQL, runs the same calls as plain SELECTs.
+#
+#     rows = db.fetchall('list_topics', [search_str])
+#
+# Each call is timed in the badmeter_db_function_seconds histogram. All
+# queries of a thread, ORM ones included, are counted and timed in tally
+# by the cursors of PostgreSQL connections, for badmeter.middleware.
+
+
+class Statement(object):
+    """
+    A stored function call with $1..$n parameters of the given types.
+    """
+    def __init__(self, name, sql, types):
+        self.name = 'badmeter_%s' % name
+        self.sql = sql
+        self.types = types
+        # Same call with psycopg2 placeholders for unprepared use.
+        self.plain_sql = re.sub(r'\$\d+', '%s', sql)
+        self.placeholders = ', '.join(['%s'] * len(types))
+        self.seconds = metrics.histogram('badmeter_db_function_seconds',
+            'Seconds of the stored function calls of badmeter.db, at the call site.',
+            labels={'function' : name})
+
+    @property
+    def prepare_sql(self):
+        if not self.types:
+            return 'PREPARE %s AS %s' % (self.name, self.sql)
+        return 'PREPARE %s(%s) AS %s' % (self.name, ', '.join(self.types), self.sql)
+
+    @property
+    def execute_sql(self):
+        return 'EXECUTE %s(%s)' % (self.name, self.placeholders) if self.types \
+            else 'EXECUTE %s' % self.name
+
+
+statements = {}
+
+
+def register(name, sql, types=()):
+    statements[name] = Statement(name, sql, types)
+
+
+register('add_topic',
+    'SELECT return_id, status_message FROM add_topic($1, $2, $3)',
+    ('text', 'text', 'text'))
+register('add_vote',
+    'SELECT return_id, status_message FROM add_vote($1, $2, $3, $4)',
+    ('text', 'text', 'text', 'text'))
+register('add_votes',
+    '''SELECT return_id, status_message FROM add_votes($1, $2, $3, $4, $5)
+        ORDER BY vote_order''',
+    ('text[]', 'text[]', 'text[]', 'text[]', 'text[]'))
+register('list_topics',
+    'SELECT id, topic_slug, topic_title FROM list_topics($1)',
+    ('text',))
+register('list_votes',
+    '''SELECT id, counted, cookie_string, comment, vote,
+        date_created, votes_negative, votes_positive FROM list_votes($1, $2, $3, $4)''',
+    ('text', 'timestamptz', 'int', 'int'))
+register('get_configuration',
+    'SELECT interval_days::text, vote_quota FROM get_configuration()')
+register('get_visitor_state',
+    '''SELECT topic_id, cookie_id, topic_date_updated, cookie_votes_positive,
+        cookie_votes_negative, cookie_date_created, status_message
+        FROM get_visitor_state($1, $2)''',
+    ('text', 'text'))
+register('get_topic_page',
+    '''SELECT topic_title, topic_slug, topic_badmeter,
+        topic_votes_positive, topic_votes_negative, topic_date_created,
+        topic_date_updated, purge_date, vote_needed,
+        vote_id, vote_counted, vote_cookie_string, vote_comment, vote_vote,
+        vote_date_created, vote_votes_negative, vote_votes_positive
+        FROM get_topic_page($1, $2)''',
+    ('text', 'int'))
+register('get_topic_page_by_id',
+    '''SELECT topic_title, topic_slug, topic_badmeter,
+        topic_votes_positive, topic_votes_negative, topic_date_created,
+        topic_date_updated, purge_date, vote_needed,
+        vote_id, vote_counted, vote_cookie_string, vote_comment, vote_vote,
+        vote_date_created, vote_votes_negative, vote_votes_positive
+        FROM get_topic_page($1, $2)''',
+    ('int', 'int'))
+register('get_vote_page',
+    '''SELECT topic_title, topic_slug, topic_badmeter,
+        topic_votes_positive, topic_votes_negative, topic_date_created,
+        topic_date_updated, purge_date, vote_needed,
+        vote_id, vote_counted, vote_cookie_string, vote_comment, vote_vote,
+        vote_date_created, vote_votes_negative, vote_votes_positive,
+        topic_id, cookie_id, cookie_votes_positive, cookie_votes_negative,
+        cookie_date_created, status_message
+        FROM get_vote_page($1, $2, $3)''',
+    ('text', 'text', 'int'))
+register('list_stale_topics',
+    'SELECT id FROM list_stale_topics($1, $2)',
+    ('text', 'int[]'))
+register('purge_many',
+    '''SELECT topic_id, topic_slug, topic_title, vote_count, cookie_count
+        FROM purge_many(ARRAY(SELECT id FROM list_stale_topics($1, $2)))''',
+    ('text', 'int[]'))
+
+
+class QueryTally(threading.local):
+    """
+    Queries run and their seconds, per thread.
+    """
+    queries = 0
+    seconds = 0.0
+
+tally = QueryTally()
+
+
+if psycopg2 is not None:
+    class TallyCursor(psycopg2.extensions.cursor):
+        """
+        psycopg2 cursor adding each query to tally.
+        """
+        def execute(self, sql, args=None):
+            started = time.time()
+            try:
+                return super(TallyCursor, self).execute(sql, args)
+            finally:
+                tally.queries += 1
+                tally.seconds += time.time() - started
+
+        def executemany(self, sql, args_list):
+            started = time.time()
+            try:
+                return super(TallyCursor, self).executemany(sql, args_list)
+            finally:
+                tally.queries += 1
+                tally.seconds += time.time() - started
+
+
+def _reset_prepared(sender, connection, **kwargs):
+    # A new database session starts without prepared statements.
+    connection.badmeter_prepared = set()
+    connection.badmeter_unsure = set()
+    if connection.vendor == 'postgresql' and psycopg2 is not None:
+        connection.connection.cursor_factory = TallyCursor
+
+connection_created.connect(_reset_prepared)
+
+
+def execute(name, params=()):
+    """
+    Run the declared call name with params. Returns the cursor.
+    """
+    statement = statements[name]
+    started = time.time()
+    try:
+        return _execute(statement, params)
+    finally:
+        statement.seconds.observe(time.time() - started)
+
+
+def _execute(statement, params):
+    cursor = connection.cursor()
+    if not settings.DB_PREPARED_STATEMENTS or connection.vendor != 'postgresql':
+        cursor.execute(statement.plain_sql, params)
+        return cursor
+
+    prepared = getattr(connection, 'badmeter_prepared', None)
+    if prepared is None:
+        prepared = connection.badmeter_prepared = set()
+    if statement.name not in prepared and statement.name in _unsure(connection):
+        # A failed first call may or may not have left it prepared.
+        cursor.execute('SELECT 1 FROM pg_prepared_statements WHERE name = %s',
+            [statement.name])
+        if cursor.fetchone():
+            prepared.add(statement.name)
+        connection.badmeter_unsure.discard(statement.name)
+
+    if statement.name in prepared:
+        cursor.execute(statement.execute_sql, params)
+        return cursor
+
+    try:
+        cursor.execute('%s; %s' % (statement.prepare_sql, statement.execute_sql), params)
+    except Exception:
+        _unsure(connection).add(statement.name)
+        raise
+    prepared.add(statement.name)
+    return cursor
+
+
+def _unsure(connection):
+    if not hasattr(connection, 'badmeter_unsure'):
+        connection.badmeter_unsure = set()
+    return connection.badmeter_unsure
+
+
+def fetchall(name, params=()):
+    return execute(name, params).fetchall()
+
+
+def fetchone(name, params=()):
+    return execute(name, params).fetchone()
@@ -3,9 +3,10 @@ from django import forms
 from django.utils.text import slugify
 from django.utils.safestring import mark_safe
 from django.contrib import messages
-from recaptcha.client import captcha
+from . import captcha
 from .models import Topic, Vote
-from .misc import print_info, strip_extra_spaces, hash_md5_random_hexdigest
+from .misc import (print_info, strip_extra_spaces, hash_md5_random_hexdigest,
+    get_cookie_string)
 from myproject import settings
 import os
 import hashlib
@@ -64,7 +65,7 @@ class TopicModelForm(forms.ModelForm):
         if settings.TESTING:
             cookie_string = hash_md5_random_hexdigest()
         else:
-            cookie_string = self.request.session.session_key
+            cookie_string = get_cookie_string(self.request, create=True)
 
         if not self._errors:
             topic = self.Meta.model()
@@ -134,7 +135,7 @@ class VoteModelForm(forms.ModelForm):
         if settings.TESTING:
             cookie_string = hash_md5_random_hexdigest()
         else:
-            cookie_string = self.request.session.session_key
+            cookie_string = get_cookie_string(self.request, create=True)
 
         if not self._errors:
             vote = self.Meta.model()
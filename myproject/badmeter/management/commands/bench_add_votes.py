@@ -0,0 +1,75 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection
+from badmeter.models import Topic, Vote
+from badmeter.misc import hash_md5_random_hexdigest
+from myproject import settings
+import time
+
+
+class Command(BaseCommand):
+    help = ('Benchmark vote ingestion: one add_vote() call per vote versus '
+        'Vote.save_many() batches through add_votes(). Each path votes on '
+        'its own synthetic topic, which is purged when done.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--votes', type='int', default=10000,
+            help='Number of votes per path.'),
+        make_option('--batch-size', type='int', default=settings.VOTES_BATCH_SIZE,
+            help='Votes per Vote.save_many() call, VOTES_BATCH_SIZE by default.'),
+    )
+
+    def handle(self, *args, **options):
+        votes = options['votes']
+        batch_size = options['batch_size']
+        loop_slug = self.add_topic('Bench add_vote loop')
+        batch_slug = self.add_topic('Bench add_votes batch')
+
+        try:
+            # Each cookie votes on 3 consecutive days so the 3rd-vote
+            # activation and badmeter recompute are exercised.
+            loop_args = self.vote_args(loop_slug, votes)
+            cursor = connection.cursor()
+            started = time.time()
+            for arg in loop_args:
+                cursor.execute('SELECT return_id, status_message FROM add_vote(%s, %s, %s, %s, %s)', [
+                    arg['topic_slug'], arg['cookie_string'], arg['comment'], arg['vote'], arg['now']])
+                cursor.fetchall()
+            loop_seconds = time.time() - started
+
+            batch_args = self.vote_args(batch_slug, votes)
+            started = time.time()
+            results = Vote.save_many(batch_args, batch_size)
+            errors = len([result for result in results if result.if_error])
+            batch_seconds = time.time() - started
+
+            self.stdout.write('votes=%d loop=%.0f votes/s batch(%d)=%.0f votes/s speedup=%.1fx errors=%d' % (
+                votes, votes / loop_seconds, batch_size, votes / batch_seconds,
+                loop_seconds / batch_seconds, errors))
+        finally:
+            cursor = connection.cursor()
+            for topic_slug in (loop_slug, batch_slug):
+                cursor.execute('SELECT purge_one(%s::text)', [topic_slug])
+
+    def add_topic(self, topic_title):
+        topic_slug = 'bench-%s' % hash_md5_random_hexdigest()
+        topic = Topic()
+        topic.save(topic, {
+            'topic_title' : topic_title,
+            'topic_slug' : topic_slug,
+            'cookie_string' : hash_md5_random_hexdigest()})
+        return topic_slug
+
+    def vote_args(self, topic_slug, votes):
+        args = []
+        cookie_string = None
+        for i in range(votes):
+            if i % 3 == 0:
+                cookie_string = hash_md5_random_hexdigest()
+            args.append({
+                'topic_slug' : topic_slug,
+                'cookie_string' : cookie_string,
+                'comment' : 'bench %d' % i,
+                'vote' : 'true' if i % 4 else 'false',
+                'now' : '2014-01-%02d 12:00' % (i % 3 + 1)})
+        return args
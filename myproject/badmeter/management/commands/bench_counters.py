@@ -0,0 +1,94 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from badmeter.misc import hash_md5_random_hexdigest
+import threading
+import time
+
+# Parallel voters on one topic, each thread on its own database
+# connection with every add_vote() in its own transaction, as votes
+# arrive on a viral topic. Each voter casts the 3 votes, a day apart,
+# that make its votes count. The run is repeated with the topic counters
+# unsharded and sharded. The topic is committed so the voters see it,
+# and purged at the end.
+
+
+class Command(BaseCommand):
+    help = ('Benchmark add_vote() throughput of many parallel voters on one '
+        'topic with and without sharded topic vote counters.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=32,
+            help='Parallel voting connections.'),
+        make_option('--voters', type='int', default=100,
+            help='Voters per thread and run, 3 votes each.'),
+        make_option('--shards', type='int', default=16,
+            help='Counter shards of the sharded run.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['voters'] < 1:
+            raise CommandError('--threads and --voters must be at least 1.')
+        if options['shards'] < 2:
+            raise CommandError('--shards must be at least 2.')
+
+        topic_slug = 'bench-counters-%s' % hash_md5_random_hexdigest()
+        cursor = connection.cursor()
+        cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s)',
+            ['Bench counters', topic_slug, hash_md5_random_hexdigest()])
+        if cursor.fetchone()[0] < 0:
+            raise CommandError('Could not add topic %s.' % topic_slug)
+
+        try:
+            self.stdout.write('threads=%d votes/run=%d' % (
+                options['threads'], options['threads'] * options['voters'] * 3))
+            for shards in (0, options['shards']):
+                cursor.execute('SELECT set_counter_shards(%s, %s)', [topic_slug, shards])
+                votes, errors, seconds = self.run(topic_slug, options['threads'],
+                    options['voters'])
+                self.stdout.write('shards=%-3d %.0f votes/s errors=%d %.3fs' % (
+                    shards, votes / seconds, errors, seconds))
+
+            # Both runs must add up once folded.
+            cursor.execute('SELECT fold_topic_counters(id) FROM badmeter_topic WHERE topic_slug = %s',
+                [topic_slug])
+            cursor.execute('''SELECT T.votes_positive + T.votes_negative, count(V.id)
+                FROM badmeter_topic T, badmeter_vote V
+                WHERE T.topic_slug = %s AND V.topic_id = T.id AND V.counted IS TRUE
+                GROUP BY T.id''', [topic_slug])
+            topic_votes, counted_votes = cursor.fetchone()
+            if topic_votes != counted_votes:
+                raise CommandError('Topic counters %d disagree with %d counted votes.' % (
+                    topic_votes, counted_votes))
+        finally:
+            cursor.execute('SELECT purge_one(%s::text)', [topic_slug])
+
+    def run(self, topic_slug, threads, voters):
+        start = threading.Event()
+        results = []
+
+        def vote():
+            cursor = connection.cursor()
+            errors = 0
+            start.wait()
+            for i in range(voters):
+                cookie_string = hash_md5_random_hexdigest()
+                for day in (2, 1, 0):
+                    cursor.execute('''SELECT return_id FROM add_vote(%s, %s, %s, %s,
+                        (now() - %s * interval '1 day')::text)''',
+                        [topic_slug, cookie_string, '', str(i % 3 > 0), day])
+                    if cursor.fetchone()[0] < 0:
+                        errors += 1
+            connection.close()
+            results.append(errors)
+
+        workers = [threading.Thread(target=vote) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        # Let the threads connect before the clock starts.
+        time.sleep(1)
+        started = time.time()
+        start.set()
+        for worker in workers:
+            worker.join()
+        return threads * voters * 3, sum(results), time.time() - started
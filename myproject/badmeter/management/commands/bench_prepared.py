@@ -0,0 +1,73 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from badmeter import db
+from badmeter.models import Topic
+from badmeter.misc import hash_md5_random_hexdigest
+import time
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the stored function calls of badmeter/db.py as plain '
+        'SELECTs versus prepared statements. A synthetic topic is voted on '
+        'in a transaction that is rolled back.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--calls', type='int', default=2000,
+            help='Number of calls timed per statement and mode.'),
+        make_option('--votes', type='int', default=100,
+            help='Number of votes on the synthetic topic.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.bench(options['calls'], options['votes'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def bench(self, calls, votes):
+        topic_slug = 'bench-%s' % hash_md5_random_hexdigest()
+        cookie_string = hash_md5_random_hexdigest()
+        topic = Topic()
+        topic.save(topic, {
+            'topic_title' : 'Bench prepared %s' % topic_slug,
+            'topic_slug' : topic_slug,
+            'cookie_string' : cookie_string})
+        cursor = connection.cursor()
+        cursor.execute('''SELECT count(*) FROM generate_series(1, %s) g,
+            LATERAL add_vote(%s, md5(g::text), 'bench', 'true')''', [votes, topic_slug])
+
+        # Start from no prepared statements whatever DB_PREPARED_STATEMENTS says.
+        cursor.execute('DEALLOCATE ALL')
+        connection.badmeter_prepared = set()
+
+        for name, params in (
+                ('get_configuration', []),
+                ('list_topics', ['Bench prepared']),
+                ('get_visitor_state', [topic_slug, cookie_string]),
+                ('get_vote_page', [topic_slug, cookie_string, 21]),
+                ('list_votes', [topic_slug, None, None, 21])):
+            statement = db.statements[name]
+            started = time.time()
+            for i in range(calls):
+                cursor.execute(statement.plain_sql, params)
+                cursor.fetchall()
+            plain_seconds = time.time() - started
+
+            cursor.execute(statement.prepare_sql)
+            connection.badmeter_prepared.add(statement.name)
+            started = time.time()
+            for i in range(calls):
+                cursor.execute(statement.execute_sql, params)
+                cursor.fetchall()
+            prepared_seconds = time.time() - started
+
+            self.stdout.write('%s plain=%.3fms/call prepared=%.3fms/call saved=%.3fms/call' % (
+                name, plain_seconds / calls * 1000, prepared_seconds / calls * 1000,
+                (plain_seconds - prepared_seconds) / calls * 1000))
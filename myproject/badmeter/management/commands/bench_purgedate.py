@@ -0,0 +1,147 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+import time
+
+# Day-by-day get_purgedate() as it was before the sliding-window rewrite,
+# kept as a session-local function for comparison.
+LEGACY_GET_PURGEDATE = '''
+CREATE OR REPLACE FUNCTION pg_temp.get_purgedate_loop(
+    p_topic_slug text,
+    p_now text,
+    OUT purge_date text,
+    OUT vote_needed text)
+AS $$
+DECLARE
+    t_now timestamp;
+    t_badmeter_topic_id integer;
+    t_start timestamp;
+    t_end timestamp;
+    t_count int;
+    t_oneday interval := interval '1 day';
+    t_interval interval;
+    t_quota int;
+BEGIN
+    -- Get application configuration from central location
+    -- in get_configuration().
+    SELECT interval_days, vote_quota
+        INTO t_interval, t_quota
+        FROM get_configuration();
+
+    SELECT COALESCE(get_timestamp(p_now), now())
+        INTO t_now;
+
+    -- First get the date the topic was created.
+    SELECT id, date_created
+        INTO t_badmeter_topic_id, t_start
+        FROM badmeter_topic
+        WHERE topic_slug = p_topic_slug;
+
+    t_start := date_trunc('day', t_start);
+
+    -- End date is interval_days from start date;
+    t_end := t_start + t_interval;
+
+    -- If topic made it beyond first interval_days period tweak start & end dates.
+    IF t_end < t_now THEN
+        t_end := date_trunc('day', t_now);
+        t_start := t_end - t_interval;
+    END IF;
+
+    LOOP
+
+        -- Count the number of votes during the interval_days period.
+        SELECT count(*)
+            INTO t_count
+            FROM badmeter_vote
+            WHERE date_created >= t_start
+                AND date_created <= t_end
+                AND counted IS TRUE
+                AND topic_id = t_badmeter_topic_id;
+
+
+        -- If there are not enough votes exit & return the end date.
+        EXIT WHEN (t_count < t_quota);
+
+        -- Try again on the next interval_days period.
+        t_end := t_end + t_oneday;
+        t_start := t_end - t_interval;
+    END LOOP;
+
+    purge_date := to_char(t_end, 'FMMon. DD, YYYY');
+    vote_needed := (t_quota - t_count)::text;
+END;
+$$ LANGUAGE plpgsql;
+'''
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Benchmark get_purgedate() against the legacy day-by-day loop '
+        'on one synthetic topic. Rows are inserted in a transaction that '
+        'is rolled back.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--votes', type='int', default=1000000,
+            help='Number of counted votes on the topic.'),
+        make_option('--days', type='int', default=365,
+            help='Number of days the votes are spread over.'),
+        make_option('--repeat', type='int', default=5,
+            help='Calls timed per function and date.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.bench(options['votes'], options['days'], options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def bench(self, votes, days, repeat):
+        topic_slug = 'bench-purgedate'
+        cursor = connection.cursor()
+        cursor.execute(LEGACY_GET_PURGEDATE)
+        cursor.execute('''SELECT return_id FROM add_topic(%s, %s, %s, %s)''',
+            ['Bench purgedate', topic_slug, 'bench-purgedate-cookie', '2014-01-01'])
+        topic_id = cursor.fetchone()[0]
+        cursor.execute('''
+            INSERT INTO badmeter_cookie (voter_id, topic_id, votes_positive, votes_negative,
+                    votes_total, counted, date_voted, date_created, date_updated)
+                SELECT voter_id, id, 0, 0, 0, TRUE, NULL, date_created, date_created
+                    FROM badmeter_topic
+                    WHERE id = %s
+                RETURNING id''', [topic_id])
+        cookie_id = cursor.fetchone()[0]
+
+        # Every 50th vote lands exactly on midnight, the window edge case.
+        cursor.execute('''
+            INSERT INTO badmeter_vote (topic_id, cookie_id, comment, vote, counted, date_created)
+                SELECT T.id, %s, '', (V.g %% 3 > 0), TRUE,
+                        CASE WHEN V.g %% 50 = 0 THEN date_trunc('day', V.d) ELSE V.d END
+                    FROM badmeter_topic T,
+                        (SELECT g, timestamp '2014-01-01' + random() * %s * interval '1 day' AS d
+                            FROM generate_series(1, %s) g) V
+                    WHERE T.id = %s''', [cookie_id, days, votes, topic_id])
+        cursor.execute('SELECT rebuild_topic_daily(%s)', [topic_id])
+        cursor.execute('ANALYZE badmeter_vote')
+
+        for day in (30, days // 2, days):
+            cursor.execute("SELECT (timestamp '2014-01-01' + %s * interval '1 day')::text", [day])
+            now = cursor.fetchone()[0]
+            results = []
+            for function in ('pg_temp.get_purgedate_loop', 'get_purgedate'):
+                started = time.time()
+                for i in range(repeat):
+                    cursor.execute('SELECT purge_date, vote_needed FROM %s(%%s, %%s)' % function,
+                        [topic_slug, now])
+                    result = cursor.fetchone()
+                results.append((result, (time.time() - started) / repeat))
+
+            self.stdout.write('now=%s loop=%.1fms window=%.1fms speedup=%.0fx result=%s %s' % (
+                now, results[0][1] * 1000, results[1][1] * 1000,
+                results[0][1] / max(results[1][1], 1e-9), results[1][0],
+                'MATCH' if results[0][0] == results[1][0] else 'MISMATCH loop=%s' % (results[0][0],)))
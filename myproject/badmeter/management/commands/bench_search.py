@@ -0,0 +1,75 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from badmeter.topic_index import TopicPrefixIndex
+import random
+import time
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Benchmark /search/ autocomplete: list_topics() stored function '
+        'versus the in-process topic prefix index. Synthetic topics are '
+        'inserted in a transaction that is rolled back.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='10000,100000,1000000',
+            help='Comma separated topic table sizes.'),
+        make_option('--queries', type='int', default=500,
+            help='Number of autocomplete prefixes timed per size.'),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        for size in sizes:
+            try:
+                with transaction.atomic():
+                    self.bench(size, options['queries'])
+                    raise Rollback()
+            except Rollback:
+                pass
+
+    def bench(self, size, queries):
+        cursor = connection.cursor()
+        cursor.execute('''
+            INSERT INTO badmeter_topic (
+                    topic_title, topic_slug, badmeter, votes_positive,
+                    votes_negative, voter_id, date_created, date_updated)
+                SELECT t.title, slugify(t.title) || '-' || g, 50, 0, 0, NULL, now(), now()
+                    FROM generate_series(1, %s) g,
+                        LATERAL (SELECT initcap(substr(md5(g::text), 1, 6)) || ' '
+                            || substr(md5((g * 7)::text), 1, 10) || ' ' || g AS title) t''',
+            [size])
+        cursor.execute('ANALYZE badmeter_topic')
+
+        cursor.execute('SELECT id, topic_title, topic_slug FROM badmeter_topic')
+        rows = cursor.fetchall()
+
+        started = time.time()
+        index = TopicPrefixIndex()
+        index.load(rows)
+        load_seconds = time.time() - started
+
+        # Autocomplete fires from the 3rd keystroke on.
+        prefixes = []
+        for topic_id, title, slug in random.sample(rows, min(queries, len(rows))):
+            prefixes.append(title[:random.randint(3, 8)])
+
+        started = time.time()
+        for prefix in prefixes:
+            cursor.execute('SELECT id, topic_slug, topic_title FROM list_topics(%s)', [prefix])
+            cursor.fetchall()
+        db_seconds = time.time() - started
+
+        started = time.time()
+        for prefix in prefixes:
+            index.search(prefix, 25)
+        index_seconds = time.time() - started
+
+        n = float(len(prefixes))
+        self.stdout.write('topics=%d load=%.2fs list_topics=%.3fms/query index=%.4fms/query speedup=%.0fx' % (
+            size, load_seconds, db_seconds / n * 1000, index_seconds / n * 1000,
+            db_seconds / max(index_seconds, 1e-9)))
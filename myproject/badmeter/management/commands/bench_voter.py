@@ -0,0 +1,131 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+import hashlib
+import random
+import time
+
+
+class Rollback(Exception):
+    pass
+
+
+# The layout before badmeter_voter: a varchar(100) cookie_string on every
+# badmeter_cookie row. Both layouts get the unique key their lookup and the
+# ON CONFLICT of add_vote() need, here (cookie_string, topic_id), and the
+# topic_id index of the badmeter_cookie.topic foreign key, which the purge
+# deletes the cookies of a topic by. Neither has any other index.
+OLD_LAYOUT = '''
+    CREATE TEMPORARY TABLE bench_cookie_old (
+        id serial PRIMARY KEY,
+        cookie_string varchar(100) NOT NULL,
+        topic_id integer NOT NULL,
+        votes_total integer NOT NULL,
+        UNIQUE (cookie_string, topic_id));
+    INSERT INTO bench_cookie_old (cookie_string, topic_id, votes_total)
+        SELECT md5((g %% %(voters)s)::text), g / %(voters)s, 1
+            FROM generate_series(0, %(cookies)s - 1) g;
+    CREATE INDEX bench_cookie_old_topic_id ON bench_cookie_old (topic_id);
+    ANALYZE bench_cookie_old;
+'''
+
+# The badmeter_voter layout: a 16-byte digest once per visitor and a
+# (voter_id, topic_id) key on the counters. The digest lookup is the one
+# extra index probe per vote, against an index of one entry per visitor
+# instead of one per visitor and topic.
+NEW_LAYOUT = '''
+    CREATE TEMPORARY TABLE bench_voter (
+        id serial PRIMARY KEY,
+        digest bytea NOT NULL UNIQUE);
+    INSERT INTO bench_voter (digest)
+        SELECT voter_digest(md5(g::text))
+            FROM generate_series(0, %(voters)s - 1) g;
+    CREATE TEMPORARY TABLE bench_cookie_new (
+        id serial PRIMARY KEY,
+        voter_id integer NOT NULL,
+        topic_id integer NOT NULL,
+        votes_total integer NOT NULL,
+        UNIQUE (voter_id, topic_id));
+    INSERT INTO bench_cookie_new (voter_id, topic_id, votes_total)
+        SELECT 1 + g %% %(voters)s, g / %(voters)s, 1
+            FROM generate_series(0, %(cookies)s - 1) g;
+    CREATE INDEX bench_cookie_new_topic_id ON bench_cookie_new (topic_id);
+    ANALYZE bench_voter;
+    ANALYZE bench_cookie_new;
+'''
+
+OLD_LOOKUP = '''SELECT id FROM bench_cookie_old
+    WHERE cookie_string = %s AND topic_id = %s'''
+
+NEW_LOOKUP = '''SELECT C.id FROM bench_cookie_new C, bench_voter W
+    WHERE W.digest = voter_digest(%s) AND C.voter_id = W.id AND C.topic_id = %s'''
+
+
+class Command(BaseCommand):
+    help = ('Compare the table and index sizes and the cookie lookup time of '
+        'a cookie_string per badmeter_cookie row against badmeter_voter '
+        'digests, on synthetic temporary tables in a transaction that is '
+        'rolled back.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--voters', type='int', default=100000,
+            help='Number of visitor ids.'),
+        make_option('--topics', type='int', default=10,
+            help='Topics each visitor has counters on.'),
+        make_option('--lookups', type='int', default=5000,
+            help='Number of random cookie lookups timed per layout.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.bench(options['voters'], options['topics'], options['lookups'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def size(self, *tables):
+        cursor = connection.cursor()
+        table_bytes = index_bytes = 0
+        for table in tables:
+            cursor.execute('SELECT pg_relation_size(%s), pg_indexes_size(%s)', [table, table])
+            row = cursor.fetchone()
+            table_bytes += row[0]
+            index_bytes += row[1]
+        return table_bytes, index_bytes
+
+    def index_sizes(self, *tables):
+        """
+        List of (index name, bytes) of the indexes of tables.
+        """
+        cursor = connection.cursor()
+        cursor.execute('''SELECT indexrelid::regclass::text, pg_relation_size(indexrelid)
+            FROM pg_index
+            WHERE indrelid = ANY(%s::regclass[])
+            ORDER BY 1''', [list(tables)])
+        return cursor.fetchall()
+
+    def bench(self, voters, topics, lookups):
+        cursor = connection.cursor()
+        # Visitor ids are md5 hexdigests, as on the site.
+        sizes = {'voters' : voters, 'cookies' : voters * topics}
+        cursor.execute(OLD_LAYOUT % sizes)
+        cursor.execute(NEW_LAYOUT % sizes)
+
+        keys = [(hashlib.md5(str(random.randrange(voters))).hexdigest(),
+            random.randrange(topics)) for i in range(lookups)]
+        for name, tables, sql in (
+                ('cookie_string', ('bench_cookie_old',), OLD_LOOKUP),
+                ('voter', ('bench_voter', 'bench_cookie_new'), NEW_LOOKUP)):
+            started = time.time()
+            for voter, topic in keys:
+                cursor.execute(sql, [voter, topic])
+                cursor.fetchall()
+            seconds = time.time() - started
+
+            table_bytes, index_bytes = self.size(*tables)
+            self.stdout.write('%s table=%.1fMB indexes=%.1fMB lookup=%.3fms' % (
+                name, table_bytes / 1048576.0, index_bytes / 1048576.0,
+                seconds / lookups * 1000))
+            for index, size in self.index_sizes(*tables):
+                self.stdout.write('    %s=%.1fMB' % (index, size / 1048576.0))
@@ -0,0 +1,367 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sessions.models import Session
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.text import slugify
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from myproject import settings
+from badmeter import captcha
+from badmeter.misc import hash_md5_random_hexdigest
+from .recaptcha_stub import StubVerifier
+import Cookie
+import Queue
+import httplib
+import json
+import math
+import random
+import threading
+import time
+import urllib
+
+# Load run of the WSGI app of myproject/wsgi.py against the configured
+# PostgreSQL database, with reCAPTCHA answered by the stub verifier.
+#
+# The app is served in this process by a WSGI server with a fixed pool
+# of threads, like a threaded app server worker, so the in-process caches
+# behave as in production. Client threads then drive a mix of:
+#   search     autocomplete bursts on /search/, one request per keystroke
+#   vote_page  vote page reads, skewed to a few popular topics
+#   vote       votes from --visitors distinct session cookies
+#   topic      new topics
+# Synthetic topics, their votes and the visitors' sessions are removed
+# at the end unless --keep.
+
+QUERIES_HEADER = 'X-Badmeter-Queries'
+
+# Synthetic topic titles are 3 of these words so autocomplete prefixes
+# match a few topics each, as on the site.
+WORDS = ('apple', 'bank', 'bridge', 'cable', 'camera', 'city', 'coffee',
+    'council', 'dentist', 'doctor', 'energy', 'festival', 'gym', 'hotel',
+    'internet', 'laptop', 'library', 'market', 'mayor', 'movie', 'museum',
+    'park', 'phone', 'pizza', 'police', 'post', 'railway', 'school',
+    'senator', 'shop', 'stadium', 'station', 'store', 'team', 'tower',
+    'traffic', 'train', 'water', 'weather', 'zoo')
+
+
+class CountQueries(object):
+    """
+    WSGI middleware returning the number of database queries of each
+    request in the X-Badmeter-Queries response header.
+    """
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        response_start = []
+
+        def deferred_start_response(status, headers, exc_info=None):
+            response_start[:] = [status, headers, exc_info]
+
+        with CaptureQueriesContext(connection) as context:
+            result = self.application(environ, deferred_start_response)
+        status, headers, exc_info = response_start
+        start_response(status, headers + [(QUERIES_HEADER, str(len(context.captured_queries)))],
+            exc_info)
+        return result
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    WSGI server answering requests on a fixed pool of threads.
+    """
+    def __init__(self, address, application, threads):
+        WSGIServer.__init__(self, address, QuietHandler)
+        self.set_app(application)
+        self.requests = Queue.Queue()
+        for i in range(threads):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def worker(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of values, e.g. fraction .95 for p95.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(max(int(math.ceil(fraction * len(values))), 1), len(values)) - 1]
+
+
+class Results(object):
+    """
+    Latency, status and query count of each request, per endpoint.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint, seconds, status, queries):
+        with self._lock:
+            result = self.endpoints.setdefault(endpoint,
+                {'seconds' : [], 'errors' : 0, 'queries' : 0})
+            result['seconds'].append(seconds)
+            result['queries'] += queries
+            if status is None or status >= 500:
+                result['errors'] += 1
+
+    def summary(self, elapsed):
+        summary = {}
+        for endpoint, result in sorted(self.endpoints.items()):
+            seconds = result['seconds']
+            summary[endpoint] = {
+                'requests' : len(seconds),
+                'errors' : result['errors'],
+                'requests_per_second' : len(seconds) / elapsed,
+                'p50_ms' : percentile(seconds, .50) * 1000,
+                'p95_ms' : percentile(seconds, .95) * 1000,
+                'p99_ms' : percentile(seconds, .99) * 1000,
+                'queries_per_request' : float(result['queries']) / len(seconds)}
+        return summary
+
+
+class Visitor(object):
+    """
+    A browser with its own cookies, hence its own session.
+    """
+    def __init__(self):
+        self.cookies = {}
+
+    def cookie_header(self):
+        return '; '.join('%s=%s' % item for item in self.cookies.items())
+
+    def keep_cookies(self, response):
+        for header in response.msg.getheaders('set-cookie'):
+            for name, morsel in Cookie.SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+
+class Command(BaseCommand):
+    help = ('Load run of the badmeter WSGI app against the configured '
+        'PostgreSQL database with reCAPTCHA stubbed. Reports throughput, '
+        'p50/p95/p99 latency and database queries per request of each '
+        'endpoint.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--seconds', type='float', default=60,
+            help='Length of the run.'),
+        make_option('--concurrency', type='int', default=16,
+            help='Number of client threads.'),
+        make_option('--server-threads', type='int', default=8,
+            help='Number of threads answering requests.'),
+        make_option('--topics', type='int', default=200,
+            help='Number of synthetic topics to start with.'),
+        make_option('--visitors', type='int', default=5000,
+            help='Number of distinct session cookies.'),
+        make_option('--mix', default='search=50,vote_page=35,vote=10,topic=5',
+            help='Comma separated endpoint=weight.'),
+        make_option('--host-header', default='www.badmeter.com',
+            help='Host header, one of ALLOWED_HOSTS.'),
+        make_option('--output',
+            help='Write the results as JSON to this file.'),
+        make_option('--keep', action='store_true', default=False,
+            help='Keep the synthetic topics, votes and sessions.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            self.mix = [(endpoint, float(weight)) for endpoint, weight in
+                (item.split('=') for item in options['mix'].split(','))]
+        except ValueError:
+            raise CommandError('--mix must look like search=50,vote_page=35,vote=10,topic=5')
+        unknown = set(endpoint for endpoint, weight in self.mix) - set(
+            ['search', 'vote_page', 'vote', 'topic'])
+        if unknown:
+            raise CommandError('Unknown --mix endpoints: %s' % ', '.join(sorted(unknown)))
+
+        from myproject.wsgi import application
+
+        verifier = StubVerifier(('127.0.0.1', 0))
+        self.start(verifier.serve_forever)
+        captcha.use_verifier('http://127.0.0.1:%d/recaptcha/api/verify' % verifier.server_port)
+
+        server = PooledWSGIServer(('127.0.0.1', 0), CountQueries(application),
+            options['server_threads'])
+        self.start(server.serve_forever)
+        self.port = server.server_port
+        self.host_header = options['host_header']
+
+        self.run_id = hash_md5_random_hexdigest()[:8]
+        self.lock = threading.Lock()
+        self.topic_count = 0
+        self.titles = []
+        self.slugs = []
+        self.visitors = [Visitor() for i in range(options['visitors'])]
+        self.results = Results()
+        try:
+            self.stdout.write('Creating %d topics...' % options['topics'])
+            for i in range(options['topics']):
+                self.new_topic(Results())
+            if not self.titles:
+                raise CommandError('No topic could be created. Is the database set up?')
+
+            self.stdout.write('Running for %ss with %d clients...' % (
+                options['seconds'], options['concurrency']))
+            stop_at = time.time() + options['seconds']
+            started = time.time()
+            clients = [self.start(self.client, stop_at) for i in range(options['concurrency'])]
+            for client in clients:
+                client.join()
+            elapsed = time.time() - started
+        finally:
+            server.shutdown()
+            verifier.shutdown()
+            if not options['keep']:
+                self.cleanup()
+
+        summary = self.results.summary(elapsed)
+        total = sum(result['requests'] for result in summary.values())
+        for endpoint, result in sorted(summary.items()):
+            self.stdout.write('%-9s requests=%d errors=%d rps=%.1f p50=%.1fms p95=%.1fms '
+                'p99=%.1fms queries/request=%.2f' % (endpoint, result['requests'],
+                result['errors'], result['requests_per_second'], result['p50_ms'],
+                result['p95_ms'], result['p99_ms'], result['queries_per_request']))
+        self.stdout.write('total     requests=%d rps=%.1f' % (total, total / elapsed))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({
+                    'started' : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+                    'seconds' : elapsed,
+                    'options' : dict((name, options[name]) for name in ('concurrency',
+                        'server_threads', 'topics', 'visitors', 'mix')),
+                    'requests' : total,
+                    'requests_per_second' : total / elapsed,
+                    'endpoints' : summary}, output, indent=2, sort_keys=True)
+            self.stdout.write('Results written to %s' % options['output'])
+
+    def start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def request(self, results, endpoint, visitor, method, path, params=None):
+        """
+        Send one request as visitor and record it under endpoint.
+        """
+        headers = {'Host' : self.host_header}
+        body = None
+        if method == 'POST':
+            params = dict(params, csrfmiddlewaretoken=visitor.cookies.get(
+                settings.CSRF_COOKIE_NAME, ''))
+            body = urllib.urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if visitor.cookies:
+            headers['Cookie'] = visitor.cookie_header()
+
+        http = httplib.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        started = time.time()
+        try:
+            http.request(method, path, body, headers)
+            response = http.getresponse()
+            response.read()
+        except (httplib.HTTPException, IOError):
+            results.add(endpoint, time.time() - started, None, 0)
+            return None
+        finally:
+            http.close()
+        results.add(endpoint, time.time() - started, response.status,
+            int(response.getheader(QUERIES_HEADER) or 0))
+        visitor.keep_cookies(response)
+        return response
+
+    def popular_title(self):
+        # Few topics get most of the traffic.
+        with self.lock:
+            titles = self.titles[:]
+        return titles[min(int(random.paretovariate(1.16)) - 1, len(titles) - 1)]
+
+    def new_topic(self, results):
+        with self.lock:
+            self.topic_count += 1
+            title = '%s %s%d' % (' '.join(random.sample(WORDS, 3)).capitalize(),
+                self.run_id, self.topic_count)
+            self.slugs.append(self.slug(title))
+        visitor = random.choice(self.visitors)
+        if settings.CSRF_COOKIE_NAME not in visitor.cookies:
+            self.request(results, 'home', visitor, 'GET', '/')
+        response = self.request(results, 'topic', visitor, 'POST', '/topic/', {
+            'topic_title' : title,
+            'recaptcha_challenge_field' : 'loadtest',
+            'recaptcha_response_field' : 'loadtest'})
+        if response is not None and response.status == 302:
+            with self.lock:
+                self.titles.append(title)
+
+    def client(self, stop_at):
+        endpoints = [endpoint for endpoint, weight in self.mix]
+        weights = [weight for endpoint, weight in self.mix]
+        while time.time() < stop_at:
+            endpoint = self.choose(endpoints, weights)
+            visitor = random.choice(self.visitors)
+            if endpoint == 'search':
+                # One request per keystroke from the 3rd one on.
+                title = self.popular_title()
+                for length in range(3, min(len(title), random.randint(4, 12)) + 1):
+                    self.request(self.results, endpoint, visitor, 'GET',
+                        '/search/?' + urllib.urlencode({'term' : title[:length]}))
+            elif endpoint == 'vote_page':
+                self.request(self.results, endpoint, visitor, 'GET',
+                    '/vote/%s/' % self.slug(self.popular_title()))
+            elif endpoint == 'vote':
+                slug = self.slug(self.popular_title())
+                if settings.CSRF_COOKIE_NAME not in visitor.cookies:
+                    self.request(self.results, 'vote_page', visitor, 'GET', '/vote/%s/' % slug)
+                self.request(self.results, endpoint, visitor, 'POST', '/vote/%s/' % slug, {
+                    'topic_slug' : slug,
+                    'comment' : 'Load run vote %s' % hash_md5_random_hexdigest()[:8],
+                    'vote' : random.choice(['true', 'false']),
+                    'recaptcha_challenge_field' : 'loadtest',
+                    'recaptcha_response_field' : 'loadtest'})
+            else:
+                self.new_topic(self.results)
+
+    def choose(self, endpoints, weights):
+        point = random.uniform(0, sum(weights))
+        for endpoint, weight in zip(endpoints, weights):
+            point -= weight
+            if point <= 0:
+                return endpoint
+        return endpoints[-1]
+
+    def slug(self, title):
+        return slugify(unicode(title))
+
+    def cleanup(self):
+        cursor = connection.cursor()
+        cursor.execute('''SELECT count(*) FROM purge_many(ARRAY(
+            SELECT id FROM badmeter_topic WHERE topic_slug = ANY(%s)))''',
+            [self.slugs])
+        topics = cursor.fetchone()[0]
+        session_keys = [visitor.cookies[settings.SESSION_COOKIE_NAME]
+            for visitor in self.visitors if settings.SESSION_COOKIE_NAME in visitor.cookies]
+        for i in range(0, len(session_keys), 1000):
+            Session.objects.filter(session_key__in=session_keys[i:i + 1000]).delete()
+        self.stdout.write('Removed %d synthetic topics and %d sessions.' % (
+            topics, len(session_keys)))
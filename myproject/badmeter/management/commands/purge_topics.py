@@ -0,0 +1,31 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from myproject import settings
+from badmeter.purge import purge_stale_topics
+
+
+class Command(BaseCommand):
+    help = ('Purge topics with less than vote_quota votes within the past '
+        'interval_days, in batches each in its own transaction.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=settings.PURGE_BATCH_SIZE,
+            help='Topics purged per transaction.'),
+        make_option('--now', default=None,
+            help='Purge as of this timestamp instead of now(), for testing.'),
+    )
+
+    def handle(self, *args, **options):
+        topics = votes = cookies = 0
+        seconds = 0.0
+        batches = purge_stale_topics(options['now'], options['batch_size'])
+        for number, batch in enumerate(batches, 1):
+            topics += batch.topics
+            votes += batch.votes
+            cookies += batch.cookies
+            seconds += batch.seconds
+            self.stdout.write('batch %d: topics=%d votes=%d cookies=%d %.3fs' % (
+                number, batch.topics, batch.votes, batch.cookies, batch.seconds))
+
+        self.stdout.write('purged topics=%d votes=%d cookies=%d in %.3fs' % (
+            topics, votes, cookies, seconds))
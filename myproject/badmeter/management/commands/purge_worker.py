@@ -0,0 +1,74 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from myproject import settings
+from badmeter import metrics
+from badmeter.purge import PurgeWorker
+import threading
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve badmeter.metrics of the worker process on any GET.
+    """
+    def do_GET(self):
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Purge stale topics continuously in small topic id ordered '
+        'slices, resuming from the saved cursor after a restart. Run one '
+        'worker per database instead of the midnight purge cron.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--slice-size', type='int', default=settings.PURGE_WORKER_SLICE_SIZE,
+            help='Most topics checked per slice.'),
+        make_option('--slice-seconds', type='float',
+            default=settings.PURGE_WORKER_SLICE_SECONDS,
+            help='Time budget of a slice. One slice runs per budget.'),
+        make_option('--idle-seconds', type='float',
+            default=settings.PURGE_WORKER_IDLE_SECONDS,
+            help='Rest after each full pass over the topics.'),
+        make_option('--slices', type='int', default=None,
+            help='Stop after this many slices instead of running forever.'),
+        make_option('--metrics-port', type='int', default=None,
+            help='Serve the worker metrics in the Prometheus text format '
+                'on this 127.0.0.1 port.'),
+        make_option('--now', default=None,
+            help='Purge as of this timestamp instead of now(), for testing.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['slice_size'] < 1:
+            raise CommandError('--slice-size must be at least 1.')
+        worker = PurgeWorker(slice_size=options['slice_size'],
+            slice_seconds=options['slice_seconds'], idle_seconds=options['idle_seconds'],
+            now=options['now'])
+        if not worker.lock():
+            raise CommandError('Another purge worker is running.')
+
+        if options['metrics_port'] is not None:
+            server = HTTPServer(('127.0.0.1', options['metrics_port']), MetricsHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+        verbosity = int(options['verbosity'])
+        purged = 0
+        for result in worker.run(options['slices']):
+            purged += result.purged
+            if verbosity > 1 and result.topic_ids:
+                self.stdout.write('topics %d-%d: purged=%d %.3fs' % (
+                    result.topic_ids[0], result.topic_ids[-1], result.purged, result.seconds))
+            if result.finished_pass:
+                if verbosity > 0:
+                    self.stdout.write('pass finished: purged=%d' % purged)
+                purged = 0
@@ -0,0 +1,67 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import time
+import urlparse
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive like the real verifier.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        params = urlparse.parse_qs(body)
+        time.sleep(self.server.delay)
+        if params.get('response', [''])[0] == 'fail':
+            answer = 'false\nincorrect-captcha-sol'
+        else:
+            answer = 'true\nsuccess'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class StubVerifier(ThreadingMixIn, HTTPServer):
+    """
+    Local reCAPTCHA verify API. Any response passes except "fail".
+    """
+    daemon_threads = True
+
+    def __init__(self, address, delay=0, verbose=False):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.delay = delay
+        self.verbose = verbose
+
+
+class Command(BaseCommand):
+    help = ('Run a local stub of the reCAPTCHA verify API for tests and load '
+        'runs. Set RECAPTCHA_VERIFY_URL to '
+        'http://127.0.0.1:<port>/recaptcha/api/verify to use it. Any '
+        'recaptcha_response_field passes except "fail".')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--port', type='int', default=8001,
+            help='Port to listen on.'),
+        make_option('--delay', type='float', default=0,
+            help='Seconds to wait before answering, to mimic a slow verifier.'),
+    )
+
+    def handle(self, *args, **options):
+        server = StubVerifier(('127.0.0.1', options['port']), options['delay'],
+            verbose=int(options['verbosity']) > 1)
+        self.stdout.write('reCAPTCHA stub verifier on http://127.0.0.1:%d/recaptcha/api/verify' %
+            options['port'])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,288 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from datetime import datetime, timedelta
+import bisect
+import cStringIO
+import random
+import time
+
+# Production shaped synthetic data for benchmarks and load runs.
+#
+# Topics go through the p_now overload of add_topic(), many per call, so
+# they get their creator voter and topic event as on the site. Voters,
+# cookies and votes, the bulk of the rows, are generated here and loaded
+# with COPY. Each cookie, the counters of a voter on a topic, has its own
+# voter. Their vote state follows add_vote(): one vote per day per cookie,
+# all votes of a cookie counted from its 3rd one on. The topic counters
+# and the badmeter_topic_daily rollup are then set from the loaded votes.
+#
+# Votes fall on topics by a Zipf distribution: the topic of popularity
+# rank r gets a share proportional to 1 / r ** skew. Cookies come back on
+# later days, fewer on weekends, at busier hours in the evening.
+#
+# Seeded topic slugs start with "seed-" so they can be told apart.
+
+WORDS = ('apple', 'bank', 'bridge', 'cable', 'camera', 'city', 'coffee',
+    'council', 'dentist', 'doctor', 'energy', 'festival', 'gym', 'hotel',
+    'internet', 'laptop', 'library', 'market', 'mayor', 'movie', 'museum',
+    'park', 'phone', 'pizza', 'police', 'post', 'railway', 'school',
+    'senator', 'shop', 'stadium', 'station', 'store', 'team', 'tower',
+    'traffic', 'train', 'water', 'weather', 'zoo')
+
+# Relative traffic by weekday, Monday first, and by hour of the day.
+WEEKDAY_WEIGHTS = (1.0, 1.0, 1.0, 1.0, .9, .7, .75)
+HOUR_WEIGHTS = (2, 1, 1, 1, 1, 2, 3, 5, 6, 6, 6, 7,
+    8, 7, 6, 6, 6, 7, 8, 9, 10, 9, 7, 4)
+
+
+class WeightedChoice(object):
+    """
+    Pick an index with probability proportional to its weight.
+    """
+    def __init__(self, weights):
+        self.cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+
+    def __call__(self):
+        return bisect.bisect(self.cumulative, random.random() * self.cumulative[-1])
+
+
+def zipf_weights(n, skew):
+    return [1.0 / rank ** skew for rank in range(1, n + 1)]
+
+
+class Command(BaseCommand):
+    help = ('Seed N topics, M cookies and K votes spread over the last '
+        '--days days, with a Zipf skew of votes over topics. Cookies and '
+        'votes are loaded with COPY. Run it on a database used for '
+        'benchmarks only.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--topics', type='int', default=1000,
+            help='Number of topics.'),
+        make_option('--cookies', type='int', default=100000,
+            help='Number of voting cookies, each on one topic.'),
+        make_option('--votes', type='int', default=1000000,
+            help='Number of votes, at least one per cookie.'),
+        make_option('--skew', type='float', default=1.1,
+            help='Zipf exponent of votes over topics. 0 spreads them evenly.'),
+        make_option('--days', type='int', default=180,
+            help='Days of history ending now.'),
+        make_option('--batch-size', type='int', default=100000,
+            help='Rows per COPY.'),
+        make_option('--seed', type='int', default=None,
+            help='Random seed for a repeatable dataset.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['topics'] < 1 or options['cookies'] < 1:
+            raise CommandError('--topics and --cookies must be at least 1.')
+        if options['votes'] < options['cookies']:
+            raise CommandError('--votes must be at least --cookies.')
+        if options['days'] < 1:
+            raise CommandError('--days must be at least 1.')
+        random.seed(options['seed'])
+        self.verbosity = int(options['verbosity'])
+
+        self.now = datetime.now().replace(microsecond=0)
+        self.today = self.now.replace(hour=0, minute=0, second=0)
+        self.first_day = self.today - timedelta(days=options['days'])
+        self.batch_size = options['batch_size']
+        self.hour = WeightedChoice(HOUR_WEIGHTS)
+
+        started = time.time()
+        with transaction.atomic():
+            # Backdated votes go to their monthly partitions, when
+            # badmeter_vote is partitioned, not to the default one.
+            cursor = connection.cursor()
+            cursor.execute('SELECT count(*) FROM create_vote_partitions(%s, %s)',
+                [self.first_day, self.now])
+            topics = self.seed_topics(options['topics'])
+            votes = self.seed_votes(topics, options['cookies'], options['votes'],
+                options['skew'])
+            self.update_topics(topics)
+            cursor.execute('SELECT rebuild_topic_daily(NULL)')
+        cursor.execute('ANALYZE badmeter_topic')
+        cursor.execute('ANALYZE badmeter_voter')
+        cursor.execute('ANALYZE badmeter_cookie')
+        cursor.execute('ANALYZE badmeter_vote')
+        cursor.execute('ANALYZE badmeter_topic_daily')
+
+        seconds = time.time() - started
+        self.stdout.write('topics=%d cookies=%d votes=%d seconds=%.1f votes/s=%.0f' % (
+            len(topics), options['cookies'], votes, seconds, votes / seconds))
+
+    def moment(self, day):
+        """
+        A time of day at a weighted hour, not later than now.
+        """
+        return min(day + timedelta(hours=self.hour(), seconds=random.randint(0, 3599)),
+            self.now)
+
+    def weekday_day(self, first, last):
+        """
+        A day from first to last, fewer on weekends.
+        """
+        days = (last - first).days
+        while True:
+            day = first + timedelta(days=random.randint(0, days))
+            if random.random() < WEEKDAY_WEIGHTS[day.weekday()]:
+                return day
+
+    def seed_topics(self, count):
+        """
+        Create the topics through add_topic() and return a list of
+        dicts of their id, creation day and vote counters.
+        """
+        run = '%06x' % random.getrandbits(24)
+        cursor = connection.cursor()
+        topics = []
+        for first in range(0, count, 1000):
+            titles, slugs, cookies, nows = [], [], [], []
+            for i in range(first, min(first + 1000, count)):
+                words = ' '.join(random.sample(WORDS, 3))
+                titles.append('Seed %s %d %s' % (run, i, words))
+                slugs.append('seed-%s-%d-%s' % (run, i, words.replace(' ', '-')))
+                cookies.append('%032x' % random.getrandbits(128))
+                # Leave a week of votes to the newest topics.
+                nows.append(self.moment(self.weekday_day(self.first_day,
+                    max(self.today - timedelta(days=7), self.first_day))).isoformat(' '))
+            cursor.execute('''SELECT count(add_topic(t, s, c, n))
+                FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[]) AS x(t, s, c, n)''',
+                [titles, slugs, cookies, nows])
+            cursor.execute('''SELECT id, date_created FROM badmeter_topic
+                WHERE topic_slug = ANY(%s) ORDER BY id''', [slugs])
+            for topic_id, date_created in cursor.fetchall():
+                topics.append({
+                    'id' : topic_id,
+                    'day' : date_created.replace(hour=0, minute=0, second=0, microsecond=0),
+                    'date_updated' : date_created,
+                    # Share of positive votes of the topic.
+                    'positive' : random.betavariate(2, 2),
+                    'votes_positive' : 0,
+                    'votes_negative' : 0})
+        return topics
+
+    def reserve_ids(self, sequence, count):
+        """
+        First of count ids taken from sequence for rows loaded with COPY.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT nextval(%s)', [sequence])
+        first = cursor.fetchone()[0]
+        cursor.execute('SELECT setval(%s, %s)', [sequence, first + count - 1])
+        return first
+
+    def copy(self, table, columns, rows):
+        buffer = cStringIO.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(row))
+            buffer.write('\n')
+        buffer.seek(0)
+        connection.cursor().cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+            table, ', '.join(columns)), buffer)
+
+    def seed_votes(self, topics, cookie_count, vote_count, skew):
+        """
+        COPY the voters, their cookies and votes. Returns the number of votes,
+        fewer than vote_count when cookies run out of days to vote on.
+        """
+        # Each cookie votes once, the rest of the votes go to cookies at
+        # random, capped at one vote per day.
+        counts = [1] * cookie_count
+        for i in xrange(vote_count - cookie_count):
+            counts[random.randrange(cookie_count)] += 1
+
+        random.shuffle(topics)
+        topic_choice = WeightedChoice(zipf_weights(len(topics), skew))
+        cookie_id = self.reserve_ids('badmeter_cookie_id_seq', cookie_count)
+        voter_id = self.reserve_ids('badmeter_voter_id_seq', cookie_count)
+        voter_rows, cookie_rows, vote_rows = [], [], []
+        votes = 0
+        for count in counts:
+            topic = topics[topic_choice()]
+            days = self.vote_days(topic['day'], count)
+            counted = len(days) >= 3
+            positive = negative = 0
+            for day in days:
+                vote = random.random() < topic['positive']
+                if vote:
+                    positive += 1
+                else:
+                    negative += 1
+                date_created = self.moment(day)
+                vote_rows.append((str(topic['id']), str(cookie_id),
+                    ' '.join(random.sample(WORDS, 4)).capitalize(),
+                    't' if vote else 'f', 't' if counted else '\\N',
+                    date_created.isoformat(' ')))
+            if not counted:
+                positive = negative = 0
+            topic['votes_positive'] += positive
+            topic['votes_negative'] += negative
+            topic['date_updated'] = max(topic['date_updated'], date_created)
+
+            date_voted = date_created.isoformat(' ')
+            date_first = vote_rows[-len(days)][5]
+            # bytea in COPY text format is \\x and hex digits.
+            voter_rows.append((str(voter_id), '\\\\x%032x' % random.getrandbits(128),
+                date_first))
+            cookie_rows.append((str(cookie_id), str(voter_id), str(topic['id']), str(positive), str(negative), str(len(days)),
+                't' if counted else 'f', date_voted, date_first, date_first))
+            cookie_id += 1
+            voter_id += 1
+            votes += len(days)
+
+            if len(vote_rows) >= self.batch_size:
+                self.flush(voter_rows, cookie_rows, vote_rows)
+                voter_rows, cookie_rows, vote_rows = [], [], []
+        self.flush(voter_rows, cookie_rows, vote_rows)
+        return votes
+
+    def flush(self, voter_rows, cookie_rows, vote_rows):
+        self.copy('badmeter_voter', ('id', 'digest', 'date_created'), voter_rows)
+        self.copy('badmeter_cookie', ('id', 'voter_id', 'topic_id',
+            'votes_positive', 'votes_negative', 'votes_total', 'counted', 'date_voted',
+            'date_created', 'date_updated'), cookie_rows)
+        self.copy('badmeter_vote', ('topic_id', 'cookie_id', 'comment', 'vote', 'counted',
+            'date_created'), vote_rows)
+        if self.verbosity > 1:
+            self.stdout.write('Copied %d cookies and %d votes.' % (len(cookie_rows), len(vote_rows)))
+
+    def vote_days(self, first_day, count):
+        """
+        Up to count distinct voting days after first_day up to today, the
+        first on a weekday weighted day and the others on return visits.
+        """
+        first_day += timedelta(days=1)
+        gaps = [1 + int(random.expovariate(1 / 3.0)) for i in range(count - 1)]
+        available = (self.today - first_day).days
+        if sum(gaps) > available:
+            # Not enough days left: come back every day.
+            gaps = [1] * min(count - 1, available)
+        start = self.weekday_day(first_day, self.today - timedelta(days=sum(gaps)))
+        days = [start]
+        for gap in gaps:
+            days.append(days[-1] + timedelta(days=gap))
+        return days
+
+    def update_topics(self, topics):
+        """
+        Set the topic counters, badmeter and date_updated as add_vote()
+        would have.
+        """
+        cursor = connection.cursor()
+        cursor.execute('''UPDATE badmeter_topic T
+            SET votes_positive = x.p,
+                votes_negative = x.n,
+                badmeter = 50 + floor((x.p - x.n) / greatest(x.p + x.n, 1)::float * 50),
+                date_updated = x.u
+            FROM unnest(%s::int[], %s::int[], %s::int[], %s::timestamp[]) AS x(id, p, n, u)
+            WHERE T.id = x.id''', [
+                [topic['id'] for topic in topics],
+                [topic['votes_positive'] for topic in topics],
+                [topic['votes_negative'] for topic in topics],
+                [topic['date_updated'] for topic in topics]])
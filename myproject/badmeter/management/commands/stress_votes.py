@@ -0,0 +1,143 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from badmeter.misc import hash_md5_random_hexdigest
+import datetime
+import multiprocessing
+import random
+
+# Stress add_topic() and add_vote() from many processes, as from many
+# gunicorn workers. Every process adds the same topics and casts the same
+# votes at the same time, so of each topic exactly one add and of each
+# voter, topic and day exactly one vote must go through. The adds that lose
+# the race must not leave a voter behind. The days run as
+# rounds of fresh processes since add_vote() expects the votes of a voter
+# in time order. The counters are then checked against the raw votes by
+# verify_vote_counters(), before and after folding the sharded ones. The
+# topics are purged at the end.
+
+
+def worker(results, topic_slugs, cookie_strings, now, add_topics):
+    # Forked processes share nothing but the database. The parent closed
+    # its connection before forking, each process opens its own.
+    random.seed()
+    cookie_strings = list(cookie_strings)
+    random.shuffle(cookie_strings)
+    passed = 0
+    error = None
+    try:
+        cursor = connection.cursor()
+        for topic_slug in topic_slugs:
+            if add_topics:
+                cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+                    [topic_slug, topic_slug, cookie_strings[0], now])
+                passed += cursor.fetchone()[0] >= 0
+                continue
+            for cookie_string in cookie_strings:
+                cursor.execute('SELECT return_id FROM add_vote(%s, %s, %s, %s, %s)',
+                    [topic_slug, cookie_string, 'stress', str(cookie_string < '8'), now])
+                passed += cursor.fetchone()[0] >= 0
+    except Exception as e:
+        error = str(e)
+    finally:
+        connection.close()
+    results.put((passed, error))
+
+
+class Command(BaseCommand):
+    help = ('Add the same topics and votes from many processes at once and '
+        'check the vote counters against the raw votes.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=8,
+            help='Parallel processes, each on its own connection.'),
+        make_option('--topics', type='int', default=4,
+            help='Topics added and voted on by all processes.'),
+        make_option('--voters', type='int', default=50,
+            help='Voters voting on every topic from all processes.'),
+        make_option('--days', type='int', default=4,
+            help='Days voted. From the 3rd on the votes count.'),
+        make_option('--shards', type='int', default=4,
+            help='Counter shards of the last topic, 0 for none.'),
+    )
+
+    def handle(self, *args, **options):
+        if min(options['processes'], options['topics'], options['voters'], options['days']) < 1:
+            raise CommandError('--processes, --topics, --voters and --days must be at least 1.')
+
+        run = hash_md5_random_hexdigest()[:8]
+        topic_slugs = ['stress-%s-%d' % (run, i) for i in range(options['topics'])]
+        cookie_strings = [hash_md5_random_hexdigest() for i in range(options['voters'])]
+        first_day = datetime.date.today() - datetime.timedelta(days=options['days'])
+        # The rounds close the connection of this process, cursors are
+        # taken after them.
+        try:
+            added = self.round(options['processes'], topic_slugs, cookie_strings,
+                '%s 00:00' % first_day, True)
+            if added != len(topic_slugs):
+                raise CommandError('%d topic adds for %d topics.' % (added, len(topic_slugs)))
+            cursor = connection.cursor()
+            cursor.execute('''SELECT count(*) FROM badmeter_voter W
+                WHERE W.digest IN (SELECT voter_digest(C) FROM unnest(%s::text[]) C)
+                    AND NOT EXISTS (SELECT 1 FROM badmeter_topic T WHERE T.voter_id = W.id)''',
+                [cookie_strings])
+            orphans = cursor.fetchone()[0]
+            if orphans:
+                raise CommandError('%d voters added by topic adds that lost the race.' % orphans)
+            if options['shards'] > 1:
+                connection.cursor().execute('SELECT set_counter_shards(%s, %s)',
+                    [topic_slugs[-1], options['shards']])
+
+            for day in range(options['days']):
+                now = '%s 12:00' % (first_day + datetime.timedelta(days=day))
+                votes = self.round(options['processes'], topic_slugs, cookie_strings, now, False)
+                if votes != len(topic_slugs) * len(cookie_strings):
+                    raise CommandError('%d votes on %s, expected %d.' % (
+                        votes, now, len(topic_slugs) * len(cookie_strings)))
+            self.verify(topic_slugs)
+            connection.cursor().execute('''SELECT fold_topic_counters(id) FROM badmeter_topic
+                WHERE topic_slug = ANY(%s)''', [topic_slugs])
+            self.verify(topic_slugs)
+        finally:
+            connection.cursor().execute('''SELECT count(*) FROM purge_many(ARRAY(
+                SELECT id FROM badmeter_topic WHERE topic_slug = ANY(%s)))''', [topic_slugs])
+
+        self.stdout.write('%d processes, %d topics, %d votes: counters consistent' % (
+            options['processes'], len(topic_slugs),
+            len(topic_slugs) * len(cookie_strings) * options['days']))
+
+    def round(self, processes, topic_slugs, cookie_strings, now, add_topics):
+        """
+        Run worker() in parallel processes, return the calls that passed.
+        """
+        connection.close()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=worker,
+            args=(results, topic_slugs, cookie_strings, now, add_topics))
+            for i in range(processes)]
+        for process in workers:
+            process.start()
+        rows = [results.get() for process in workers]
+        for process in workers:
+            process.join()
+
+        errors = [error for passed, error in rows if error]
+        if errors:
+            raise CommandError('Worker failed: %s' % errors[0])
+        return sum(passed for passed, error in rows)
+
+    def verify(self, topic_slugs):
+        cursor = connection.cursor()
+        cursor.execute('''SELECT V.topic_id, V.cookie_id, V.problem
+            FROM verify_vote_counters(ARRAY(
+                SELECT id FROM badmeter_topic WHERE topic_slug = ANY(%s))) V''',
+            [topic_slugs])
+        rows = cursor.fetchall()
+        cursor.execute('''SELECT count(*) FROM verify_topic_daily() V, badmeter_topic T
+            WHERE T.id = V.topic_id AND T.topic_slug = ANY(%s)''', [topic_slugs])
+        rollup = cursor.fetchone()[0]
+        for row in rows:
+            self.stdout.write('topic=%s cookie=%s %s' % row)
+        if rows or rollup:
+            raise CommandError('%d vote counters and %d daily rollup rows disagree '
+                'with the raw votes.' % (len(rows), rollup))
@@ -0,0 +1,46 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import time
+
+
+class Command(BaseCommand):
+    args = '[topic_slug ...]'
+    help = ('Fold the sharded vote counters of all topics into badmeter_topic, '
+        'once or every --every seconds. With topic slugs and --shards, '
+        'spread the vote counters of those topics over that many shards '
+        'instead, or stop sharding them with --shards 0.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--shards', type='int', default=None,
+            help='Counter shards of the given topics, 0 or 1 for none.'),
+        make_option('--every', type='float', default=None,
+            help='Fold again every this many seconds, forever.'),
+    )
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        if args or options['shards'] is not None:
+            if not args or options['shards'] is None:
+                raise CommandError('Give both topic slugs and --shards.')
+            if options['shards'] < 0:
+                raise CommandError('--shards must be at least 0.')
+            for topic_slug in args:
+                cursor.execute('SELECT set_counter_shards(%s, %s)',
+                    [topic_slug, options['shards']])
+                if not cursor.fetchone()[0]:
+                    raise CommandError('No topic %s.' % topic_slug)
+                self.stdout.write('%s: shards=%d' % (topic_slug, options['shards']))
+            return
+
+        verbosity = int(options['verbosity'])
+        while True:
+            started = time.time()
+            cursor.execute('SELECT fold_topic_counters(NULL)')
+            folded = cursor.fetchone()[0]
+            if verbosity > 1 or (verbosity > 0 and options['every'] is None):
+                self.stdout.write('folded %d topics %.3fs' % (folded, time.time() - started))
+            if options['every'] is None:
+                return
+            time.sleep(max(0, options['every'] - (time.time() - started)))
@@ -0,0 +1,36 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+
+class Command(BaseCommand):
+    help = ('Verify the badmeter_topic_daily vote rollup against the raw '
+        'badmeter_vote table, or rebuild it with --rebuild.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', default=False,
+            help='Rebuild the rollup from badmeter_vote.'),
+        make_option('--topic', type='int', default=None,
+            help='Rebuild only this topic id.'),
+    )
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        if options['rebuild']:
+            with transaction.atomic():
+                cursor.execute('SELECT rebuild_topic_daily(%s)', [options['topic']])
+            self.stdout.write('Rebuilt badmeter_topic_daily.')
+            return
+
+        cursor.execute('''SELECT topic_id, day, votes_counted, votes_counted_midnight,
+            votes_uncounted, expected_counted, expected_counted_midnight,
+            expected_uncounted FROM verify_topic_daily()''')
+        rows = cursor.fetchall()
+        for row in rows:
+            self.stdout.write('topic=%s day=%s rollup=%s/%s/%s raw=%s/%s/%s' % row)
+
+        if rows:
+            raise CommandError('%d badmeter_topic_daily rows disagree with badmeter_vote. '
+                'Run with --rebuild to fix.' % len(rows))
+        self.stdout.write('badmeter_topic_daily matches badmeter_vote.')
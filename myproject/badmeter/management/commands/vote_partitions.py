@@ -0,0 +1,63 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from myproject import settings
+import time
+
+
+class Command(BaseCommand):
+    help = ('Create the monthly badmeter_vote partitions of the coming months '
+        'and detach and drop those older than --retention-months, each in '
+        'its own transaction. Needs badmeter_vote partitioned by '
+        'badmeter/upgrade/004_vote_partitions.sql.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--months-ahead', type='int',
+            default=settings.VOTE_PARTITION_MONTHS_AHEAD,
+            help='Months of partitions created ahead of the current one.'),
+        make_option('--retention-months', type='int',
+            default=settings.VOTE_RETENTION_MONTHS,
+            help='Drop partitions older than this many months. '
+                'Default VOTE_RETENTION_MONTHS, none keeps them all.'),
+        make_option('--now', default=None,
+            help='Run as of this timestamp instead of now(), for testing.'),
+        make_option('--dry-run', action='store_true', default=False,
+            help='List the partitions to drop without dropping them.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['months_ahead'] < 0:
+            raise CommandError('--months-ahead must be at least 0.')
+        if options['retention_months'] is not None and options['retention_months'] < 1:
+            raise CommandError('--retention-months must be at least 1.')
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT vote_partitioned()')
+        if not cursor.fetchone()[0]:
+            raise CommandError('badmeter_vote is not partitioned. '
+                'Run badmeter/upgrade/004_vote_partitions.sql first.')
+
+        with transaction.atomic():
+            cursor.execute('''SELECT create_vote_partitions(N.now,
+                    N.now + %s * interval '1 month')
+                FROM (SELECT COALESCE(get_timestamp(%s), now()::timestamp) AS now) N''',
+                [options['months_ahead'], options['now']])
+            for row in cursor.fetchall():
+                self.stdout.write('created %s' % row[0])
+
+        if options['retention_months'] is None:
+            return
+
+        cursor.execute('SELECT partition_name FROM list_expired_vote_partitions(%s, %s)',
+            [options['now'], options['retention_months']])
+        for row in cursor.fetchall():
+            if options['dry_run']:
+                self.stdout.write('would drop %s' % row[0])
+                continue
+
+            started = time.time()
+            with transaction.atomic():
+                cursor.execute('SELECT drop_vote_partition(%s)', [row[0]])
+                freed = cursor.fetchone()[0]
+            self.stdout.write('dropped %s %.1fMB %.3fs' % (
+                row[0], freed / 1048576.0, time.time() - started))
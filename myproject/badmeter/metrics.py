@@ -0,0 +1,208 @@
+import threading
+
+# Process-local counters, gauges and histograms of the caches and other
+# hot paths, e.g. hits and misses of the topic stats cache. They are created once at
+# import time of the module using them:
+#
+#     hits = metrics.counter('badmeter_topic_stats_hits_total',
+#         'Vote pages served from the topic stats cache.')
+#     hits.inc()
+#
+# Labels tell apart metrics of the same name, e.g. the time of each view:
+#
+#     metrics.histogram('badmeter_view_seconds', 'View seconds.',
+#         labels={'view' : 'search'}).observe(seconds)
+#
+# render() returns them all in the Prometheus text format, served by
+# badmeter.views.metrics_text() at /metrics and by the purge worker on
+# its own port.
+
+
+class Counter(object):
+    """
+    Monotonic thread-safe counter.
+    """
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+
+class Gauge(object):
+    """
+    Thread-safe value that goes up and down, e.g. a progress ratio.
+    """
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+
+class Histogram(object):
+    """
+    Thread-safe distribution of observed values, e.g. latency seconds,
+    in cumulative buckets.
+    """
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    @property
+    def bucket_counts(self):
+        """
+        List of (upper bound, observations <= upper bound).
+        """
+        return zip(self.buckets, self._counts)
+
+    def snapshot(self):
+        """
+        Consistent (bucket_counts, count, sum).
+        """
+        with self._lock:
+            return zip(self.buckets, self._counts), self.count, self.sum
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def counter(name, help_text='', labels=None):
+    """
+    Return the counter called name with labels, a dict, created on first
+    use.
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        if key not in _counters:
+            _counters[key] = Counter(name, help_text, key[1])
+        return _counters[key]
+
+
+def counters():
+    """
+    All counters sorted by name.
+    """
+    with _lock:
+        return sorted(_counters.values(), key=lambda c: (c.name, c.labels))
+
+
+def gauge(name, help_text='', labels=None):
+    """
+    Return the gauge called name with labels, a dict, created on first
+    use.
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        if key not in _gauges:
+            _gauges[key] = Gauge(name, help_text, key[1])
+        return _gauges[key]
+
+
+def gauges():
+    """
+    All gauges sorted by name.
+    """
+    with _lock:
+        return sorted(_gauges.values(), key=lambda g: (g.name, g.labels))
+
+
+def histogram(name, help_text='', buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+        labels=None):
+    """
+    Return the histogram called name with labels, a dict, created on
+    first use.
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram(name, help_text, buckets, key[1])
+        return _histograms[key]
+
+
+def histograms():
+    """
+    All histograms sorted by name.
+    """
+    with _lock:
+        return sorted(_histograms.values(), key=lambda h: (h.name, h.labels))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n')) for key, value in labels)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    All counters, gauges and histograms in the Prometheus text format.
+    """
+    lines = []
+    for kind, values in (('counter', counters()), ('gauge', gauges())):
+        name = None
+        for c in values:
+            if c.name != name:
+                name = c.name
+                lines.append('# HELP %s %s' % (name, c.help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s%s %s' % (name, _format_labels(c.labels), _format_value(c.value)))
+
+    name = None
+    for h in histograms():
+        if h.name != name:
+            name = h.name
+            lines.append('# HELP %s %s' % (name, h.help_text))
+            lines.append('# TYPE %s histogram' % name)
+        bucket_counts, count, total = h.snapshot()
+        for bound, bucket_count in bucket_counts:
+            lines.append('%s_bucket%s %d' % (name,
+                _format_labels(h.labels + (('le', _format_value(bound)),)), bucket_count))
+        lines.append('%s_bucket%s %d' % (name, _format_labels(h.labels + (('le', '+Inf'),)), count))
+        lines.append('%s_sum%s %s' % (name, _format_labels(h.labels), _format_value(total)))
+        lines.append('%s_count%s %d' % (name, _format_labels(h.labels), count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,42 @@
+from . import db
+from . import metrics
+import time
+
+QUERY_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50)
+
+
+class MetricsMiddleware(object):
+    """
+    Record the seconds, database queries and database seconds of each
+    request in badmeter.metrics histograms labeled by view, e.g.
+    view="VoteFormView". Put it first in MIDDLEWARE_CLASSES so the
+    session and message middleware queries count too.
+
+    Queries are counted by the cursors of badmeter.db.tally, a few
+    additions per query, so it can stay on in production.
+    """
+    def process_request(self, request):
+        request.badmeter_metrics_start = (time.time(), db.tally.queries, db.tally.seconds)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Class based views keep their class name in as_view().
+        request.badmeter_view = getattr(view_func, '__name__', 'unknown')
+
+    def process_response(self, request, response):
+        view = getattr(request, 'badmeter_view', None)
+        start = getattr(request, 'badmeter_metrics_start', None)
+        if view is None or start is None:
+            # Not resolved to a view, e.g. a 404.
+            return response
+
+        started, queries, seconds = start
+        labels = {'view' : view}
+        metrics.histogram('badmeter_view_seconds',
+            'Seconds per request by view.', labels=labels).observe(time.time() - started)
+        metrics.histogram('badmeter_view_db_queries',
+            'Database queries per request by view.', QUERY_BUCKETS,
+            labels=labels).observe(db.tally.queries - queries)
+        metrics.histogram('badmeter_view_db_seconds',
+            'Database seconds per request by view.',
+            labels=labels).observe(db.tally.seconds - seconds)
+        return response
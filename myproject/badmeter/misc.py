@@ -1,7 +1,8 @@
 
 from __future__ import print_function
-from datetime import datetime, date
-from django.utils.timezone import make_aware
+from datetime import datetime, date, timedelta
+from django.utils.timezone import make_aware, get_default_timezone, utc
+from myproject import settings
 import os
 import sys
 import hashlib
@@ -24,3 +25,58 @@ def ageindays_string(born_datetime):
 
 def hash_md5_random_hexdigest():
     return hashlib.md5(os.urandom(5)).hexdigest()
+
+def voter_digest(cookie_string):
+    """
+    The 16-byte badmeter_voter.digest of a visitor id. Its hex form is
+    the voter shown in the vote list.
+    """
+    return hashlib.md5(cookie_string).digest()
+
+
+def voter_hexdigest(cookie_string):
+    return hashlib.md5(cookie_string).hexdigest() if cookie_string else None
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+
+def vote_cursor(date_created, vote_id):
+    """
+    The ?before= cursor of votes.json for the votes older than this one:
+    its date_created in microseconds since the epoch and its id.
+    """
+    if date_created.tzinfo is None:
+        date_created = make_aware(date_created, get_default_timezone())
+    delta = date_created - EPOCH
+    return '%d_%d' % ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds,
+        vote_id)
+
+
+def parse_vote_cursor(cursor):
+    """
+    (date_created, id) of a vote_cursor(), (None, None) if malformed.
+    """
+    try:
+        microseconds, vote_id = [int(part) for part in cursor.split('_')]
+        return EPOCH + timedelta(microseconds=microseconds), vote_id
+    except (ValueError, OverflowError):
+        return None, None
+
+
+def get_cookie_string(request, create=False):
+    """
+    The visitor id, kept as a digest in badmeter_voter. It is stored in
+    the session as 'cookie_string'; older database sessions use their
+    session key. A new id is only written to the session with create=True,
+    i.e. on a vote or new topic, so readers never write a session.
+    """
+    session = request.session
+    if 'cookie_string' in session:
+        return session['cookie_string']
+    if session.session_key and not settings.SESSION_ENGINE.endswith('signed_cookies'):
+        return session.session_key
+    if create:
+        session['cookie_string'] = hash_md5_random_hexdigest()
+        return session['cookie_string']
+    return None
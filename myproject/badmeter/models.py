@@ -1,6 +1,8 @@
 
-from django.db import models, connection
+from django.db import models
+from myproject import settings
 from .misc import print_info
+from . import db
 
 # Business rules are implemented in postgresql server-side stored
 # function for efficiency. This elliminates back-and-forth traffic
@@ -40,22 +42,42 @@ class CheckModelSave(object):
         return self._error_msg
 
 
+class Voter(models.Model):
+    """
+    Voter table keeps one row per visitor id (cookie_string) as its
+    16-byte md5 digest, see misc.voter_digest().
+    """
+    digest = models.BinaryField(max_length=16, unique=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'%s' % str(self.digest).encode('hex')
+
+
 class Cookie(models.Model):
     """
-    Cookie table keeps user unique session cookie id.
+    Cookie table keeps the vote counters of a voter on a topic.
     """
-    cookie_string = models.CharField(db_index=True, max_length=100)
-    #~ Note that Topic & Cookie tables have cyclic foreigh-key dependencies.
-    #~ This is addressed by: 'badmeter.Topic', related_name='topic_cookies', null=True
+    #~ The unique (voter, topic) index serves the voter lookups.
+    voter = models.ForeignKey(Voter, related_name='voter_cookies',
+        db_index=False, on_delete=models.CASCADE)
     topic = models.ForeignKey('badmeter.Topic', related_name='topic_cookies',
         null=True, blank=True, on_delete=models.CASCADE)
     votes_positive = models.IntegerField(null=True)
     votes_negative = models.IntegerField(null=True)
+    #~ Vote state of this voter on this topic maintained by
+    #~ add_vote(). Makes the 1-vote-per-day and 3-vote rules O(1) checks.
+    votes_total = models.IntegerField(default=0)
+    counted = models.BooleanField(default=False)
+    date_voted = models.DateTimeField(null=True, blank=True)
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        unique_together = (('voter', 'topic'),)
+
     def __unicode__(self):
-        return u'%s' % (self.cookie_string)
+        return u'%s -- %s' % (self.voter_id, self.topic_id)
 
 
 class Topic(models.Model):
@@ -63,14 +85,18 @@ class Topic(models.Model):
     Topic table saves user created topics.
     """
     topic_title = models.CharField(db_index=True, max_length=100)
-    topic_slug = models.SlugField(db_index=True, max_length=100)
+    #~ Unique so racing add_topic() calls add one topic per slug.
+    topic_slug = models.SlugField(unique=True, max_length=100)
     badmeter = models.DecimalField(max_digits=5, decimal_places=2, null=True)
     votes_positive = models.IntegerField(null=True)
     votes_negative = models.IntegerField(null=True)
-    #~ Note that Topic & Cookie tables have cyclic foreigh-key dependencies.
-    #~ This is addressed by: related_name='cookie_topics', null=True
-    cookie = models.ForeignKey(Cookie, related_name='cookie_topics',
-        null=True, blank=True, on_delete=models.CASCADE)
+    #~ The voter who created this topic.
+    voter = models.ForeignKey(Voter, related_name='voter_topics',
+        null=True, blank=True, on_delete=models.SET_NULL)
+    #~ Number of TopicCounter rows the vote counters of this topic are
+    #~ spread over by add_vote(), NULL when not sharded. Set it with
+    #~ "python manage.py topic_counters --shards".
+    counter_shards = models.SmallIntegerField(null=True, blank=True)
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now_add=True)
 
@@ -83,22 +109,119 @@ class Topic(models.Model):
     def save(self, *args, **kwargs):
         #~ By-pass orm for custom save using a database stored function.
         #~ This way the call is a one-way trip to the server. Using orm
-        #~ is clumsy in this way. Reference to cookie_string in table
-        #~ Cookie is saved in both Topic and Cookie save. Vote counters are
-        #~ also set to zero in the add_topic() plgsql stored function.
+        #~ is clumsy in this way. The creator's cookie_string is saved as
+        #~ a Voter. Vote counters are also set to zero in the add_topic()
+        #~ plgsql stored function.
 
         arg = args[1]
-        cursor = connection.cursor()
-        cursor.execute(
-            'SELECT return_id, status_message FROM add_topic(%s, %s, %s)', [
-                arg['topic_title'],
-                arg['topic_slug'],
-                arg['cookie_string']
-            ]
-        )
+        rows = db.fetchall('add_topic', [
+            arg['topic_title'],
+            arg['topic_slug'],
+            arg['cookie_string']
+        ])
 
         # Save database returned message for debug purposes.
-        self.check_model_save = CheckModelSave(cursor.fetchall())
+        self.check_model_save = CheckModelSave(rows)
+
+        # Make the new topic searchable right away in this process.
+        # Other processes pick it up from the badmeter_topic_event log.
+        if not self.check_model_save.if_error:
+            from .topic_index import topic_index
+            from .search_cache import search_cache
+            topic_index.add(self.check_model_save.get_error_code,
+                arg['topic_title'], arg['topic_slug'])
+            search_cache.invalidate_title(arg['topic_title'])
+
+
+class TopicDaily(models.Model):
+    """
+    TopicDaily table rolls up votes per topic per day. It is maintained by
+    add_vote() and purge_one() in the same transaction as the votes, so
+    purge logic reads one row per day instead of every vote.
+    """
+    topic = models.ForeignKey(Topic, related_name='topic_dailies', on_delete=models.CASCADE)
+    day = models.DateField()
+    votes_counted = models.IntegerField(default=0)
+    #~ Counted votes cast exactly at midnight. get_purgedate() windows
+    #~ include their end timestamp so these also fall in the window
+    #~ ending on this day.
+    votes_counted_midnight = models.IntegerField(default=0)
+    votes_uncounted = models.IntegerField(default=0)
+    #~ Sharded topics roll up into one row per TopicCounter shard per
+    #~ day. fold_topic_counters() folds past days into shard 0.
+    shard = models.SmallIntegerField(default=0)
+
+    class Meta:
+        db_table = 'badmeter_topic_daily'
+        unique_together = (('topic', 'day', 'shard'),)
+
+    def __unicode__(self):
+        return u'%s -- %s' % (self.topic_id, self.day)
+
+
+class TopicCounter(models.Model):
+    """
+    TopicCounter table holds vote counter deltas of sharded topics not yet
+    folded into their Topic row. add_vote() adds each vote to the shard of
+    its voter, so voters of a busy topic do not queue on the Topic row
+    lock. See sql/topic_counters.sql.
+    """
+    topic = models.ForeignKey(Topic, related_name='topic_counters', on_delete=models.CASCADE)
+    shard = models.SmallIntegerField()
+    votes_positive = models.IntegerField(default=0)
+    votes_negative = models.IntegerField(default=0)
+    date_updated = models.DateTimeField()
+
+    class Meta:
+        db_table = 'badmeter_topic_counter'
+        unique_together = (('topic', 'shard'),)
+
+    def __unicode__(self):
+        return u'%s -- %s' % (self.topic_id, self.shard)
+
+
+class TopicEvent(models.Model):
+    """
+    TopicEvent table logs topics added by add_topic() and deleted by
+    purge_one(). It lets the in-process topic search index refresh
+    incrementally instead of reloading the whole Topic table.
+    """
+    ADD = 'add'
+    PURGE = 'purge'
+
+    #~ Plain integer, not a foreign-key, since purged topics are gone.
+    topic_id = models.IntegerField()
+    topic_title = models.CharField(max_length=100)
+    topic_slug = models.SlugField(max_length=100)
+    event = models.CharField(max_length=10)
+    date_created = models.DateTimeField(db_index=True, auto_now_add=True)
+
+    class Meta:
+        db_table = 'badmeter_topic_event'
+
+    def __unicode__(self):
+        return u'%s -- %s' % (self.event, self.topic_slug)
+
+
+class PurgeCursor(models.Model):
+    """
+    PurgeCursor table keeps the place of the purge worker in its topic id
+    ordered pass over the topics, so a restarted worker resumes there.
+    See badmeter.purge.PurgeWorker.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    #~ Topics up to this id are checked in the current pass.
+    last_topic_id = models.IntegerField(default=0)
+    pass_started = models.DateTimeField()
+    last_pass_started = models.DateTimeField(null=True, blank=True)
+    last_pass_finished = models.DateTimeField(null=True, blank=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'badmeter_purge_cursor'
+
+    def __unicode__(self):
+        return u'%s -- %s' % (self.name, self.last_topic_id)
 
 
 class Vote(models.Model):
@@ -106,6 +229,9 @@ class Vote(models.Model):
     Vote table saves user created votes. Business rules are implemented on
     postgresql server-side stored function for efficiency. This elliminates
     back-and-forth traffic between django orm and postgresql.
+
+    The table is split into monthly partitions on date_created by
+    upgrade/004_vote_partitions.sql, see sql/vote_partitions.sql.
     """
     topic = models.ForeignKey(Topic)
     cookie = models.ForeignKey(Cookie)
@@ -117,6 +243,9 @@ class Vote(models.Model):
     # Container for returned database message (class CheckModelSave()).
     check_model_save = None
 
+    class Meta:
+        index_together = [['topic', 'cookie', 'date_created'], ['topic', 'date_created', 'id']]
+
     def __unicode__(self):
         return u'%s -- %s' % (self.topic, self.topic.topic_slug)
 
@@ -131,15 +260,46 @@ class Vote(models.Model):
         #~ also incremented in both Topic.save() and Cookie.save() tables.
 
         arg = args[1]
-        cursor = connection.cursor()
-        cursor.execute(
-            'SELECT return_id, status_message FROM add_vote(%s, %s, %s, %s)', [
-                arg['topic_slug'],
-                arg['cookie_string'],
-                arg['comment'],
-                arg['vote']
-            ]
-        )
+        rows = db.fetchall('add_vote', [
+            arg['topic_slug'],
+            arg['cookie_string'],
+            arg['comment'],
+            arg['vote']
+        ])
 
         # Save database returned message for debug purposes.
-        self.check_model_save = CheckModelSave(cursor.fetchall())
+        self.check_model_save = CheckModelSave(rows)
+
+        # Write the new topic stats through to the topic stats cache.
+        if not self.check_model_save.if_error:
+            from .stats_cache import topic_stats_cache
+            topic_stats_cache.refresh(arg['topic_slug'])
+
+    @classmethod
+    def save_many(cls, args, batch_size=None):
+        """
+        Batched Vote.save() for imports, replays and load tests. args is a
+        list of the dicts taken by Vote.save(), each with an optional
+        'now' timestamp text. The votes go to the add_votes() stored
+        function in batches of batch_size, settings.VOTES_BATCH_SIZE by
+        default, one round trip each. Returns one CheckModelSave per vote.
+        """
+        batch_size = batch_size or settings.VOTES_BATCH_SIZE
+        results = []
+        for i in range(0, len(args), batch_size):
+            batch = args[i:i + batch_size]
+            rows = db.fetchall('add_votes', [
+                [arg['topic_slug'] for arg in batch],
+                [arg['cookie_string'] for arg in batch],
+                [arg['comment'] for arg in batch],
+                [arg['vote'] for arg in batch],
+                [arg.get('now') for arg in batch]
+            ])
+            results.extend(CheckModelSave([row]) for row in rows)
+
+        # Drop the cached stats of the voted topics.
+        from .stats_cache import topic_stats_cache
+        for topic_slug in set(arg['topic_slug'] for arg, result in zip(args, results)
+                if not result.if_error):
+            topic_stats_cache.delete(topic_slug)
+        return results
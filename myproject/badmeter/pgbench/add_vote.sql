@@ -0,0 +1,8 @@
+-- pgbench custom script: one add_vote() per transaction by a random
+-- cookie on a random topic created by add_vote_setup.sql. Compare the
+-- reported tps before and after a change to add_vote():
+--     pgbench -n -f badmeter/pgbench/add_vote.sql -c 8 -j 4 -T 60 \
+--         -D topics=1000 -D cookies=100000 badmeter
+\set topic random(1, :topics)
+\set cookie random(1, :cookies)
+SELECT return_id FROM add_vote('pgbench-topic-' || :topic, 'pgbench-cookie-' || :cookie, 'pgbench', 'true');
@@ -0,0 +1,5 @@
+
+-- Create the topics voted on by pgbench/add_vote.sql. Run once:
+--     psql -d badmeter -v topics=1000 -f badmeter/pgbench/add_vote_setup.sql
+SELECT count(add_topic('pgbench topic ' || g, 'pgbench-topic-' || g, 'pgbench-creator'))
+    FROM generate_series(1, :topics) g;
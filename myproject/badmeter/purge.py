@@ -0,0 +1,217 @@
+from django.db import connection, transaction
+from django.db.models import Max
+from myproject import settings
+from datetime import datetime
+from . import db
+from . import metrics
+from .models import PurgeCursor, Topic
+from .stats_cache import topic_stats_cache
+from .search_cache import search_cache
+import time
+
+# Batched topic purge engine. Replaces the single-transaction purge_scan()
+# for the midnight cron (python manage.py purge_topics), and drives the
+# incremental purge worker below (python manage.py purge_worker).
+#
+# Stale topics are found with one grouped query over the daily vote rollup
+# (list_stale_topics()). They are then purged in batches of
+# PURGE_BATCH_SIZE topics with purge_many(), each batch in its own
+# transaction, so no lock or WAL burst outlives a batch. Each batch
+# re-checks staleness so topics voted on since the scan are spared.
+# Purged topics are evicted from the topic stats and search caches.
+
+
+class PurgeBatch(object):
+    """
+    Outcome of one purge batch.
+    """
+    def __init__(self, topic_ids, rows, seconds):
+        self.topic_ids = topic_ids
+        self.rows = rows
+        self.seconds = seconds
+
+    @property
+    def topics(self):
+        return len(self.rows)
+
+    @property
+    def votes(self):
+        return sum(row[3] for row in self.rows)
+
+    @property
+    def cookies(self):
+        return sum(row[4] for row in self.rows)
+
+
+def list_stale_topics(now=None, topic_ids=None):
+    return [row[0] for row in db.fetchall('list_stale_topics', [now, topic_ids])]
+
+
+def purge_topics(topic_ids, now=None):
+    """
+    Purge the still stale topics among topic_ids in one transaction.
+    """
+    started = time.time()
+    with transaction.atomic():
+        rows = db.fetchall('purge_many', [now, topic_ids])
+
+    for row in rows:
+        topic_stats_cache.delete(row[1])
+        search_cache.invalidate_title(row[2])
+    return PurgeBatch(topic_ids, rows, time.time() - started)
+
+
+def purge_stale_topics(now=None, batch_size=None):
+    """
+    Generator purging all stale topics batch by batch, yielding a
+    PurgeBatch for each.
+    """
+    batch_size = batch_size or settings.PURGE_BATCH_SIZE
+    topic_ids = list_stale_topics(now)
+    for i in range(0, len(topic_ids), batch_size):
+        yield purge_topics(topic_ids[i:i + batch_size], now)
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT trim_topic_events()')
+
+
+# Incremental purge worker (python manage.py purge_worker). Instead of one
+# midnight scan it walks the topics in id order, PURGE_WORKER_SLICE_SIZE
+# at a time, and purges the stale ones of each slice with purge_topics(),
+# the purge_one() semantics. After each slice its place is saved in the
+# PurgeCursor table, so a restart resumes there. A slice that is purged
+# but not saved is just checked again. A pass over all topics starts over
+# from id 0 once the ids run out.
+
+scanned = metrics.counter('badmeter_purge_worker_topics_scanned_total',
+    'Topics checked for staleness by the purge worker.')
+purged = metrics.counter('badmeter_purge_worker_topics_purged_total',
+    'Topics purged by the purge worker.')
+passes = metrics.counter('badmeter_purge_worker_passes_total',
+    'Full passes over the topics by the purge worker.')
+slice_seconds = metrics.histogram('badmeter_purge_worker_slice_seconds',
+    'Seconds per purge worker slice.')
+progress = metrics.gauge('badmeter_purge_worker_pass_progress',
+    'Share of the topic ids checked in the current pass.')
+lag = metrics.gauge('badmeter_purge_worker_lag_seconds',
+    'Seconds since the last full pass started, the longest a topic gone '
+    'stale may wait to be purged.')
+
+
+class PurgeSlice(object):
+    """
+    Outcome of one purge worker slice.
+    """
+    def __init__(self, topic_ids, batch, finished_pass, seconds):
+        self.topic_ids = topic_ids
+        self.batch = batch
+        self.finished_pass = finished_pass
+        self.seconds = seconds
+
+    @property
+    def purged(self):
+        return self.batch.topics if self.batch else 0
+
+
+class PurgeWorker(object):
+    """
+    Purge stale topics slice by slice from the saved cursor called name.
+    Each slice should take at most slice_seconds: run() starts one slice
+    per slice_seconds and halves the slice size while slices run over,
+    growing it back to slice_size when they are quick again. A
+    slice_seconds of 0 runs the slices back to back.
+    """
+    def __init__(self, name='purge_worker', slice_size=None, slice_seconds=None,
+            idle_seconds=None, now=None):
+        self.name = name
+        self.max_slice_size = slice_size or settings.PURGE_WORKER_SLICE_SIZE
+        self.slice_size = self.max_slice_size
+        self.slice_seconds = (settings.PURGE_WORKER_SLICE_SECONDS
+            if slice_seconds is None else slice_seconds)
+        self.idle_seconds = (settings.PURGE_WORKER_IDLE_SECONDS
+            if idle_seconds is None else idle_seconds)
+        self.now = now
+        self.cursor, created = PurgeCursor.objects.get_or_create(name=name,
+            defaults={'pass_started' : datetime.now()})
+        # Highest topic id when the pass started, the end of the progress
+        # gauge. Read once per pass rather than per slice.
+        self.pass_last_id = None
+
+    def lock(self):
+        """
+        Take the session advisory lock of the worker. Returns False if
+        another worker holds it.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_try_advisory_lock(hashtext(%s))',
+            ['badmeter_purge_worker_%s' % self.name])
+        return cursor.fetchone()[0]
+
+    def run_slice(self):
+        """
+        Purge the stale topics among the next slice_size topic ids and
+        save the cursor after them.
+        """
+        started = time.time()
+        topic_ids = list(Topic.objects.filter(id__gt=self.cursor.last_topic_id)
+            .order_by('id').values_list('id', flat=True)[:self.slice_size])
+        batch = purge_topics(topic_ids, self.now) if topic_ids else None
+
+        finished_pass = len(topic_ids) < self.slice_size
+        if finished_pass:
+            now = datetime.now()
+            self.cursor.last_pass_started = self.cursor.pass_started
+            self.cursor.last_pass_finished = now
+            self.cursor.pass_started = now
+            self.cursor.last_topic_id = 0
+            self.pass_last_id = None
+            connection.cursor().execute('SELECT trim_topic_events()')
+            passes.inc()
+        else:
+            self.cursor.last_topic_id = topic_ids[-1]
+        self.cursor.save()
+
+        seconds = time.time() - started
+        scanned.inc(len(topic_ids))
+        purged.inc(batch.topics if batch else 0)
+        slice_seconds.observe(seconds)
+        self.update_gauges()
+        return PurgeSlice(topic_ids, batch, finished_pass, seconds)
+
+    def update_gauges(self):
+        if self.pass_last_id is None:
+            self.pass_last_id = Topic.objects.aggregate(Max('id'))['id__max'] or 0
+        progress.set(min(1.0, self.cursor.last_topic_id / float(self.pass_last_id))
+            if self.pass_last_id else 1.0)
+        lag.set((datetime.now() - (self.cursor.last_pass_started
+            or self.cursor.pass_started)).total_seconds())
+
+    def run(self, slices=None):
+        """
+        Generator running slices, or forever when None, paced by
+        slice_seconds and idle_seconds, yielding a PurgeSlice for each.
+        """
+        count = 0
+        result = None
+        while slices is None or count < slices:
+            if result is not None:
+                self.pace(result)
+            result = self.run_slice()
+            count += 1
+            yield result
+
+    def pace(self, result):
+        """
+        Resize the slices and sleep out the time budget of the last one.
+        """
+        if not self.slice_seconds:
+            pass
+        elif result.seconds > self.slice_seconds:
+            self.slice_size = max(1, self.slice_size // 2)
+        elif result.seconds < self.slice_seconds / 4:
+            self.slice_size = min(self.max_slice_size, self.slice_size * 2)
+
+        if result.finished_pass:
+            time.sleep(self.idle_seconds)
+        else:
+            time.sleep(max(0, self.slice_seconds - result.seconds))
@@ -0,0 +1,62 @@
+from django.core.cache import caches
+from myproject import settings
+from .topic_index import normalize_title
+from . import metrics
+import hashlib
+
+# Shared result cache of the /search/ autocomplete.
+#
+# The jQuery autocomplete only caches per browser tab so every visitor
+# repeats the same prefixes. Answers are kept here in the SEARCH_CACHE
+# cache (settings.CACHES) for SEARCH_CACHE_SECONDS, keyed by the term
+# normalized as in the topic prefix index. Search is case-insensitive
+# so "Lazy" and "lazy  " share an entry.
+#
+# Adding or purging a topic changes the answer of every prefix of its
+# title, so those entries are deleted by Topic.save() and the purge
+# engine. With a per process backend, the other processes catch up when
+# their entries expire. A shared backend such as memcached sees every
+# invalidation.
+
+hits = metrics.counter('badmeter_search_cache_hits_total',
+    'Autocomplete searches answered from the search cache.')
+misses = metrics.counter('badmeter_search_cache_misses_total',
+    'Autocomplete searches that missed the search cache.')
+
+
+class SearchCache(object):
+    """
+    /search/ answers keyed by normalized term.
+    """
+    def __init__(self, cache_alias=None, timeout=None):
+        self.cache_alias = cache_alias or settings.SEARCH_CACHE
+        self.timeout = settings.SEARCH_CACHE_SECONDS if timeout is None else timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def key(self, term):
+        # Hashed so any term is a valid memcached key.
+        return 'search:%s' % hashlib.md5(normalize_title(term).encode('utf-8')).hexdigest()
+
+    def get(self, term):
+        rows = self.cache.get(self.key(term))
+        if rows is None:
+            misses.inc()
+        else:
+            hits.inc()
+        return rows
+
+    def set(self, term, rows):
+        self.cache.set(self.key(term), rows, self.timeout)
+
+    def invalidate_title(self, topic_title):
+        """
+        Delete the entries of all prefixes of a topic title.
+        """
+        title = normalize_title(topic_title)
+        self.cache.delete_many([self.key(title[:i]) for i in range(len(title) + 1)])
+
+
+search_cache = SearchCache()
@@ -32,7 +32,6 @@ CREATE OR REPLACE FUNCTION add_topic(
 AS $$
 DECLARE
     t_now timestamp;
-    t_badmeter_cookie_id int;
     t_badmeter_topic_id int;
 BEGIN
     -- Function get_timestamp() returns null if p_now has 
@@ -40,55 +39,41 @@ BEGIN
     SELECT COALESCE(get_timestamp(p_now), now())
         INTO t_now;
 
-    SELECT id
-        INTO t_badmeter_topic_id
-        FROM badmeter_topic
-        WHERE topic_slug = p_topic_slug;
-
-    -- Add topic if new. Note cookie_id initially NULL.
-    IF t_badmeter_topic_id IS NULL THEN
+    -- Add topic if new. Of racing adds of the same topic_slug only one
+    -- inserts, the unique slug makes the others wait for it and insert
+    -- nothing.
+    IF NOT EXISTS (SELECT 1 FROM badmeter_topic WHERE topic_slug = p_topic_slug) THEN
         INSERT INTO badmeter_topic (
                 topic_title, topic_slug, badmeter, votes_positive,
-                votes_negative, cookie_id, date_created, date_updated)
+                votes_negative, date_created, date_updated)
             VALUES (
                 p_topic_title, p_topic_slug, 50, 0,
-                0, NULL, t_now, t_now)
+                0, t_now, t_now)
+            ON CONFLICT (topic_slug) DO NOTHING
             -- Return newly inserted topic record id.
             RETURNING badmeter_topic.id INTO t_badmeter_topic_id;
+    END IF;
 
-        return_id := t_badmeter_topic_id;
-        status_message := 'badmeter_topic.id';
-    ELSE
+    IF t_badmeter_topic_id IS NULL THEN
         -- Already existing topic no record inserted.
         return_id := -1;
         status_message := 'Already existing topic no record inserted.';
-    END IF;
+    ELSE
+        return_id := t_badmeter_topic_id;
+        status_message := 'badmeter_topic.id';
 
-    -- Check if cookie exists. Note that badmeter_cookie stores counters on
-    -- a per cookie_string AND topic_id basis.
-    SELECT id
-        INTO t_badmeter_cookie_id
-        FROM badmeter_cookie
-        WHERE cookie_string = p_cookie_string
-            AND topic_id = t_badmeter_topic_id;
+        -- Keep record of which voter created this topic, only once the
+        -- topic is in so a lost race adds no voter. Its vote counters on
+        -- the topic wait for its first vote.
+        UPDATE badmeter_topic
+            SET voter_id = add_voter(p_cookie_string, t_now)
+            WHERE id = t_badmeter_topic_id;
 
-    -- Create the badmeter_cookie record if not existing.
-    IF t_badmeter_cookie_id IS NULL THEN
-        INSERT INTO badmeter_cookie (
-                cookie_string, votes_positive, votes_negative, date_created, date_updated, topic_id)
+        -- Log the new topic for the in-process search indexes.
+        INSERT INTO badmeter_topic_event (
+                topic_id, topic_title, topic_slug, event, date_created)
             VALUES (
-                p_cookie_string, 0, 0, t_now, t_now, t_badmeter_topic_id)
-            -- Grab newly inserted cookie record id.
-            RETURNING badmeter_cookie.id INTO t_badmeter_cookie_id;
+                t_badmeter_topic_id, p_topic_title, p_topic_slug, 'add', now());
     END IF;
-
-    -- Now go back to the badmeter_topic table just inserted above and
-    -- update the cookie_id. Keep record of which cookie created
-    -- this topic. Note that badmeter_topic & badmeter_cookie have cyclic
-    -- foreigh-key dependencies.
-    UPDATE badmeter_topic
-        SET cookie_id = t_badmeter_cookie_id
-        WHERE id = t_badmeter_topic_id
-            AND cookie_id IS NULL;
 END;
 $$ LANGUAGE plpgsql;
@@ -26,6 +26,17 @@ $$ LANGUAGE plpgsql;
 /*
     Overload add_vote function and add 'p_now' parameter.
     This is for testing purposes so we can feed it a custom date for testing.
+
+    The per cookie AND topic vote state (votes_total, counted, date_voted)
+    lives on the badmeter_cookie row, so the one-vote-per-day and
+    3-vote rules are checks on that one row instead of counts over
+    badmeter_vote. Votes are expected in time order per cookie.
+
+    Concurrent votes of a voter on a topic, e.g. a double submit handled
+    by two workers, queue on the lock of that row and each sees the
+    state the other left. The row itself is added with ON CONFLICT on
+    its unique (voter_id, topic_id) key, so racing first votes share one
+    row. No table locks are taken.
 */
 CREATE OR REPLACE FUNCTION add_vote(
     p_topic_slug text,
@@ -39,24 +50,26 @@ AS $$
 DECLARE
     t_badmeter_cookie_id int;
     t_badmeter_topic_id int;
+    t_badmeter_voter_id int;
+    t_counter_shards int;
+    t_shard int := 0;
     t_now timestamp;
 
-    t_positive int;
-    t_negative int;
-
-    t_positive_sum int;
-    t_negative_sum int;
-
-    t_diff int;
-    t_sum int;
-    t_badmeter int;
+    -- Deltas of counted positive & negative votes from this vote.
+    t_positive_sum int := 0;
+    t_negative_sum int := 0;
 
     t_vote boolean := p_vote::boolean;
+    t_counted boolean;
     t_badmeter_vote_count int;
+    t_date_voted timestamp;
+    t_cookie_date_created timestamp;
+    t_date_created timestamp;
+    t_previous_vote boolean;
 BEGIN
     -- Check if topic exists.
-    SELECT id
-        INTO t_badmeter_topic_id
+    SELECT id, counter_shards
+        INTO t_badmeter_topic_id, t_counter_shards
         FROM badmeter_topic
         WHERE topic_slug = p_topic_slug;
 
@@ -70,126 +83,138 @@ BEGIN
     SELECT COALESCE(get_timestamp(p_now), now())
         INTO t_now;
 
-    -- Check if cookie exists.
-    SELECT id
-        INTO t_badmeter_cookie_id
-        FROM badmeter_cookie
-        WHERE cookie_string = p_cookie_string
-            AND topic_id = t_badmeter_topic_id;
+    t_badmeter_voter_id := add_voter(p_cookie_string, t_now);
 
-    -- RAISE NOTICE 't_badmeter_cookie_id = %', t_badmeter_cookie_id;
+    -- A sharded topic keeps the counters of this voter's votes in one of
+    -- its counter rows, see topic_counters.sql.
+    IF t_counter_shards > 1 THEN
+        t_shard := mod(t_badmeter_voter_id, t_counter_shards);
+    END IF;
+
+    -- Check if the voter has counters on this topic. Lock them as they
+    -- hold the vote state.
+    SELECT id, votes_total, date_voted, date_created
+        INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_date_voted, t_cookie_date_created
+        FROM badmeter_cookie
+        WHERE voter_id = t_badmeter_voter_id
+            AND topic_id = t_badmeter_topic_id
+        FOR UPDATE;
 
-    -- Add to badmeter_cookie if cookie is new.
+    -- Add to badmeter_cookie on the first vote of the voter on this topic.
+    -- A racing first vote that added the row first leaves nothing to
+    -- insert; lock its row instead once it commits.
     IF t_badmeter_cookie_id IS NULL THEN
         INSERT INTO badmeter_cookie (
-                cookie_string, votes_positive, votes_negative, date_created, date_updated, topic_id)
+                voter_id, votes_positive, votes_negative, votes_total,
+                counted, date_voted, date_created, date_updated, topic_id)
             VALUES (
-                p_cookie_string, 0, 0, t_now, t_now, t_badmeter_topic_id)
+                t_badmeter_voter_id, 0, 0, 0,
+                FALSE, NULL, t_now, t_now, t_badmeter_topic_id)
+            ON CONFLICT (voter_id, topic_id) DO NOTHING
             -- Grab newly inserted cookie record id.
-            RETURNING badmeter_cookie.id INTO t_badmeter_cookie_id;
+            RETURNING badmeter_cookie.id, 0, badmeter_cookie.date_created
+                INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_cookie_date_created;
+    END IF;
+
+    IF t_badmeter_cookie_id IS NULL THEN
+        SELECT id, votes_total, date_voted, date_created
+            INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_date_voted, t_cookie_date_created
+            FROM badmeter_cookie
+            WHERE voter_id = t_badmeter_voter_id
+                AND topic_id = t_badmeter_topic_id
+            FOR UPDATE;
     END IF;
 
     -- Enforce one vote per day rule.
-    IF if_allow_add(t_badmeter_topic_id, t_badmeter_cookie_id, t_now::text) THEN
-        INSERT INTO badmeter_vote (
-                topic_id, cookie_id, comment, vote, date_created)
-            VALUES (
-                t_badmeter_topic_id, t_badmeter_cookie_id, p_comment, t_vote, t_now)
-            RETURNING badmeter_vote.id, 'badmeter_vote.id'::text
-                -- return_id should be >= 0 for normal save.
-                INTO return_id, status_message;
-
-        -- Count the total number of votes per this topic.
-        SELECT count(*)
-            INTO t_badmeter_vote_count
-            FROM badmeter_vote
-            WHERE topic_id = t_badmeter_topic_id
-                AND cookie_id = t_badmeter_cookie_id;
-
-        -- On the 3rd or more vote set counted = TRUE.
-        IF t_badmeter_vote_count = 3 THEN
-            UPDATE badmeter_vote SET counted = TRUE
-                WHERE topic_id = t_badmeter_topic_id
-                    AND cookie_id = t_badmeter_cookie_id;
+    IF date_trunc('day', t_date_voted) = date_trunc('day', t_now) THEN
+        return_id := -1;
+        status_message := 'You are limited to one vote per day per topic.';
+        RETURN;
+    END IF;
 
-            SELECT count(*)
-                INTO t_positive_sum
-                FROM badmeter_vote
-                WHERE topic_id = t_badmeter_topic_id
-                    AND cookie_id = t_badmeter_cookie_id
-                    AND vote IS TRUE
-                    AND counted IS TRUE;
+    -- The 3rd or more vote is counted.
+    t_badmeter_vote_count := t_badmeter_vote_count + 1;
+    IF t_badmeter_vote_count >= 3 THEN
+        t_counted := TRUE;
+        IF t_vote IS TRUE THEN
+            t_positive_sum := 1;
+        ELSE
+            t_negative_sum := 1;
+        END IF;
+    END IF;
+
+    INSERT INTO badmeter_vote (
+            topic_id, cookie_id, comment, vote, counted, date_created)
+        VALUES (
+            t_badmeter_topic_id, t_badmeter_cookie_id, p_comment, t_vote, t_counted, t_now)
+        RETURNING badmeter_vote.id, 'badmeter_vote.id'::text
+            -- return_id should be >= 0 for normal save.
+            INTO return_id, status_message;
+
+    -- Keep the badmeter_topic_daily rollup in step.
+    IF t_counted THEN
+        PERFORM topic_daily_add(t_badmeter_topic_id, t_now, 1, 0, t_shard);
+    ELSE
+        PERFORM topic_daily_add(t_badmeter_topic_id, t_now, 0, 1, t_shard);
+    END IF;
 
-            SELECT count(*)
-                INTO t_negative_sum
-                FROM badmeter_vote
+    -- On the 3rd vote the previous 1st & 2nd votes count too. They are
+    -- not older than the cookie row, which bounds the scan to the recent
+    -- monthly partitions of a partitioned badmeter_vote.
+    IF t_badmeter_vote_count = 3 THEN
+        FOR t_date_created, t_previous_vote IN
+            UPDATE badmeter_vote SET counted = TRUE
                 WHERE topic_id = t_badmeter_topic_id
                     AND cookie_id = t_badmeter_cookie_id
-                    AND vote IS NOT TRUE
-                    AND counted IS TRUE;
-
-            -- Update badmeter_topic & badmeter_cookie accordingly.
-            UPDATE badmeter_cookie
-                SET votes_positive = t_positive_sum,
-                    votes_negative = t_negative_sum
-                WHERE id = t_badmeter_cookie_id
-                    AND topic_id = t_badmeter_topic_id;
-
-            UPDATE badmeter_topic
-                SET votes_positive = (votes_positive + t_positive_sum),
-                    votes_negative = (votes_negative + t_negative_sum)
-                WHERE id = t_badmeter_topic_id
-                RETURNING votes_positive, votes_negative
-                    INTO t_positive, t_negative;
-
-        ELSIF t_badmeter_vote_count > 3 THEN
-            UPDATE badmeter_vote SET counted = TRUE
-                WHERE id = return_id;
-
-            -- Update badmeter_topic & badmeter_cookie accordingly.
-            IF t_vote IS TRUE THEN
-                UPDATE badmeter_topic
-                    SET votes_positive = (votes_positive + 1)
-                    WHERE id = t_badmeter_topic_id
-                    RETURNING votes_positive, votes_negative
-                        INTO t_positive, t_negative;
-
-                UPDATE badmeter_cookie
-                    SET votes_positive = (votes_positive + 1)
-                    WHERE id = t_badmeter_cookie_id
-                        AND topic_id = t_badmeter_topic_id;
+                    AND date_created >= t_cookie_date_created
+                    AND counted IS NOT TRUE
+                RETURNING date_created, vote
+        LOOP
+            PERFORM topic_daily_add(t_badmeter_topic_id, t_date_created, 1, -1, t_shard);
+            IF t_previous_vote IS TRUE THEN
+                t_positive_sum := t_positive_sum + 1;
             ELSE
-                UPDATE badmeter_topic
-                    SET votes_negative = (votes_negative + 1)
-                    WHERE id = t_badmeter_topic_id
-                    RETURNING votes_positive, votes_negative
-                        INTO t_positive, t_negative;
-
-                UPDATE badmeter_cookie
-                    SET votes_negative = (votes_negative + 1)
-                    WHERE id = t_badmeter_cookie_id
-                        AND topic_id = t_badmeter_topic_id;
+                t_negative_sum := t_negative_sum + 1;
             END IF;
-        END IF;
-
-        IF t_badmeter_vote_count >= 3 THEN
-            -- Compute & update badmeter value.
-            t_diff := t_positive - t_negative;
-            t_sum := t_positive + t_negative;
-            -- Prevent divide-by-zero error.
-            IF t_sum = 0 THEN
-                t_sum := 1;
-            END IF;
-            t_badmeter := 50 + floor((t_diff / t_sum::float) * 50);
+        END LOOP;
+    END IF;
 
-            UPDATE badmeter_topic
-                SET badmeter = t_badmeter,
-                    date_updated = t_now
-                WHERE id = t_badmeter_topic_id;
-        END IF;
-    ELSE
-        return_id := -1;
-        status_message := 'You are limited to one vote per day per topic.';
+    -- Update badmeter_cookie vote state & counters.
+    UPDATE badmeter_cookie
+        SET votes_total = t_badmeter_vote_count,
+            counted = (t_badmeter_vote_count >= 3),
+            date_voted = t_now,
+            votes_positive = (votes_positive + t_positive_sum),
+            votes_negative = (votes_negative + t_negative_sum)
+        WHERE id = t_badmeter_cookie_id;
+
+    -- Update badmeter_topic counters & compute the badmeter value.
+    -- date_updated is bumped by uncounted votes too since they show in
+    -- the vote list; it is the version of the cached topic page in
+    -- badmeter.stats_cache and of the vote page ETag. It takes the clock
+    -- time, not t_now, and at least 1 microsecond more than before, so
+    -- every vote changes it even within one transaction. A sharded topic
+    -- adds to its counter row instead, folded into badmeter_topic by
+    -- fold_topic_counters().
+    IF t_counter_shards > 1 THEN
+        INSERT INTO badmeter_topic_counter AS S (
+                topic_id, shard, votes_positive, votes_negative, date_updated)
+            VALUES (
+                t_badmeter_topic_id, t_shard, t_positive_sum, t_negative_sum, clock_timestamp())
+            ON CONFLICT (topic_id, shard) DO UPDATE
+                SET votes_positive = S.votes_positive + EXCLUDED.votes_positive,
+                    votes_negative = S.votes_negative + EXCLUDED.votes_negative,
+                    date_updated = greatest(S.date_updated + interval '1 microsecond',
+                        EXCLUDED.date_updated);
+        RETURN;
     END IF;
+
+    UPDATE badmeter_topic
+        SET votes_positive = (votes_positive + t_positive_sum),
+            votes_negative = (votes_negative + t_negative_sum),
+            badmeter = topic_badmeter(votes_positive + t_positive_sum,
+                votes_negative + t_negative_sum),
+            date_updated = greatest(date_updated + interval '1 microsecond', clock_timestamp())
+        WHERE id = t_badmeter_topic_id;
 END;
 $$ LANGUAGE plpgsql;
@@ -0,0 +1,46 @@
+-- The 16-byte md5 digest of a visitor id as kept in badmeter_voter.
+-- Same as badmeter.misc.voter_digest().
+CREATE OR REPLACE FUNCTION voter_digest(
+    p_cookie_string text
+)
+RETURNS bytea
+AS $$
+    SELECT decode(md5(p_cookie_string), 'hex');
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Return the badmeter_voter id of a visitor id, adding it if new. A
+-- request racing to add the same visitor id waits on the unique digest
+-- and then reads the row the other added. The voter row is locked FOR KEY
+-- SHARE until commit, so purge_voters() leaves it to the rows about to
+-- reference it. A voter purged in between is added again. Used by:
+--   add_topic()
+--   add_vote()
+CREATE OR REPLACE FUNCTION add_voter(
+    p_cookie_string text,
+    p_now timestamp
+)
+RETURNS int
+AS $$
+DECLARE
+    t_digest bytea := voter_digest(p_cookie_string);
+    t_badmeter_voter_id int;
+BEGIN
+    LOOP
+        SELECT id
+            INTO t_badmeter_voter_id
+            FROM badmeter_voter
+            WHERE digest = t_digest
+            FOR KEY SHARE;
+        EXIT WHEN t_badmeter_voter_id IS NOT NULL;
+
+        INSERT INTO badmeter_voter (digest, date_created)
+            VALUES (t_digest, p_now)
+            ON CONFLICT (digest) DO NOTHING
+            RETURNING badmeter_voter.id INTO t_badmeter_voter_id;
+        EXIT WHEN t_badmeter_voter_id IS NOT NULL;
+    END LOOP;
+
+    RETURN t_badmeter_voter_id;
+END;
+$$ LANGUAGE plpgsql;
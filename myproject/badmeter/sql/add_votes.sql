@@ -0,0 +1,298 @@
+-- Batched add_vote(). Takes parallel arrays, one element per vote, and
+-- applies the add_vote() rules to all of them set-based in one round
+-- trip and one transaction. Returns one row per vote, in input order,
+-- with the add_vote() return_id & status_message. A vote that add_vote()
+-- would fail on (an invalid vote value, no cookie string, no or a too
+-- long comment) gets return_id -1 and an error without failing the
+-- others. Used by:
+--   badmeter.models.Vote.save_many()
+--
+-- The votes of a voter on a topic are taken in input order, expected to
+-- be time order as for add_vote(). A vote on the day of the voter's
+-- previous vote on the topic, in the table or in the batch, is refused.
+-- When the vote total reaches 3 all the voter's votes on the topic
+-- count. Each voter, vote state row, daily rollup row and topic counter
+-- row is written once per batch, not once per vote. Vote state rows are
+-- locked in id order and topic rows after them, as add_vote() does.
+CREATE OR REPLACE FUNCTION add_votes(
+    p_topic_slugs text[],
+    p_cookie_strings text[],
+    p_comments text[],
+    p_votes text[],
+    p_nows text[]
+)
+RETURNS TABLE(
+    vote_order int,
+    return_id int,
+    status_message text
+) AS $$
+#variable_conflict use_column
+BEGIN
+    -- counter_shards is 0 for topics that are not sharded, so the
+    -- counter_shards <= 1 and > 1 filters below hold for NULL too.
+    CREATE TEMPORARY TABLE add_votes_batch ON COMMIT DROP AS
+        SELECT I.vote_order::int AS vote_order,
+                T.id AS topic_id,
+                COALESCE(T.counter_shards, 0) AS counter_shards,
+                voter_digest(I.cookie_string) AS digest,
+                I.comment,
+                CASE WHEN lower(btrim(I.vote)) IN ('t', 'true', 'y', 'yes', 'on', '1') THEN TRUE
+                    WHEN lower(btrim(I.vote)) IN ('f', 'false', 'n', 'no', 'off', '0') THEN FALSE
+                END AS vote,
+                -- NULL p_now falls back to now() as in add_vote().
+                COALESCE(get_timestamp(I.now), now())::timestamp AS date_created,
+                NULL::int AS cookie_id,
+                NULL::int AS cookie_votes_total,
+                NULL::timestamp AS cookie_date_created,
+                0 AS shard,
+                NULL::boolean AS accepted,
+                NULL::int AS votes_total,
+                NULL::boolean AS counted,
+                NULL::int AS return_id,
+                CASE WHEN I.vote IS NOT NULL
+                        AND lower(btrim(I.vote)) NOT IN ('t', 'true', 'y', 'yes', 'on', '1',
+                            'f', 'false', 'n', 'no', 'off', '0') THEN
+                        concat('Error: invalid input syntax for type boolean: "', I.vote, '"')
+                    WHEN T.id IS NULL THEN
+                        'Error: You Cannot vote on non-existing topic.'
+                    WHEN I.cookie_string IS NULL THEN
+                        'Error: A vote needs a cookie.'
+                    WHEN I.comment IS NULL OR length(I.comment) > 400 THEN
+                        'Error: A comment must have at most 400 characters.'
+                END AS status_message
+            FROM unnest(p_topic_slugs, p_cookie_strings, p_comments, p_votes, p_nows)
+                    WITH ORDINALITY AS I(topic_slug, cookie_string, comment, vote, now, vote_order)
+                LEFT JOIN badmeter_topic T
+                    ON T.topic_slug = I.topic_slug;
+
+    UPDATE add_votes_batch B
+        SET return_id = -1
+        WHERE B.status_message IS NOT NULL;
+
+    -- Voters and their vote state rows, added at their first vote in the
+    -- batch. Racing adds leave them to the other transaction. The voters
+    -- are locked FOR KEY SHARE as in add_voter(), and those purged in
+    -- between added again.
+    LOOP
+        INSERT INTO badmeter_voter (digest, date_created)
+            SELECT DISTINCT ON (B.digest) B.digest, B.date_created
+                FROM add_votes_batch B
+                WHERE B.status_message IS NULL
+                ORDER BY B.digest, B.vote_order
+            ON CONFLICT (digest) DO NOTHING;
+
+        PERFORM 1
+            FROM badmeter_voter W
+            WHERE W.digest IN (
+                    SELECT B.digest
+                        FROM add_votes_batch B
+                        WHERE B.status_message IS NULL)
+            ORDER BY W.id
+            FOR KEY SHARE;
+
+        EXIT WHEN NOT EXISTS (
+            SELECT 1
+                FROM add_votes_batch B
+                WHERE B.status_message IS NULL
+                    AND NOT EXISTS (SELECT 1 FROM badmeter_voter W WHERE W.digest = B.digest));
+    END LOOP;
+
+    INSERT INTO badmeter_cookie (
+            voter_id, votes_positive, votes_negative, votes_total,
+            counted, date_voted, date_created, date_updated, topic_id)
+        SELECT DISTINCT ON (W.id, B.topic_id)
+                W.id, 0, 0, 0, FALSE, NULL, B.date_created, B.date_created, B.topic_id
+            FROM add_votes_batch B, badmeter_voter W
+            WHERE B.status_message IS NULL
+                AND W.digest = B.digest
+            ORDER BY W.id, B.topic_id, B.vote_order
+        ON CONFLICT (voter_id, topic_id) DO NOTHING;
+
+    PERFORM 1
+        FROM badmeter_cookie C
+        WHERE (C.voter_id, C.topic_id) IN (
+                SELECT W.id, B.topic_id
+                    FROM add_votes_batch B, badmeter_voter W
+                    WHERE B.status_message IS NULL
+                        AND W.digest = B.digest)
+        ORDER BY C.id
+        FOR UPDATE;
+
+    -- With the vote state rows locked, a vote is accepted unless it falls
+    -- on the day of the voter's previous vote on the topic: the previous
+    -- one in the batch, or date_voted for the first. votes_total is the
+    -- voter's vote total on the topic after the batch.
+    UPDATE add_votes_batch B
+        SET cookie_id = S.cookie_id,
+            cookie_votes_total = S.cookie_votes_total,
+            cookie_date_created = S.cookie_date_created,
+            shard = S.shard,
+            accepted = S.accepted,
+            votes_total = S.votes_total
+        FROM (
+            SELECT A.*, A.cookie_votes_total
+                    + count(*) FILTER (WHERE A.accepted) OVER (PARTITION BY A.cookie_id) AS votes_total
+                FROM (
+                    SELECT B.vote_order, C.id AS cookie_id, C.votes_total AS cookie_votes_total,
+                            C.date_created::timestamp AS cookie_date_created,
+                            -- A sharded topic keeps the counters of this
+                            -- voter's votes in one of its counter rows.
+                            CASE WHEN B.counter_shards > 1 THEN mod(C.voter_id, B.counter_shards)
+                                ELSE 0 END AS shard,
+                            date_trunc('day', B.date_created) IS DISTINCT FROM date_trunc('day',
+                                COALESCE(lag(B.date_created) OVER (PARTITION BY C.id ORDER BY B.vote_order),
+                                    C.date_voted::timestamp)) AS accepted
+                        FROM add_votes_batch B, badmeter_voter W, badmeter_cookie C
+                        WHERE B.status_message IS NULL
+                            AND W.digest = B.digest
+                            AND C.voter_id = W.id
+                            AND C.topic_id = B.topic_id) A) S
+        WHERE S.vote_order = B.vote_order;
+
+    -- Accepted votes count when the vote total reached 3. Their ids are
+    -- taken in input order, as a loop over add_vote() would.
+    UPDATE add_votes_batch B
+        SET return_id = -1,
+            status_message = 'You are limited to one vote per day per topic.'
+        WHERE B.accepted IS FALSE;
+
+    UPDATE add_votes_batch B
+        SET counted = CASE WHEN B.votes_total >= 3 THEN TRUE END,
+            return_id = N.id,
+            status_message = 'badmeter_vote.id'
+        FROM (
+            SELECT A.vote_order, nextval('badmeter_vote_id_seq')::int AS id
+                FROM (
+                    SELECT vote_order
+                        FROM add_votes_batch
+                        WHERE accepted
+                        ORDER BY vote_order) A) N
+        WHERE N.vote_order = B.vote_order;
+
+    -- Counter deltas, one row per vote: the accepted votes and, of voters
+    -- whose 3rd vote is in the batch, their earlier uncounted votes now
+    -- counted. These are not older than the vote state row, which bounds
+    -- the scan to the recent monthly partitions of a partitioned
+    -- badmeter_vote.
+    CREATE TEMPORARY TABLE add_votes_delta ON COMMIT DROP AS
+        SELECT topic_id, counter_shards, cookie_id, shard, date_created,
+                CASE WHEN counted AND vote IS TRUE THEN 1 ELSE 0 END AS votes_positive,
+                CASE WHEN counted AND vote IS NOT TRUE THEN 1 ELSE 0 END AS votes_negative,
+                CASE WHEN counted THEN 1 ELSE 0 END AS votes_counted,
+                CASE WHEN counted THEN 0 ELSE 1 END AS votes_uncounted
+            FROM add_votes_batch
+            WHERE accepted;
+
+    WITH activated AS (
+        UPDATE badmeter_vote V
+            SET counted = TRUE
+            FROM (
+                SELECT DISTINCT topic_id, counter_shards, cookie_id, shard, cookie_date_created
+                    FROM add_votes_batch
+                    WHERE accepted
+                        AND cookie_votes_total < 3
+                        AND votes_total >= 3) A
+            WHERE V.topic_id = A.topic_id
+                AND V.cookie_id = A.cookie_id
+                AND V.date_created >= A.cookie_date_created
+                AND V.counted IS NOT TRUE
+            RETURNING V.topic_id, A.counter_shards, V.cookie_id, A.shard, V.date_created, V.vote)
+    INSERT INTO add_votes_delta
+        SELECT topic_id, counter_shards, cookie_id, shard, date_created::timestamp,
+                CASE WHEN vote IS TRUE THEN 1 ELSE 0 END,
+                CASE WHEN vote IS NOT TRUE THEN 1 ELSE 0 END,
+                1, -1
+            FROM activated;
+
+    INSERT INTO badmeter_vote (
+            id, topic_id, cookie_id, comment, vote, counted, date_created)
+        SELECT return_id, topic_id, cookie_id, comment, vote, counted, date_created
+            FROM add_votes_batch
+            WHERE accepted
+            ORDER BY vote_order;
+
+    -- Keep the badmeter_topic_daily rollup in step, see topic_daily_add().
+    INSERT INTO badmeter_topic_daily AS D (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        SELECT topic_id, date_created::date, shard, sum(votes_counted),
+                sum(CASE WHEN date_created = date_trunc('day', date_created)
+                    THEN votes_counted ELSE 0 END),
+                sum(votes_uncounted)
+            FROM add_votes_delta
+            GROUP BY topic_id, date_created::date, shard
+            ORDER BY topic_id, date_created::date, shard
+        ON CONFLICT (topic_id, day, shard) DO UPDATE
+            SET votes_counted = D.votes_counted + EXCLUDED.votes_counted,
+                votes_counted_midnight = D.votes_counted_midnight + EXCLUDED.votes_counted_midnight,
+                votes_uncounted = D.votes_uncounted + EXCLUDED.votes_uncounted;
+
+    -- Update badmeter_cookie vote state & counters. date_voted is the
+    -- date of the last accepted vote.
+    UPDATE badmeter_cookie C
+        SET votes_total = A.votes_total,
+            counted = (A.votes_total >= 3),
+            date_voted = A.date_voted,
+            votes_positive = (C.votes_positive + S.votes_positive),
+            votes_negative = (C.votes_negative + S.votes_negative)
+        FROM (
+                SELECT cookie_id, max(votes_total) AS votes_total,
+                        (array_agg(date_created ORDER BY vote_order DESC))[1] AS date_voted
+                    FROM add_votes_batch
+                    WHERE accepted
+                    GROUP BY cookie_id) A,
+            (
+                SELECT cookie_id, sum(votes_positive)::int AS votes_positive,
+                        sum(votes_negative)::int AS votes_negative
+                    FROM add_votes_delta
+                    GROUP BY cookie_id) S
+        WHERE C.id = A.cookie_id
+            AND S.cookie_id = A.cookie_id;
+
+    -- Update badmeter_topic counters & compute the badmeter value, or the
+    -- counter rows of sharded topics. date_updated moves forward as in
+    -- add_vote().
+    PERFORM 1
+        FROM badmeter_topic T
+        WHERE T.id IN (
+                SELECT topic_id
+                    FROM add_votes_delta
+                    WHERE counter_shards <= 1)
+        ORDER BY T.id
+        FOR UPDATE;
+
+    UPDATE badmeter_topic T
+        SET votes_positive = (T.votes_positive + S.votes_positive),
+            votes_negative = (T.votes_negative + S.votes_negative),
+            badmeter = topic_badmeter(T.votes_positive + S.votes_positive,
+                T.votes_negative + S.votes_negative),
+            date_updated = greatest(T.date_updated + interval '1 microsecond', clock_timestamp())
+        FROM (
+            SELECT topic_id, sum(votes_positive)::int AS votes_positive,
+                    sum(votes_negative)::int AS votes_negative
+                FROM add_votes_delta
+                WHERE counter_shards <= 1
+                GROUP BY topic_id) S
+        WHERE T.id = S.topic_id;
+
+    INSERT INTO badmeter_topic_counter AS S (
+            topic_id, shard, votes_positive, votes_negative, date_updated)
+        SELECT topic_id, shard, sum(votes_positive), sum(votes_negative), clock_timestamp()
+            FROM add_votes_delta
+            WHERE counter_shards > 1
+            GROUP BY topic_id, shard
+            ORDER BY topic_id, shard
+        ON CONFLICT (topic_id, shard) DO UPDATE
+            SET votes_positive = S.votes_positive + EXCLUDED.votes_positive,
+                votes_negative = S.votes_negative + EXCLUDED.votes_negative,
+                date_updated = greatest(S.date_updated + interval '1 microsecond',
+                    EXCLUDED.date_updated);
+
+    RETURN QUERY
+        SELECT vote_order, return_id, status_message
+            FROM add_votes_batch
+            ORDER BY vote_order;
+
+    DROP TABLE add_votes_batch;
+    DROP TABLE add_votes_delta;
+END;
+$$ LANGUAGE plpgsql;
@@ -17,3 +17,7 @@ BEGIN
             vote_quota;
 END;
 $$ LANGUAGE plpgsql;
+
+-- Tell the configuration caches of running Django processes to reload.
+-- See badmeter/configuration.py.
+NOTIFY badmeter_configuration;
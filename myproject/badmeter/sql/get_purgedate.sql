@@ -15,6 +15,22 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+-- Same by topic id, for callers that already resolved the slug.
+CREATE OR REPLACE FUNCTION get_purgedate(
+    p_topic_id int,
+    OUT purge_date text,
+    OUT vote_needed text)
+AS $$
+BEGIN
+    SELECT *
+        INTO purge_date, vote_needed
+        FROM get_purgedate(
+            p_topic_id,
+            now()::text);
+END;
+$$ LANGUAGE plpgsql;
+
+
 -- Overload function get_purgedate adding a timestamp parameter.
 CREATE OR REPLACE FUNCTION get_purgedate(
     p_topic_slug text,
@@ -22,15 +38,57 @@ CREATE OR REPLACE FUNCTION get_purgedate(
     OUT purge_date text,
     OUT vote_needed text)
 AS $$
+DECLARE
+    t_badmeter_topic_id integer;
+BEGIN
+    SELECT id
+        INTO t_badmeter_topic_id
+        FROM badmeter_topic
+        WHERE topic_slug = p_topic_slug;
+
+    SELECT *
+        INTO purge_date, vote_needed
+        FROM get_purgedate(
+            t_badmeter_topic_id,
+            p_now);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- The id based get_purgedate() doing the work.
+--
+-- The purge date is the end of the first interval_days window, sliding
+-- forward one day at a time from today, that holds less than vote_quota
+-- counted votes. Counted votes per day are read from the
+-- badmeter_topic_daily rollup, summed over its shards, and the window is
+-- then slid over them.
+-- Windows include both their start and end timestamps so votes cast
+-- exactly at midnight are tallied separately for the window ending on
+-- that day.
+CREATE OR REPLACE FUNCTION get_purgedate(
+    p_topic_id int,
+    p_now text,
+    OUT purge_date text,
+    OUT vote_needed text)
+AS $$
 DECLARE
     t_now timestamp;
     t_badmeter_topic_id integer;
     t_start timestamp;
     t_end timestamp;
     t_count int;
-    t_oneday interval := interval '1 day';
     t_interval interval;
     t_quota int;
+    t_days int;
+    t_day int;
+    t_offset int;
+    t_votes int;
+    t_midnight_votes int;
+    t_window_votes int := 0;
+    -- Counted votes per day, and those cast exactly at midnight,
+    -- indexed by days since the first window start.
+    t_day_votes int[] := '{}';
+    t_day_midnight_votes int[] := '{}';
 BEGIN
     -- Get application configuration from central location
     -- in get_configuration().
@@ -45,7 +103,13 @@ BEGIN
     SELECT id, date_created
         INTO t_badmeter_topic_id, t_start
         FROM badmeter_topic
-        WHERE topic_slug = p_topic_slug;
+        WHERE id = p_topic_id;
+
+    IF t_badmeter_topic_id IS NULL THEN
+        -- Non-existing topic has no purge date.
+        vote_needed := t_quota::text;
+        RETURN;
+    END IF;
 
     t_start := date_trunc('day', t_start);
 
@@ -58,29 +122,43 @@ BEGIN
         t_start := t_end - t_interval;
     END IF;
 
-    LOOP
-        RAISE NOTICE 't_start=%',t_start;
-        RAISE NOTICE 't_end=%',t_end;
+    t_days := date_part('day', t_interval)::int;
 
-        -- Count the number of votes during the interval_days period.
-        SELECT count(*)
-            INTO t_count
-            FROM badmeter_vote
-            WHERE date_created >= t_start
-                AND date_created <= t_end
-                AND counted IS TRUE
-                AND topic_id = t_badmeter_topic_id;
+    -- Single pass over the daily rollup of all windows still to come.
+    FOR t_offset, t_votes, t_midnight_votes IN
+        SELECT (day - t_start::date), sum(votes_counted), sum(votes_counted_midnight)
+            FROM badmeter_topic_daily
+            WHERE day >= t_start::date
+                AND topic_id = t_badmeter_topic_id
+            GROUP BY day
+            ORDER BY day
+    LOOP
+        t_day_votes[t_offset] := t_votes;
+        t_day_midnight_votes[t_offset] := t_midnight_votes;
+        IF t_offset < t_days THEN
+            t_window_votes := t_window_votes + t_votes;
+        END IF;
+    END LOOP;
 
-        RAISE NOTICE 't_count=%',t_count;
+    -- Slide the window one day at a time. t_window_votes holds the
+    -- votes of days [t_day, t_day + t_days) and the window also takes
+    -- the midnight votes of its end day.
+    t_day := 0;
+    LOOP
+        t_count := t_window_votes + COALESCE(t_day_midnight_votes[t_day + t_days], 0);
 
         -- If there are not enough votes exit & return the end date.
         EXIT WHEN (t_count < t_quota);
 
         -- Try again on the next interval_days period.
-        t_end := t_end + t_oneday;
-        t_start := t_end - t_interval;
+        t_window_votes := t_window_votes
+            + COALESCE(t_day_votes[t_day + t_days], 0)
+            - COALESCE(t_day_votes[t_day], 0);
+        t_day := t_day + 1;
     END LOOP;
 
+    t_end := t_end + t_day * interval '1 day';
+
     purge_date := to_char(t_end, 'FMMon. DD, YYYY');
     vote_needed := (t_quota - t_count)::text;
 END;
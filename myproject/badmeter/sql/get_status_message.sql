@@ -5,40 +5,58 @@ CREATE OR REPLACE FUNCTION get_status_message(
     OUT status_message text
 ) AS $$
 DECLARE
-    t_badmeter_vote_count int;
     t_badmeter_cookie_id int;
     t_badmeter_topic_id int;
 BEGIN
-    -- Check if topic exists.
     SELECT id
         INTO t_badmeter_topic_id
         FROM badmeter_topic
         WHERE topic_slug = p_topic_slug;
 
-    -- ~ RAISE NOTICE 't_badmeter_topic_id = %', t_badmeter_topic_id;
-    IF t_badmeter_topic_id IS NULL THEN
+    SELECT C.id
+        INTO t_badmeter_cookie_id
+        FROM badmeter_cookie C, badmeter_voter W
+        WHERE W.digest = voter_digest(p_cookie_string)
+            AND C.voter_id = W.id
+            AND C.topic_id = t_badmeter_topic_id;
+
+    SELECT S.status_message
+        INTO status_message
+        FROM get_status_message(t_badmeter_topic_id, t_badmeter_cookie_id) S;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Same by topic and cookie id, for callers that already resolved them.
+-- A NULL p_cookie_id is a cookie that has not voted on the topic.
+-- Used by:
+--   get_visitor_state()
+CREATE OR REPLACE FUNCTION get_status_message(
+    p_topic_id int,
+    p_cookie_id int,
+    OUT status_message text
+) AS $$
+DECLARE
+    t_badmeter_vote_count int;
+    t_badmeter_cookie_id int;
+    t_date_voted timestamp;
+BEGIN
+    -- ~ RAISE NOTICE 'p_topic_id = %', p_topic_id;
+    IF p_topic_id IS NULL THEN
         status_message := 'Non-existing topic. Enter new topic above in "Search/New Topic".';
         -- Makes no sense to continue with a non-existing topic.
         RETURN;
     END IF;
 
-    -- Check if cookie exists.
-    SELECT id
-        INTO t_badmeter_cookie_id
+    -- Check if cookie exists. It keeps the vote count of this topic.
+    SELECT id, COALESCE(votes_total, 0), date_voted
+        INTO t_badmeter_cookie_id, t_badmeter_vote_count, t_date_voted
         FROM badmeter_cookie
-        WHERE cookie_string = p_cookie_string
-            AND topic_id = t_badmeter_topic_id;
+        WHERE id = p_cookie_id;
 
     IF t_badmeter_cookie_id IS NULL THEN
         -- This cookie could not have voted since it does not exist in badmeter_cookie table.
         t_badmeter_vote_count := 0;
-    ELSE
-        -- Count the total number of votes per this topic.
-        SELECT count(*)
-            INTO t_badmeter_vote_count
-            FROM badmeter_vote
-            WHERE topic_id = t_badmeter_topic_id
-                AND cookie_id = t_badmeter_cookie_id;
     END IF;
 
     IF t_badmeter_vote_count = 0 THEN
@@ -48,7 +66,7 @@ BEGIN
     END IF;
 
     -- Enforce one vote per day per topic rule.
-    IF if_allow_add(t_badmeter_topic_id, t_badmeter_cookie_id) THEN
+    IF t_date_voted IS NULL OR date_trunc('day', t_date_voted) <> date_trunc('day', now()) THEN
         status_message := concat(status_message, 'You can vote today. ');
     ELSE
         status_message := concat(status_message, 'You have already voted today. ');
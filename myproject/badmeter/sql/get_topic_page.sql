@@ -0,0 +1,104 @@
+
+-- The visitor independent part of the vote page: topic stats, purge date
+-- and the first p_limit votes. badmeter.stats_cache keeps it per topic,
+-- versioned by topic_date_updated which add_vote() bumps. Used by:
+--   get_vote_page()
+--   badmeter.stats_cache.TopicStatsCache.refresh()
+--
+-- The topic and purge date columns are repeated on each row; the vote
+-- columns hold one row of list_votes() each. A topic without votes still
+-- returns one row with NULL vote columns.
+CREATE OR REPLACE FUNCTION get_topic_page(
+    p_topic_slug text,
+    p_limit int
+)
+RETURNS TABLE(
+    topic_title text,
+    topic_slug text,
+    topic_badmeter numeric,
+    topic_votes_positive int,
+    topic_votes_negative int,
+    topic_date_created timestamp,
+    topic_date_updated timestamp,
+    purge_date text,
+    vote_needed text,
+    vote_id int,
+    vote_counted boolean,
+    vote_cookie_string text,
+    vote_comment text,
+    vote_vote boolean,
+    vote_date_created timestamp with time zone,
+    vote_votes_negative int,
+    vote_votes_positive int
+) AS $$
+DECLARE
+    t_badmeter_topic_id int;
+BEGIN
+    SELECT A.id
+        INTO t_badmeter_topic_id
+        FROM badmeter_topic A
+        WHERE A.topic_slug = p_topic_slug;
+
+    RETURN QUERY
+        SELECT * FROM get_topic_page(t_badmeter_topic_id, p_limit);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Same by topic id, for callers that already resolved the slug. Used by:
+--   get_vote_page()
+--   badmeter.stats_cache.TopicStatsCache.get_vote_page()
+CREATE OR REPLACE FUNCTION get_topic_page(
+    p_topic_id int,
+    p_limit int
+)
+RETURNS TABLE(
+    topic_title text,
+    topic_slug text,
+    topic_badmeter numeric,
+    topic_votes_positive int,
+    topic_votes_negative int,
+    topic_date_created timestamp,
+    topic_date_updated timestamp,
+    purge_date text,
+    vote_needed text,
+    vote_id int,
+    vote_counted boolean,
+    vote_cookie_string text,
+    vote_comment text,
+    vote_vote boolean,
+    vote_date_created timestamp with time zone,
+    vote_votes_negative int,
+    vote_votes_positive int
+) AS $$
+BEGIN
+    -- The counters of a sharded topic are folded on read.
+    SELECT A.topic_title, A.topic_slug, S.badmeter, S.votes_positive,
+            S.votes_negative, A.date_created, S.date_updated
+        INTO topic_title, topic_slug, topic_badmeter, topic_votes_positive,
+            topic_votes_negative, topic_date_created, topic_date_updated
+        FROM badmeter_topic A, topic_counters(A.id) S
+        WHERE A.id = p_topic_id;
+
+    SELECT P.purge_date, P.vote_needed
+        INTO purge_date, vote_needed
+        FROM get_purgedate(p_topic_id) P;
+
+    -- New topic so no purge-date yet then just get from configuration setting.
+    IF purge_date IS NULL THEN
+        SELECT G.interval_days::text, G.vote_quota::text
+            INTO purge_date, vote_needed
+            FROM get_configuration() G;
+    END IF;
+
+    RETURN QUERY
+        SELECT topic_title, topic_slug, topic_badmeter,
+            topic_votes_positive, topic_votes_negative,
+            topic_date_created, topic_date_updated,
+            purge_date, vote_needed,
+            V.id, V.counted, V.cookie_string, V.comment, V.vote,
+            V.date_created, V.votes_negative, V.votes_positive
+        FROM (SELECT 1) X
+            LEFT JOIN list_votes(p_topic_id, NULL, NULL, p_limit) V ON TRUE;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,45 @@
+-- get_visitor_state() gained the topic_id and cookie_id columns.
+DROP FUNCTION IF EXISTS get_visitor_state(text, text);
+
+-- The visitor dependent part of the vote page, light enough to run on
+-- every request: the cookie stats and status message, plus the topic
+-- date_updated that tells whether a cached get_topic_page() is current.
+-- topic_date_updated is NULL for a non-existing topic.
+--
+-- The slug and cookie string are resolved here once. topic_id and
+-- cookie_id are returned so the rest of the request calls the id based
+-- functions instead of looking them up again. cookie_id is NULL for a
+-- cookie that has not voted on the topic. Used by:
+--   get_vote_page()
+--   badmeter.stats_cache.TopicStatsCache.get_visitor_state()
+CREATE OR REPLACE FUNCTION get_visitor_state(
+    p_topic_slug text,
+    p_cookie_string text,
+    OUT topic_id int,
+    OUT cookie_id int,
+    OUT topic_date_updated timestamp,
+    OUT cookie_votes_positive int,
+    OUT cookie_votes_negative int,
+    OUT cookie_date_created timestamp,
+    OUT status_message text
+) AS $$
+BEGIN
+    SELECT A.id, greatest(A.date_updated, (SELECT max(S.date_updated)
+                FROM badmeter_topic_counter S
+                WHERE S.topic_id = A.id))
+        INTO topic_id, topic_date_updated
+        FROM badmeter_topic A
+        WHERE A.topic_slug = p_topic_slug;
+
+    SELECT C.id, C.votes_positive, C.votes_negative, C.date_created
+        INTO cookie_id, cookie_votes_positive, cookie_votes_negative, cookie_date_created
+        FROM badmeter_cookie C, badmeter_voter W
+        WHERE W.digest = voter_digest(p_cookie_string)
+            AND C.voter_id = W.id
+            AND C.topic_id = get_visitor_state.topic_id;
+
+    SELECT S.status_message
+        INTO status_message
+        FROM get_status_message(topic_id, cookie_id) S;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,61 @@
+
+DROP FUNCTION IF EXISTS get_vote_page(text, text);
+DROP FUNCTION IF EXISTS get_vote_page(text, text, int);
+
+-- Everything needed to render the stats table and the first p_limit
+-- votes of a topic page in one round trip: get_visitor_state() joined
+-- to get_topic_page() by the topic id it resolved, plus the topic_id and
+-- cookie_id for the rest of the request. Used on a topic stats cache
+-- miss by:
+--   badmeter.stats_cache.TopicStatsCache.get_vote_page()
+--
+-- The topic, cookie, purge date and status columns are repeated on each
+-- row; the vote columns hold one row of list_votes() each. A topic
+-- without votes still returns one row with NULL vote columns.
+CREATE OR REPLACE FUNCTION get_vote_page(
+    p_topic_slug text,
+    p_cookie_string text,
+    p_limit int
+)
+RETURNS TABLE(
+    topic_title text,
+    topic_slug text,
+    topic_badmeter numeric,
+    topic_votes_positive int,
+    topic_votes_negative int,
+    topic_date_created timestamp,
+    topic_date_updated timestamp,
+    cookie_votes_positive int,
+    cookie_votes_negative int,
+    cookie_date_created timestamp,
+    purge_date text,
+    vote_needed text,
+    status_message text,
+    topic_id int,
+    cookie_id int,
+    vote_id int,
+    vote_counted boolean,
+    vote_cookie_string text,
+    vote_comment text,
+    vote_vote boolean,
+    vote_date_created timestamp with time zone,
+    vote_votes_negative int,
+    vote_votes_positive int
+) AS $$
+DECLARE
+    S record;
+BEGIN
+    SELECT * INTO S FROM get_visitor_state(p_topic_slug, p_cookie_string);
+
+    RETURN QUERY
+        SELECT T.topic_title, T.topic_slug, T.topic_badmeter,
+            T.topic_votes_positive, T.topic_votes_negative,
+            T.topic_date_created, T.topic_date_updated,
+            S.cookie_votes_positive, S.cookie_votes_negative, S.cookie_date_created,
+            T.purge_date, T.vote_needed, S.status_message,
+            S.topic_id, S.cookie_id,
+            T.vote_id, T.vote_counted, T.vote_cookie_string, T.vote_comment, T.vote_vote,
+            T.vote_date_created, T.vote_votes_negative, T.vote_votes_positive
+        FROM get_topic_page(S.topic_id, p_limit) T;
+END;
+$$ LANGUAGE plpgsql;
@@ -1,5 +1,7 @@
 
--- Used to enforce one vote per day rule.
+-- Used to enforce one vote per day rule. This is a read without locks,
+-- a vote racing the check can still pass it. add_vote() applies the rule
+-- itself on the locked badmeter_cookie row.
 CREATE OR REPLACE FUNCTION if_allow_add(
     p_badmeter_topic_id int,
     p_badmeter_cookie_id int
@@ -19,6 +21,7 @@ $$ LANGUAGE plpgsql;
 /*
     Overload if_allow_add function and add 'p_now' parameter.
     This is for testing purposes so we can feed it a custom date for testing.
+    Reads the date of the last vote kept on the badmeter_cookie row.
 */
 CREATE OR REPLACE FUNCTION if_allow_add(
     p_badmeter_topic_id int,
@@ -29,24 +32,18 @@ RETURNS boolean
 AS $$
 DECLARE
     t_now timestamp;
-    t_now_start timestamp;
-    t_now_end timestamp;
-    t_badmeter_vote_count int;
+    t_date_voted timestamp;
 BEGIN
     SELECT COALESCE(get_timestamp(p_now), now())
         INTO t_now;
 
-    t_now_start := date_trunc('day', t_now);
-    t_now_end := t_now_start + interval '1 day';
+    SELECT date_voted
+        INTO t_date_voted
+        FROM badmeter_cookie
+        WHERE id = p_badmeter_cookie_id
+            AND topic_id = p_badmeter_topic_id;
 
-    SELECT count(*)
-        INTO t_badmeter_vote_count
-        FROM badmeter_vote
-        WHERE topic_id = p_badmeter_topic_id
-            AND cookie_id = p_badmeter_cookie_id
-            AND date_created >= t_now_start
-            AND date_created < t_now_end;
-
-    RETURN (t_badmeter_vote_count = 0);
+    RETURN (t_date_voted IS NULL
+        OR date_trunc('day', t_date_voted) <> date_trunc('day', t_now));
 END;
 $$ LANGUAGE plpgsql;
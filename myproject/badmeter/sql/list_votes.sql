@@ -1,28 +1,91 @@
 
+-- The text returning list_votes(p_topic_slug) is replaced by the keyset
+-- paginated version below, as are the versions paging by vote id only.
+DROP FUNCTION IF EXISTS list_votes(text);
+DROP FUNCTION IF EXISTS list_votes(text, int, int);
+DROP FUNCTION IF EXISTS list_votes(int, int, int);
+
+-- List up to p_limit votes of a topic, newest first, older than the vote
+-- (p_before_date, p_before_id), or the newest ones when p_before_id is
+-- NULL. Keyset pagination on (date_created, id) keeps deep pages as cheap
+-- as the first one. The page carries the date_created of its last vote,
+-- so a partitioned badmeter_vote only scans the partitions up to it and
+-- a purged last vote still leads to the next page. cookie_string is the
+-- voter digest in hex. Used by:
+--   badmeter.views.votes_json()
 CREATE OR REPLACE FUNCTION list_votes(
-    p_topic_slug text
+    p_topic_slug text,
+    p_before_date timestamp with time zone,
+    p_before_id int,
+    p_limit int
 )
 RETURNS TABLE(
-    id text,
-    counted text,
+    id int,
+    counted boolean,
     cookie_string text,
     comment text,
-    vote text,
-    date_created text,
+    vote boolean,
+    date_created timestamp with time zone,
     votes_negative int,
     votes_positive int
 ) AS $$
+DECLARE
+    t_badmeter_topic_id int;
 BEGIN
+    SELECT B.id
+        INTO t_badmeter_topic_id
+        FROM badmeter_topic B
+        WHERE B.topic_slug = p_topic_slug;
+
     RETURN QUERY
-        SELECT A.id::text, A.counted::text,
-            C.cookie_string::text, A.comment::text, A.vote::text,
-            to_char(A.date_created, 'FMMonth DD, YYYY HH:MI:SS'),
-            C.votes_negative, C.votes_positive
-        FROM badmeter_vote A, badmeter_topic B, badmeter_cookie C
-        WHERE A.topic_id = B.id
-            AND A.cookie_id = C.id
-            AND B.topic_slug = p_topic_slug
-        ORDER BY A.date_created DESC
-        LIMIT 100 OFFSET 0;
+        SELECT * FROM list_votes(t_badmeter_topic_id, p_before_date, p_before_id, p_limit);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Same by topic id, for callers that already resolved the slug. Used by:
+--   get_topic_page()
+CREATE OR REPLACE FUNCTION list_votes(
+    p_topic_id int,
+    p_before_date timestamp with time zone,
+    p_before_id int,
+    p_limit int
+)
+RETURNS TABLE(
+    id int,
+    counted boolean,
+    cookie_string text,
+    comment text,
+    vote boolean,
+    date_created timestamp with time zone,
+    votes_negative int,
+    votes_positive int
+) AS $$
+DECLARE
+    t_badmeter_topic_id int := p_topic_id;
+BEGIN
+    IF p_before_id IS NULL THEN
+        RETURN QUERY
+            SELECT A.id, A.counted, encode(W.digest, 'hex'), A.comment::text,
+                A.vote, A.date_created, C.votes_negative, C.votes_positive
+            FROM badmeter_vote A, badmeter_cookie C, badmeter_voter W
+            WHERE A.topic_id = t_badmeter_topic_id
+                AND A.cookie_id = C.id
+                AND C.voter_id = W.id
+            ORDER BY A.date_created DESC, A.id DESC
+            LIMIT p_limit;
+    ELSE
+        RETURN QUERY
+            SELECT A.id, A.counted, encode(W.digest, 'hex'), A.comment::text,
+                A.vote, A.date_created, C.votes_negative, C.votes_positive
+            FROM badmeter_vote A, badmeter_cookie C, badmeter_voter W
+            WHERE A.topic_id = t_badmeter_topic_id
+                AND A.date_created <= p_before_date
+                AND (A.date_created, A.id) < (p_before_date, p_before_id)
+                AND A.cookie_id = C.id
+                AND C.voter_id = W.id
+            ORDER BY A.date_created DESC, A.id DESC
+            LIMIT p_limit;
+    END IF;
 END;
 $$ LANGUAGE plpgsql;
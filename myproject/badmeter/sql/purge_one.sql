@@ -25,22 +25,109 @@ CREATE OR REPLACE FUNCTION purge_one(
 RETURNS void
 AS $$
 BEGIN
-    -- Delete records in badmeter_vote.
-    DELETE FROM badmeter_vote
-        WHERE topic_id = p_badmeter_topic_id;
-
-    -- Remove badmeter_topic foreignkey dependence on badmeter_cookie.
-    -- This is so we can delete records in badmeter_cookie.
-    UPDATE badmeter_topic
-        SET cookie_id = NULL
-        WHERE id = p_badmeter_topic_id;
-
-    -- Delete records in badmeter_cookie.
-    DELETE FROM badmeter_cookie
-        WHERE topic_id = p_badmeter_topic_id;
-
-    -- Delete records in badmeter_topic.
-    DELETE FROM badmeter_topic
-        WHERE id = p_badmeter_topic_id;
+    PERFORM purge_many(ARRAY[p_badmeter_topic_id]);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Purge a set of topics given their topic_id's in one statement.
+-- Voters left with no other topic go too, see purge_voters(). Returns one
+-- row per purged topic with its deleted vote and cookie counts. Used by:
+--   purge_one()
+--   purge_scan()
+--   badmeter.purge.purge_stale_topics()
+CREATE OR REPLACE FUNCTION purge_many(
+    p_topic_ids int[]
+)
+RETURNS TABLE(
+    topic_id int,
+    topic_slug text,
+    topic_title text,
+    vote_count int,
+    cookie_count int
+) AS $$
+DECLARE
+    t_voter_ids int[];
+BEGIN
+    SELECT array_agg(X.voter_id)
+        INTO t_voter_ids
+        FROM (
+            SELECT C.voter_id FROM badmeter_cookie C WHERE C.topic_id = ANY(p_topic_ids)
+            UNION
+            SELECT T.voter_id FROM badmeter_topic T WHERE T.id = ANY(p_topic_ids)) X;
+
+    -- Django creates the foreign keys DEFERRABLE INITIALLY DEFERRED so
+    -- all records can go in one statement and are checked at commit.
+    RETURN QUERY
+        WITH daily AS (
+            DELETE FROM badmeter_topic_daily D
+                WHERE D.topic_id = ANY(p_topic_ids)),
+        counters AS (
+            DELETE FROM badmeter_topic_counter S
+                WHERE S.topic_id = ANY(p_topic_ids)),
+        votes AS (
+            DELETE FROM badmeter_vote V
+                WHERE V.topic_id = ANY(p_topic_ids)
+                RETURNING V.topic_id),
+        cookies AS (
+            DELETE FROM badmeter_cookie C
+                WHERE C.topic_id = ANY(p_topic_ids)
+                RETURNING C.topic_id),
+        topics AS (
+            DELETE FROM badmeter_topic T
+                WHERE T.id = ANY(p_topic_ids)
+                RETURNING T.id, T.topic_slug, T.topic_title),
+        -- Log the purge for the in-process search indexes.
+        events AS (
+            INSERT INTO badmeter_topic_event (
+                    topic_id, topic_title, topic_slug, event, date_created)
+                SELECT P.id, P.topic_title, P.topic_slug, 'purge', now()
+                    FROM topics P)
+        SELECT P.id, P.topic_slug::text, P.topic_title::text,
+                COALESCE(PV.n, 0)::int, COALESCE(PC.n, 0)::int
+            FROM topics P
+                LEFT JOIN (SELECT X.topic_id, count(*) AS n
+                        FROM votes X GROUP BY X.topic_id) PV
+                    ON PV.topic_id = P.id
+                LEFT JOIN (SELECT X.topic_id, count(*) AS n
+                        FROM cookies X GROUP BY X.topic_id) PC
+                    ON PC.topic_id = P.id
+            ORDER BY P.id;
+
+    PERFORM purge_voters(t_voter_ids);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Delete the voters of p_voter_ids left with no cookie or topic. A voter
+-- is only checked once it is locked, in a statement of its own, so the
+-- check sees the rows of any add that used it before. Voters locked by
+-- add_voter() or add_votes() for an add still running are kept. Returns
+-- the number of voters deleted. Used by:
+--   purge_many()
+CREATE OR REPLACE FUNCTION purge_voters(
+    p_voter_ids int[]
+)
+RETURNS int
+AS $$
+DECLARE
+    t_locked_ids int[];
+    t_count int;
+BEGIN
+    SELECT array_agg(L.id)
+        INTO t_locked_ids
+        FROM (
+            SELECT W.id
+                FROM badmeter_voter W
+                WHERE W.id = ANY(p_voter_ids)
+                ORDER BY W.id
+                FOR UPDATE SKIP LOCKED) L;
+
+    DELETE FROM badmeter_voter W
+        WHERE W.id = ANY(t_locked_ids)
+            AND NOT EXISTS (SELECT 1 FROM badmeter_cookie C WHERE C.voter_id = W.id)
+            AND NOT EXISTS (SELECT 1 FROM badmeter_topic T WHERE T.voter_id = W.id);
+    GET DIAGNOSTICS t_count = ROW_COUNT;
+    RETURN t_count;
 END;
 $$ LANGUAGE plpgsql;
@@ -8,22 +8,39 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+-- Purge all stale topics in one transaction. Large sites should run
+-- "python manage.py purge_topics" instead, which purges the same
+-- topics in bounded batches each in its own transaction.
 CREATE OR REPLACE FUNCTION purge_scan(
     p_now text
 )
 RETURNS void
 AS $$
+BEGIN
+    PERFORM purge_many(ARRAY(SELECT id FROM list_stale_topics(p_now, NULL)));
+    PERFORM trim_topic_events();
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List topics with less than vote_quota votes within the last
+-- interval_days, among all topics or only those in p_topic_ids.
+-- Topics younger than interval_days are never stale. Used by:
+--   purge_scan()
+--   badmeter.purge.purge_stale_topics()
+CREATE OR REPLACE FUNCTION list_stale_topics(
+    p_now text,
+    p_topic_ids int[]
+)
+RETURNS TABLE(
+    id int
+) AS $$
 DECLARE
     t_now timestamp;
     t_start timestamp;
     t_end timestamp;
-    t_badmeter_topic_id int;
-    t_date_created timestamp;
-    t_topic_slug text;
-    t_badmeter_vote_count int;
-    t_interval interval;    -- := interval '11 days';
-    t_quota int;            -- := 100;
-    -- ~ t_timestamp timestamp;
+    t_interval interval;
+    t_quota int;
 BEGIN
     -- Get application configuration from central location
     -- in get_configuration().
@@ -37,35 +54,34 @@ BEGIN
     t_end := date_trunc('day', t_now);
     t_start := t_end - t_interval;
 
-    RAISE NOTICE 'start = %', t_start;
-    RAISE NOTICE 'end = %', t_end;
-
-    FOR t_badmeter_topic_id, t_date_created, t_topic_slug IN
-        SELECT id, date_created, topic_slug
-            FROM badmeter_topic
-            ORDER BY id
-    LOOP
-        IF t_now > (date_trunc('day', t_date_created) + t_interval) THEN
-
-            SELECT count(*)
-                INTO t_badmeter_vote_count
-                FROM badmeter_vote
-                WHERE topic_id = t_badmeter_topic_id
-                    AND date_created >= t_start
-                    AND date_created < t_end;
-
-            IF t_badmeter_vote_count < t_quota THEN
-
-                -- ~ RAISE NOTICE 'topic_slug = %', t_topic_slug;
-                -- ~ RAISE NOTICE 't_badmeter_topic_id = %', t_badmeter_topic_id;
-                PERFORM purge_one(t_badmeter_topic_id);
+    -- One grouped pass over the daily rollup. Both dates are
+    -- midnights so the rollup is exact.
+    RETURN QUERY
+        SELECT T.id
+            FROM badmeter_topic T
+                LEFT JOIN (
+                    SELECT D.topic_id, sum(D.votes_counted + D.votes_uncounted) AS votes
+                        FROM badmeter_topic_daily D
+                        WHERE D.day >= t_start::date
+                            AND D.day < t_end::date
+                            AND (p_topic_ids IS NULL OR D.topic_id = ANY(p_topic_ids))
+                        GROUP BY D.topic_id) V
+                    ON V.topic_id = T.id
+            WHERE t_now > (date_trunc('day', T.date_created) + t_interval)
+                AND COALESCE(V.votes, 0) < t_quota
+                AND (p_topic_ids IS NULL OR T.id = ANY(p_topic_ids))
+            ORDER BY T.id;
+END;
+$$ LANGUAGE plpgsql;
 
-                -- ~ RAISE NOTICE 't_date_created = %', t_date_created;
-                -- ~ t_timestamp := date_trunc('day', t_date_created) + t_interval;
-                -- ~ RAISE NOTICE 't_purge_date = %', t_timestamp;
 
-            END IF;
-        END IF;
-    END LOOP;
+-- Trim the topic event log. Search indexes older than this
+-- reload in full (see settings.TOPIC_INDEX_MAX_AGE_SECONDS).
+CREATE OR REPLACE FUNCTION trim_topic_events()
+RETURNS void
+AS $$
+BEGIN
+    DELETE FROM badmeter_topic_event
+        WHERE date_created < now() - interval '1 day';
 END;
 $$ LANGUAGE plpgsql;
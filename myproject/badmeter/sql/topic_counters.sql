@@ -0,0 +1,136 @@
+-- Sharded topic vote counters. A counted vote adds to the badmeter_topic
+-- row of its topic, so the voters of one busy topic queue on that row
+-- lock. Topics opted in with set_counter_shards() spread their counters
+-- over counter_shards badmeter_topic_counter rows instead, and their
+-- badmeter_topic_daily rollup over as many rows per day. add_vote()
+-- picks the row of a vote by its voter id.
+--
+-- The counter rows hold deltas not yet in badmeter_topic. Readers add
+-- them on read with topic_counters(). fold_topic_counters() moves them
+-- into badmeter_topic, run by "python manage.py topic_counters --every".
+
+
+-- The badmeter value of the vote counters. greatest() prevents
+-- divide-by-zero error.
+CREATE OR REPLACE FUNCTION topic_badmeter(
+    p_votes_positive int,
+    p_votes_negative int
+)
+RETURNS numeric
+AS $$
+    SELECT (50 + floor((p_votes_positive - p_votes_negative)
+        / greatest(p_votes_positive + p_votes_negative, 1)::float * 50))::numeric;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- The vote counters of a topic with its pending deltas. Used by:
+--   get_topic_page()
+CREATE OR REPLACE FUNCTION topic_counters(
+    p_topic_id int,
+    OUT badmeter numeric,
+    OUT votes_positive int,
+    OUT votes_negative int,
+    OUT date_updated timestamp
+) AS $$
+DECLARE
+    t_shards int;
+BEGIN
+    SELECT T.badmeter, T.votes_positive + COALESCE(sum(S.votes_positive), 0),
+            T.votes_negative + COALESCE(sum(S.votes_negative), 0),
+            greatest(T.date_updated, max(S.date_updated)), count(S.id)
+        INTO badmeter, votes_positive, votes_negative, date_updated, t_shards
+        FROM badmeter_topic T
+            LEFT JOIN badmeter_topic_counter S
+                ON S.topic_id = T.id
+        WHERE T.id = p_topic_id
+        GROUP BY T.id;
+
+    IF t_shards > 0 THEN
+        badmeter := topic_badmeter(votes_positive, votes_negative);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Move the pending deltas of a topic, or of all topics when NULL, into
+-- badmeter_topic, and the sharded rollup rows of past days into shard 0.
+-- Each counter row is locked only for the statement. Returns the number
+-- of topics folded.
+CREATE OR REPLACE FUNCTION fold_topic_counters(
+    p_topic_id int
+)
+RETURNS int
+AS $$
+DECLARE
+    t_count int;
+BEGIN
+    WITH folded AS (
+        DELETE FROM badmeter_topic_counter S
+            WHERE p_topic_id IS NULL
+                OR S.topic_id = p_topic_id
+            RETURNING S.topic_id, S.votes_positive, S.votes_negative, S.date_updated),
+    deltas AS (
+        SELECT F.topic_id, sum(F.votes_positive)::int AS votes_positive,
+                sum(F.votes_negative)::int AS votes_negative,
+                max(F.date_updated) AS date_updated
+            FROM folded F
+            GROUP BY F.topic_id)
+    UPDATE badmeter_topic T
+        SET votes_positive = T.votes_positive + D.votes_positive,
+            votes_negative = T.votes_negative + D.votes_negative,
+            badmeter = topic_badmeter(T.votes_positive + D.votes_positive,
+                T.votes_negative + D.votes_negative),
+            date_updated = greatest(T.date_updated, D.date_updated)
+        FROM deltas D
+        WHERE T.id = D.topic_id;
+    GET DIAGNOSTICS t_count = ROW_COUNT;
+
+    WITH folded AS (
+        DELETE FROM badmeter_topic_daily R
+            WHERE R.shard > 0
+                AND R.day < current_date
+                AND (p_topic_id IS NULL OR R.topic_id = p_topic_id)
+            RETURNING R.topic_id, R.day, R.votes_counted, R.votes_counted_midnight,
+                R.votes_uncounted)
+    INSERT INTO badmeter_topic_daily AS R (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        SELECT F.topic_id, F.day, 0, sum(F.votes_counted), sum(F.votes_counted_midnight),
+                sum(F.votes_uncounted)
+            FROM folded F
+            GROUP BY F.topic_id, F.day
+        ON CONFLICT (topic_id, day, shard) DO UPDATE
+            SET votes_counted = R.votes_counted + EXCLUDED.votes_counted,
+                votes_counted_midnight = R.votes_counted_midnight + EXCLUDED.votes_counted_midnight,
+                votes_uncounted = R.votes_uncounted + EXCLUDED.votes_uncounted;
+
+    RETURN t_count;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Opt a topic in to p_shards counter rows, or out with 0 or 1. Opting out
+-- folds its pending deltas. Returns FALSE for a non-existing topic.
+CREATE OR REPLACE FUNCTION set_counter_shards(
+    p_topic_slug text,
+    p_shards int
+)
+RETURNS boolean
+AS $$
+DECLARE
+    t_badmeter_topic_id int;
+BEGIN
+    UPDATE badmeter_topic
+        SET counter_shards = CASE WHEN p_shards > 1 THEN p_shards END
+        WHERE topic_slug = p_topic_slug
+        RETURNING id INTO t_badmeter_topic_id;
+
+    IF t_badmeter_topic_id IS NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    IF p_shards <= 1 THEN
+        PERFORM fold_topic_counters(t_badmeter_topic_id);
+    END IF;
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,110 @@
+
+-- Maintain the badmeter_topic_daily vote rollup. Used by:
+--   add_vote()
+--   python manage.py topic_daily
+--
+-- topic_daily_add() gained the p_shard parameter.
+DROP FUNCTION IF EXISTS topic_daily_add(int, timestamp, int, int);
+
+-- Add deltas to the counted and uncounted totals of the day of
+-- p_date_created. Counted votes cast exactly at midnight are also
+-- tallied in votes_counted_midnight for get_purgedate().
+--
+-- Topics with sharded counters (see topic_counters.sql) keep a row per
+-- day per shard, so readers sum the rows of a day. Other topics only
+-- use shard 0.
+CREATE OR REPLACE FUNCTION topic_daily_add(
+    p_badmeter_topic_id int,
+    p_date_created timestamp,
+    p_counted int,
+    p_uncounted int,
+    p_shard int
+)
+RETURNS void
+AS $$
+DECLARE
+    t_midnight int := 0;
+BEGIN
+    IF p_date_created = date_trunc('day', p_date_created) THEN
+        t_midnight := p_counted;
+    END IF;
+
+    INSERT INTO badmeter_topic_daily AS D (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        VALUES (
+            p_badmeter_topic_id, p_date_created::date, p_shard, p_counted, t_midnight,
+            p_uncounted)
+        ON CONFLICT (topic_id, day, shard) DO UPDATE
+            SET votes_counted = D.votes_counted + p_counted,
+                votes_counted_midnight = D.votes_counted_midnight + t_midnight,
+                votes_uncounted = D.votes_uncounted + p_uncounted;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Rebuild the rollup of one topic, or of all topics when NULL,
+-- from the raw badmeter_vote table.
+CREATE OR REPLACE FUNCTION rebuild_topic_daily(
+    p_badmeter_topic_id int
+)
+RETURNS void
+AS $$
+BEGIN
+    DELETE FROM badmeter_topic_daily
+        WHERE p_badmeter_topic_id IS NULL
+            OR topic_id = p_badmeter_topic_id;
+
+    INSERT INTO badmeter_topic_daily (
+            topic_id, day, shard, votes_counted, votes_counted_midnight, votes_uncounted)
+        SELECT topic_id, date_created::date, 0,
+                sum(CASE WHEN counted IS TRUE THEN 1 ELSE 0 END),
+                sum(CASE WHEN counted IS TRUE
+                    AND date_created = date_trunc('day', date_created) THEN 1 ELSE 0 END),
+                sum(CASE WHEN counted IS TRUE THEN 0 ELSE 1 END)
+            FROM badmeter_vote
+            WHERE p_badmeter_topic_id IS NULL
+                OR topic_id = p_badmeter_topic_id
+            GROUP BY topic_id, date_created::date;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List the rollup rows that disagree with the raw badmeter_vote table.
+CREATE OR REPLACE FUNCTION verify_topic_daily()
+RETURNS TABLE(
+    topic_id int,
+    day date,
+    votes_counted int,
+    votes_counted_midnight int,
+    votes_uncounted int,
+    expected_counted int,
+    expected_counted_midnight int,
+    expected_uncounted int
+) AS $$
+BEGIN
+    RETURN QUERY
+        SELECT COALESCE(D.topic_id, V.topic_id), COALESCE(D.day, V.day),
+                D.votes_counted, D.votes_counted_midnight, D.votes_uncounted,
+                V.counted, V.counted_midnight, V.uncounted
+            FROM (
+                SELECT R.topic_id, R.day, sum(R.votes_counted)::int AS votes_counted,
+                        sum(R.votes_counted_midnight)::int AS votes_counted_midnight,
+                        sum(R.votes_uncounted)::int AS votes_uncounted
+                    FROM badmeter_topic_daily R
+                    GROUP BY R.topic_id, R.day) D
+                FULL OUTER JOIN (
+                    SELECT A.topic_id, A.date_created::date AS day,
+                            sum(CASE WHEN A.counted IS TRUE THEN 1 ELSE 0 END)::int AS counted,
+                            sum(CASE WHEN A.counted IS TRUE
+                                AND A.date_created = date_trunc('day', A.date_created)
+                                THEN 1 ELSE 0 END)::int AS counted_midnight,
+                            sum(CASE WHEN A.counted IS TRUE THEN 0 ELSE 1 END)::int AS uncounted
+                        FROM badmeter_vote A
+                        GROUP BY A.topic_id, A.date_created::date) V
+                    ON V.topic_id = D.topic_id
+                        AND V.day = D.day
+            WHERE (D.votes_counted, D.votes_counted_midnight, D.votes_uncounted)
+                    IS DISTINCT FROM (V.counted, V.counted_midnight, V.uncounted)
+            ORDER BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
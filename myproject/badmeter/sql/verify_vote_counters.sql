@@ -0,0 +1,62 @@
+-- List the vote counters of the given topics that disagree with the raw
+-- badmeter_vote table: badmeter_cookie vote state and counters, topic
+-- counters with their pending shards, and voters with more than one vote
+-- on a topic in a day. Topics whose old vote partitions were dropped
+-- disagree too. Used by:
+--   python manage.py stress_votes
+CREATE OR REPLACE FUNCTION verify_vote_counters(
+    p_topic_ids int[]
+)
+RETURNS TABLE(
+    topic_id int,
+    cookie_id int,
+    problem text
+) AS $$
+BEGIN
+    RETURN QUERY
+        SELECT C.topic_id, C.id, 'cookie counters'::text
+            FROM badmeter_cookie C
+                LEFT JOIN (
+                    SELECT A.cookie_id, count(*)::int AS votes_total,
+                            sum(CASE WHEN A.counted IS TRUE THEN 0 ELSE 1 END)::int AS uncounted,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_positive,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS NOT TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_negative
+                        FROM badmeter_vote A
+                        WHERE A.topic_id = ANY(p_topic_ids)
+                        GROUP BY A.cookie_id) V
+                    ON V.cookie_id = C.id
+            WHERE C.topic_id = ANY(p_topic_ids)
+                AND ((C.votes_total, C.votes_positive, C.votes_negative)
+                        IS DISTINCT FROM (COALESCE(V.votes_total, 0),
+                            COALESCE(V.votes_positive, 0), COALESCE(V.votes_negative, 0))
+                    OR C.counted IS DISTINCT FROM (C.votes_total >= 3)
+                    OR V.uncounted <> CASE WHEN C.votes_total >= 3 THEN 0 ELSE C.votes_total END)
+        UNION ALL
+        SELECT A.topic_id, A.cookie_id, 'more than one vote a day'::text
+            FROM badmeter_vote A
+            WHERE A.topic_id = ANY(p_topic_ids)
+            GROUP BY A.topic_id, A.cookie_id, A.date_created::date
+            HAVING count(*) > 1
+        UNION ALL
+        SELECT T.id, NULL::int, 'topic counters'::text
+            FROM badmeter_topic T
+                CROSS JOIN topic_counters(T.id) S
+                LEFT JOIN (
+                    SELECT A.topic_id,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_positive,
+                            sum(CASE WHEN A.counted IS TRUE AND A.vote IS NOT TRUE
+                                THEN 1 ELSE 0 END)::int AS votes_negative
+                        FROM badmeter_vote A
+                        WHERE A.topic_id = ANY(p_topic_ids)
+                        GROUP BY A.topic_id) V
+                    ON V.topic_id = T.id
+            WHERE T.id = ANY(p_topic_ids)
+                AND ((S.votes_positive, S.votes_negative)
+                        IS DISTINCT FROM (COALESCE(V.votes_positive, 0), COALESCE(V.votes_negative, 0))
+                    OR S.badmeter <> topic_badmeter(S.votes_positive, S.votes_negative))
+        ORDER BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
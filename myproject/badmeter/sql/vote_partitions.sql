@@ -0,0 +1,239 @@
+-- Monthly range partitions of badmeter_vote on date_created. The table is
+-- converted once by upgrade/004_vote_partitions.sql (PostgreSQL 11 or
+-- later). "python manage.py vote_partitions" then creates the partitions
+-- of the coming months and drops whole months past VOTE_RETENTION_MONTHS
+-- without DELETEs. Partitions are named badmeter_vote_YYYYMM. Rows
+-- outside of them land in badmeter_vote_default. Month bounds are taken
+-- in the session time zone.
+
+
+-- Whether badmeter_vote is partitioned. The functions below do nothing
+-- on the plain table created by "python manage.py migrate".
+CREATE OR REPLACE FUNCTION vote_partitioned()
+RETURNS boolean
+AS $$
+    SELECT COALESCE((
+        SELECT relkind = 'p'
+            FROM pg_class
+            WHERE oid = to_regclass('badmeter_vote')), FALSE);
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION vote_partition_name(
+    p_month timestamp
+)
+RETURNS text
+AS $$
+    SELECT 'badmeter_vote_' || to_char(p_month, 'YYYYMM');
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Create the missing monthly partitions from the month of p_from up to
+-- the month of p_to. Votes of those months kept in badmeter_vote_default
+-- move to their new partition. Returns the created partition names.
+-- Used by:
+--   partition_votes()
+--   badmeter vote_partitions and seed_data commands
+CREATE OR REPLACE FUNCTION create_vote_partitions(
+    p_from timestamp,
+    p_to timestamp
+)
+RETURNS SETOF text
+AS $$
+DECLARE
+    t_month timestamp := date_trunc('month', p_from);
+    t_next timestamp;
+    t_name text;
+BEGIN
+    IF NOT vote_partitioned() THEN
+        RETURN;
+    END IF;
+
+    WHILE t_month <= p_to LOOP
+        t_next := t_month + interval '1 month';
+        t_name := vote_partition_name(t_month);
+
+        IF to_regclass(t_name) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM badmeter_vote_default
+                    WHERE date_created >= t_month
+                        AND date_created < t_next) THEN
+                EXECUTE format('CREATE TABLE %I (LIKE badmeter_vote INCLUDING DEFAULTS)', t_name);
+                EXECUTE format('
+                    WITH moved AS (
+                        DELETE FROM badmeter_vote_default
+                            WHERE date_created >= %L
+                                AND date_created < %L
+                            RETURNING *)
+                    INSERT INTO %I SELECT * FROM moved', t_month, t_next, t_name);
+                EXECUTE format('ALTER TABLE badmeter_vote ATTACH PARTITION %I
+                    FOR VALUES FROM (%L) TO (%L)', t_name, t_month, t_next);
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF badmeter_vote
+                    FOR VALUES FROM (%L) TO (%L)', t_name, t_month, t_next);
+            END IF;
+            RETURN NEXT t_name;
+        END IF;
+
+        t_month := t_next;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List the monthly partitions of badmeter_vote, oldest first.
+CREATE OR REPLACE FUNCTION list_vote_partitions()
+RETURNS TABLE(
+    partition_name text,
+    range_start timestamp,
+    range_end timestamp
+) AS $$
+BEGIN
+    RETURN QUERY
+        SELECT C.relname::text, P.range_start, P.range_start + interval '1 month'
+            FROM pg_inherits I
+                JOIN pg_class C
+                    ON C.oid = I.inhrelid,
+                LATERAL (SELECT to_timestamp(right(C.relname, 6), 'YYYYMM')::timestamp
+                    AS range_start) P
+            WHERE I.inhparent = to_regclass('badmeter_vote')
+                AND C.relname ~ '^badmeter_vote_[0-9]{6}$'
+            ORDER BY P.range_start;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- List the partitions whose votes are all older than p_months months
+-- before the month of p_now. Partitions holding any vote of the last
+-- interval_days, which the purge windows may still read, are never
+-- listed.
+CREATE OR REPLACE FUNCTION list_expired_vote_partitions(
+    p_now text,
+    p_months int
+)
+RETURNS TABLE(
+    partition_name text,
+    range_start timestamp,
+    range_end timestamp
+) AS $$
+DECLARE
+    t_now timestamp;
+    t_interval interval;
+BEGIN
+    SELECT interval_days
+        INTO t_interval
+        FROM get_configuration();
+
+    SELECT COALESCE(get_timestamp(p_now), now())
+        INTO t_now;
+
+    RETURN QUERY
+        SELECT P.partition_name, P.range_start, P.range_end
+            FROM list_vote_partitions() P
+            WHERE P.range_end <= date_trunc('month', t_now) - p_months * interval '1 month'
+                AND P.range_end <= date_trunc('day', t_now) - t_interval
+            ORDER BY P.range_start;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Detach and drop one monthly partition with its days of the
+-- badmeter_topic_daily rollup. The vote counters on badmeter_topic and
+-- badmeter_cookie are kept. Returns the bytes freed.
+CREATE OR REPLACE FUNCTION drop_vote_partition(
+    p_partition_name text
+)
+RETURNS bigint
+AS $$
+DECLARE
+    t_start timestamp;
+    t_end timestamp;
+    t_bytes bigint;
+BEGIN
+    SELECT range_start, range_end
+        INTO t_start, t_end
+        FROM list_vote_partitions()
+        WHERE partition_name = p_partition_name;
+
+    IF t_start IS NULL THEN
+        RAISE EXCEPTION 'No badmeter_vote partition %', p_partition_name;
+    END IF;
+
+    t_bytes := pg_total_relation_size(to_regclass(p_partition_name));
+    EXECUTE format('ALTER TABLE badmeter_vote DETACH PARTITION %I', p_partition_name);
+    EXECUTE format('DROP TABLE %I', p_partition_name);
+
+    DELETE FROM badmeter_topic_daily
+        WHERE day >= t_start::date
+            AND day < t_end::date;
+
+    RETURN t_bytes;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Convert the plain badmeter_vote table into a partitioned one, with
+-- partitions from the month of its oldest vote up to p_months_ahead
+-- months ahead. The primary key becomes (id, date_created) as it has to
+-- hold the partition key. Used by:
+--   upgrade/004_vote_partitions.sql
+CREATE OR REPLACE FUNCTION partition_votes(
+    p_months_ahead int
+)
+RETURNS void
+AS $$
+DECLARE
+    t_first timestamp;
+BEGIN
+    IF vote_partitioned() THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE badmeter_vote RENAME TO badmeter_vote_heap;
+    ALTER TABLE badmeter_vote_heap RENAME CONSTRAINT badmeter_vote_pkey TO badmeter_vote_heap_pkey;
+    -- Keep the id sequence when the old table is dropped.
+    ALTER SEQUENCE badmeter_vote_id_seq OWNED BY NONE;
+
+    CREATE TABLE badmeter_vote (
+        id integer NOT NULL DEFAULT nextval('badmeter_vote_id_seq'),
+        topic_id integer NOT NULL,
+        cookie_id integer NOT NULL,
+        comment varchar(400) NOT NULL,
+        vote boolean NULL,
+        counted boolean NULL,
+        date_created timestamp with time zone NOT NULL,
+        PRIMARY KEY (id, date_created)
+    ) PARTITION BY RANGE (date_created);
+
+    CREATE TABLE badmeter_vote_default PARTITION OF badmeter_vote DEFAULT;
+
+    SELECT date_trunc('month', COALESCE(min(date_created), now()))
+        INTO t_first
+        FROM badmeter_vote_heap;
+
+    PERFORM create_vote_partitions(t_first,
+        (now() + p_months_ahead * interval '1 month')::timestamp);
+
+    INSERT INTO badmeter_vote (
+            id, topic_id, cookie_id, comment, vote, counted, date_created)
+        SELECT id, topic_id, cookie_id, comment, vote, counted, date_created
+            FROM badmeter_vote_heap;
+
+    DROP TABLE badmeter_vote_heap;
+    ALTER SEQUENCE badmeter_vote_id_seq OWNED BY badmeter_vote.id;
+
+    -- Indexes and foreign keys after the copy, built once per partition.
+    -- The partition bounds take the place of the date_created index.
+    CREATE INDEX badmeter_vote_cookie_id
+        ON badmeter_vote (cookie_id);
+    CREATE INDEX badmeter_vote_topic_id_cookie_id_date_created
+        ON badmeter_vote (topic_id, cookie_id, date_created);
+    CREATE INDEX badmeter_vote_topic_id_date_created_id
+        ON badmeter_vote (topic_id, date_created, id);
+
+    ALTER TABLE badmeter_vote
+        ADD CONSTRAINT badmeter_vote_topic_id_fk
+            FOREIGN KEY (topic_id) REFERENCES badmeter_topic (id) DEFERRABLE INITIALLY DEFERRED,
+        ADD CONSTRAINT badmeter_vote_cookie_id_fk
+            FOREIGN KEY (cookie_id) REFERENCES badmeter_cookie (id) DEFERRABLE INITIALLY DEFERRED;
+END;
+$$ LANGUAGE plpgsql;
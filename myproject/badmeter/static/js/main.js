@@ -70,6 +70,26 @@ $(function(){
         window.location.href = "/index#home_section";
     });
 
+    // Lazy-load the next page of older votes from votes.json.
+    $(".older_votes").click(function(){
+        var button = $(this);
+        var url = "/vote/" + button.data("slug") + "/votes.json";
+        button.prop("disabled", true);
+        $.getJSON( url, { before: button.data("before") }, function( data ){
+            var count = button.data("count");
+            $.each( data.votes, function( i, vote ){
+                count += 1;
+                $(".topic_votes").append( vote_rows( vote, count ) );
+            });
+            button.data("count", count);
+            if ( data.before ) {
+                button.data("before", data.before).prop("disabled", false);
+            } else {
+                button.remove();
+            }
+        });
+    });
+
 });
 
 function slugify(topic_title){
@@ -77,4 +97,28 @@ function slugify(topic_title){
         .toLowerCase()
         .replace(/[^0-9a-z]+/g,' ')
         .replace(/[ ]+/g,'-');
-}
\ No newline at end of file
+}
+
+// Table rows of one vote, same as the topic_votes loop in add_vote.html.
+function vote_rows(vote, count){
+    var icon = "img/Button-Blank-Gray-icon.png";
+    if (vote.counted) {
+        icon = vote.vote ? "img/add-icon.png" : "img/Math-minus-icon.png";
+    }
+    var cookie = $("<span>").text(vote.cookie_string);
+    if (vote.mine) {
+        cookie = $("<strong>").append(cookie);
+    }
+    var row1 = $("<tr class='topic_votes_row1'>")
+        .append("<td class='topic_votes_row1_except'>&nbsp;</td>")
+        .append($("<td class='topic_votes_row1_except'>").append($("<img>").attr("src", "/static/" + icon)))
+        .append("<td class='topic_votes_row1_except'>&nbsp;</td>")
+        .append($("<td>").text(count + ".\u00a0").append(cookie)
+            .append(document.createTextNode("\u00a0(-" + vote.votes_negative + "/+" + vote.votes_positive + ")")))
+        .append("<td>&nbsp;</td>")
+        .append($("<td>").text(vote.date_created));
+    var row2 = $("<tr>")
+        .append("<td colspan='3'>&nbsp;</td>")
+        .append($("<td colspan='3'>").text(vote.comment));
+    return [row1, row2, $("<tr><td colspan='6'>&nbsp;</td></tr>")];
+}
@@ -0,0 +1,118 @@
+from collections import namedtuple
+from datetime import date
+from django.core.cache import caches
+from myproject import settings
+from . import db
+from . import metrics
+
+# Per topic cache of the visitor independent part of the vote page.
+#
+# Reads far outnumber votes, yet every vote page used to reload the topic
+# stats, purge date and first votes. They are the get_topic_page() rows,
+# cached here in the TOPIC_STATS_CACHE cache (settings.CACHES), a bounded
+# LRU in process memory by default or a shared backend such as memcached.
+#
+# An entry is versioned by badmeter_topic.date_updated, which add_vote()
+# moves forward to the clock time on every vote, and by the day since the
+# purge date moves with it.
+# A vote page then costs one light get_visitor_state() call when the entry
+# is current. Vote.save() refreshes the entry of its topic (write-through)
+# and the purge engine deletes the entries of purged topics.
+#
+# get_visitor_state() resolves the topic slug and cookie string to their
+# ids once per request. A miss with a known VisitorState then reloads the
+# entry through get_topic_page() by topic id, with no further slug lookup.
+
+hits = metrics.counter('badmeter_topic_stats_hits_total',
+    'Vote pages served from the topic stats cache.')
+misses = metrics.counter('badmeter_topic_stats_misses_total',
+    'Vote pages that missed the topic stats cache.')
+
+VisitorState = namedtuple('VisitorState', ['topic_id', 'cookie_id',
+    'topic_date_updated', 'cookie_votes_positive', 'cookie_votes_negative',
+    'cookie_date_created', 'status_message'])
+
+
+class TopicStatsCache(object):
+    """
+    get_topic_page() rows of each topic, versioned by topic date_updated.
+    """
+    def __init__(self, cache_alias=None):
+        self.cache_alias = cache_alias or settings.TOPIC_STATS_CACHE
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def key(self, topic_slug):
+        return 'topic-stats:%s' % topic_slug
+
+    def get_visitor_state(self, topic_slug, cookie_string):
+        """
+        Return the VisitorState of a topic and cookie. topic_id and
+        topic_date_updated are None for a non-existing topic, cookie_id
+        for a cookie that has not voted on it.
+        """
+        return VisitorState(*db.fetchone('get_visitor_state', [topic_slug, cookie_string]))
+
+    def get_vote_page(self, topic_slug, cookie_string, state=None):
+        """
+        Return (topic page, visitor state) of the vote page. The topic
+        page is a dict with keys version, day, topic (title, slug,
+        badmeter, votes_positive, votes_negative, date_created or None),
+        purge_date, vote_needed and votes (list_votes() rows). The
+        visitor state is a VisitorState. state is a VisitorState the
+        caller already has.
+        """
+        page = self.cache.get(self.key(topic_slug))
+        if page is not None:
+            if state is None:
+                state = self.get_visitor_state(topic_slug, cookie_string)
+            if page['version'] == state.topic_date_updated and page['day'] == date.today():
+                hits.inc()
+                return page, state
+
+        misses.inc()
+        if state is not None:
+            # The ids are already resolved for this request.
+            return self.store(topic_slug, db.fetchall('get_topic_page_by_id',
+                [state.topic_id, settings.VOTES_PAGE_SIZE + 1])), state
+
+        # One round trip for the whole page. See sql/get_vote_page.sql.
+        rows = db.fetchall('get_vote_page',
+            [topic_slug, cookie_string, settings.VOTES_PAGE_SIZE + 1])
+        row = rows[0]
+        state = VisitorState(row[17], row[18], row[6], *row[19:23])
+        return self.store(topic_slug, [row[:17] for row in rows]), state
+
+    def refresh(self, topic_slug):
+        """
+        Reload the entry of a topic, e.g. after a vote.
+        """
+        return self.store(topic_slug, db.fetchall('get_topic_page',
+            [topic_slug, settings.VOTES_PAGE_SIZE + 1]))
+
+    def store(self, topic_slug, rows):
+        """
+        Cache and return the topic page of get_topic_page() rows.
+        """
+        first = rows[0]
+        page = {
+            'version' : first[6],
+            'day' : date.today(),
+            'topic' : first[:6] if first[0] else None,
+            'purge_date' : first[7],
+            'vote_needed' : first[8],
+            'votes' : [row[9:] for row in rows if row[9] is not None]}
+        if page['version'] is None:
+            # Non-existing topic.
+            self.delete(topic_slug)
+        else:
+            self.cache.set(self.key(topic_slug), page)
+        return page
+
+    def delete(self, topic_slug):
+        self.cache.delete(self.key(topic_slug))
+
+
+topic_stats_cache = TopicStatsCache()
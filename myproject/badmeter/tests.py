@@ -1,13 +1,36 @@
 
 from datetime import datetime, date
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import caches
 from django.db import models, connection
+from django.core.management import call_command
 from django.utils.text import slugify
+from django.utils.timezone import utc
+from myproject import settings
 from .misc import (print_info, strip_extra_spaces, ageinyears,
-    ageindays_string, hash_md5_random_hexdigest)
-from .models import Topic, Vote, Cookie
+    ageindays_string, hash_md5_random_hexdigest, voter_digest, voter_hexdigest,
+    vote_cursor, parse_vote_cursor)
+from .models import Topic, Vote, Cookie, Voter, PurgeCursor, TopicEvent
 from .forms import TopicModelForm, VoteModelForm
+from .topic_index import TopicPrefixIndex
+from .purge import purge_stale_topics, PurgeWorker
+from .configuration import ConfigurationCache
+from .cache import LRUCache
+from .stats_cache import topic_stats_cache, hits, misses
+from .search_cache import SearchCache
+from . import db
+from . import metrics
+from . import search_cache
+from .management.commands.bench_purgedate import LEGACY_GET_PURGEDATE
+from .management.commands.recaptcha_stub import StubVerifier
+from .management.commands.loadtest import CountQueries, QUERIES_HEADER, percentile
+from .captcha import VerifyClient, UNAVAILABLE
+from importlib import import_module
+import json
+import StringIO
+import threading
 
 
 class Test_misc_functions(TestCase):
@@ -31,6 +54,215 @@ class Test_misc_functions(TestCase):
         age_str = ''.join(str(datetime.now()-born_datetime).split('.')[:1])
         self.assertEqual(ageindays_string(born_datetime), age_str)
 
+    def test_vote_cursor(self):
+        date_created = datetime(2015, 3, 1, 12, 30, 15, 123456, tzinfo=utc)
+        cursor = vote_cursor(date_created, 42)
+        self.assertEqual(cursor, '1425213015123456_42')
+        self.assertEqual(parse_vote_cursor(cursor), (date_created, 42))
+        self.assertEqual(parse_vote_cursor('42'), (None, None))
+        self.assertEqual(parse_vote_cursor(''), (None, None))
+
+
+class Test_topic_index(TestCase):
+    """
+    Test the in-process topic prefix index used by /search/.
+    """
+    def test_search_prefix(self):
+        index = TopicPrefixIndex()
+        index.load([
+            (1, 'The quick brown fox', 'the-quick-brown-fox'),
+            (2, 'the   QUICK red fox', 'the-quick-red-fox'),
+            (3, 'Lazy dog', 'lazy-dog')])
+        self.assertEqual([row[0] for row in index.search('the quick', 25)], [1, 2])
+        self.assertEqual([row[0] for row in index.search('THE  quick r', 25)], [2])
+        self.assertEqual(index.search('the quick', 1), [(1, 'the-quick-brown-fox', 'The quick brown fox')])
+        self.assertEqual(index.search('cat', 25), [])
+
+    def test_add_remove(self):
+        index = TopicPrefixIndex()
+        index.load([(1, 'Lazy dog', 'lazy-dog')])
+        index.add(2, 'Lazy cat', 'lazy-cat')
+        self.assertEqual([row[0] for row in index.search('lazy', 25)], [2, 1])
+        index.remove(1)
+        self.assertEqual([row[0] for row in index.search('lazy', 25)], [2])
+        self.assertEqual(len(index), 1)
+
+    def test_refresh_late_events(self):
+        """
+        Test an event committed after a later one is still applied.
+        """
+        def log(event_id, event, topic_id, title):
+            TopicEvent.objects.create(id=event_id, event=event, topic_id=topic_id,
+                topic_title=title, topic_slug=slugify(unicode(title)))
+
+        index = TopicPrefixIndex(refresh_seconds=0)
+        index.refresh()
+        log(1, TopicEvent.ADD, 1, 'Lazy dog')
+        log(3, TopicEvent.ADD, 3, 'Lazy cat')
+        index.refresh()
+        self.assertEqual([row[0] for row in index.search('lazy', 25)], [3, 1])
+
+        log(2, TopicEvent.PURGE, 1, 'Lazy dog')
+        log(4, TopicEvent.ADD, 4, 'Lazy cow')
+        index.refresh()
+        self.assertEqual([row[0] for row in index.search('lazy', 25)], [3, 4])
+
+        # Gaps below the high-water mark of a full load are waited for too.
+        log(6, TopicEvent.ADD, 6, 'Lazy owl')
+        Topic.objects.bulk_create([Topic(id=topic_id, topic_title=title,
+            topic_slug=slugify(unicode(title)))
+            for topic_id, title in ((3, 'Lazy cat'), (4, 'Lazy cow'), (6, 'Lazy owl'))])
+        index = TopicPrefixIndex(refresh_seconds=0)
+        index.refresh()
+        log(5, TopicEvent.PURGE, 3, 'Lazy cat')
+        index.refresh()
+        self.assertEqual([row[0] for row in index.search('lazy', 25)], [4, 6])
+
+
+class Test_lru_cache(TestCase):
+    """
+    Test the LRU cache backend of the topic stats cache.
+    """
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache('test-lru', {'OPTIONS' : {'MAX_ENTRIES' : 3, 'CULL_FREQUENCY' : 3}})
+        cache.clear()
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key.upper())
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('d', 'D')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual([cache.get(key) for key in ('a', 'c', 'd')], ['A', 'C', 'D'])
+
+
+class Test_search_cache(TestCase):
+    """
+    Test the /search/ result cache.
+    """
+    def test_invalidate_title(self):
+        cache = SearchCache()
+        cache.cache.clear()
+        for term in ('la', 'LAZY  d', 'lazy cat', 'dog'):
+            cache.set(term, [term])
+        self.assertEqual(cache.get('lazy   D'), ['LAZY  d'])
+        cache.invalidate_title('Lazy   dog')
+        self.assertEqual([cache.get(term) for term in ('la', 'lazy d', 'lazy cat', 'dog')],
+            [None, None, ['lazy cat'], ['dog']])
+
+
+class Test_captcha(TestCase):
+    """
+    Test the pooled reCAPTCHA client against the local stub verifier.
+    """
+    def setUp(self):
+        self.server = StubVerifier(('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/recaptcha/api/verify' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_submit(self):
+        client = VerifyClient(self.url, timeout=1, pool_size=2)
+        self.assertTrue(client.submit('challenge', 'pass', 'key', '127.0.0.1').is_valid)
+        response = client.submit('challenge', 'fail', 'key', '127.0.0.1')
+        self.assertFalse(response.is_valid)
+        self.assertEqual(response.error_code, 'incorrect-captcha-sol')
+        # Both calls went over the same kept alive connection.
+        self.assertEqual(client._pool.qsize(), 1)
+
+    def test_timeout_opens_breaker(self):
+        self.server.delay = 0.5
+        client = VerifyClient(self.url, timeout=0.1, failure_limit=2, reset_seconds=60)
+        for i in range(3):
+            response = client.submit('challenge', 'pass', 'key', '127.0.0.1')
+            self.assertFalse(response.is_valid)
+            self.assertEqual(response.error_code, UNAVAILABLE)
+        self.assertTrue(client.breaker.is_open)
+
+        self.server.delay = 0
+        client.breaker.reset_seconds = 0
+        self.assertTrue(client.submit('challenge', 'pass', 'key', '127.0.0.1').is_valid)
+        self.assertFalse(client.breaker.is_open)
+
+
+class Test_db(TestCase):
+    """
+    Test the stored function call declarations of badmeter.db.
+    """
+    def test_statement_sql(self):
+        statement = db.statements['list_votes']
+        self.assertTrue(statement.prepare_sql.startswith('PREPARE badmeter_list_votes(text, timestamptz, int, int) AS SELECT'))
+        self.assertEqual(statement.execute_sql, 'EXECUTE badmeter_list_votes(%s, %s, %s, %s)')
+        self.assertTrue(statement.plain_sql.endswith('FROM list_votes(%s, %s, %s, %s)'))
+        self.assertTrue(db.statements['get_configuration'].prepare_sql.startswith(
+            'PREPARE badmeter_get_configuration AS SELECT'))
+        self.assertEqual(db.statements['get_configuration'].execute_sql,
+            'EXECUTE badmeter_get_configuration')
+
+
+class Test_metrics(TestCase):
+    """
+    Test the per view metrics and their /metrics endpoint.
+    """
+    def test_render(self):
+        metrics.counter('badmeter_test_total', 'Test counter.', labels={'kind' : 'a"b'}).inc(2)
+        metrics.histogram('badmeter_test_seconds', 'Test histogram.', (.1, 1),
+            labels={'view' : 'test'}).observe(.5)
+        metrics.gauge('badmeter_test_ratio', 'Test gauge.').set(.25)
+        text = metrics.render()
+        self.assertTrue('# TYPE badmeter_test_total counter\n' in text)
+        self.assertTrue('badmeter_test_total{kind="a\\"b"} 2\n' in text)
+        self.assertTrue('# TYPE badmeter_test_ratio gauge\nbadmeter_test_ratio 0.25\n' in text)
+        self.assertTrue('# TYPE badmeter_test_seconds histogram\n' in text)
+        self.assertTrue('badmeter_test_seconds_bucket{view="test",le="0.1"} 0\n' in text)
+        self.assertTrue('badmeter_test_seconds_bucket{view="test",le="1"} 1\n' in text)
+        self.assertTrue('badmeter_test_seconds_bucket{view="test",le="+Inf"} 1\n' in text)
+        self.assertTrue('badmeter_test_seconds_sum{view="test"} 0.5\n' in text)
+        self.assertTrue('badmeter_test_seconds_count{view="test"} 1\n' in text)
+
+    def test_view_metrics(self):
+        seconds = metrics.histogram('badmeter_view_seconds', labels={'view' : 'HomeTemplateView'})
+        count = seconds.count
+        client = Client()
+        client.get('/home/')
+        self.assertEqual(seconds.count, count + 1)
+
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('badmeter_view_seconds_count{view="HomeTemplateView"}' in response.content)
+        self.assertEqual(client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 404)
+        self.assertEqual(client.get('/metrics', HTTP_X_FORWARDED_FOR='10.1.2.3').status_code, 404)
+
+
+class Test_loadtest(TestCase):
+    """
+    Test the helpers of the loadtest command.
+    """
+    def test_percentile(self):
+        values = range(100, 0, -1)
+        self.assertEqual(percentile(values, .50), 50)
+        self.assertEqual(percentile(values, .95), 95)
+        self.assertEqual(percentile(values, .99), 99)
+        self.assertEqual(percentile([7], .99), 7)
+        self.assertEqual(percentile([], .5), None)
+
+    def test_count_queries(self):
+        def application(environ, start_response):
+            Topic.objects.count()
+            Vote.objects.count()
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok']
+
+        started = []
+        result = CountQueries(application)({}, lambda status, headers, exc_info=None:
+            started.append((status, dict(headers))))
+        self.assertEqual(result, ['ok'])
+        self.assertEqual(started[0][0], '200 OK')
+        self.assertEqual(started[0][1][QUERIES_HEADER], '2')
+
 
 class Test_index_page(TestCase):
     """
@@ -41,6 +273,29 @@ class Test_index_page(TestCase):
         response = client.get('/home/')
         self.assertEqual(response.status_code, 200)
 
+    def test_index_cache_control(self):
+        client = Client()
+        response = client.get('/home/')     # Shows the cookie message.
+        self.assertFalse(response.has_header('Cache-Control'))
+        response = client.get('/home/')
+        self.assertTrue('max-age=%d' % settings.HOME_PAGE_CACHE_SECONDS in response['Cache-Control'])
+        self.assertTrue('private' in response['Cache-Control'])
+
+    def test_index_session_writes(self):
+        """
+        Count database writes per GET of a reader: there should be none,
+        whether first visit or returning.
+        """
+        client = Client()
+        for i in range(3):
+            with CaptureQueriesContext(connection) as context:
+                response = client.get('/home/')
+            self.assertEqual(response.status_code, 200)
+            writes = [query['sql'] for query in context.captured_queries
+                if query['sql'].split()[0].upper() in ('INSERT', 'UPDATE', 'DELETE')]
+            self.assertEqual(writes, [])
+        self.assertTrue('badmeter_seen' in client.cookies)
+
     def test_index_home_section(self):
         client = Client()
         response = client.get('/home/#home_section/')
@@ -67,6 +322,27 @@ class Test_index_page(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+class Test_topic_form_redirect(TestCase):
+    """
+    Test a new topic matching an existing one redirects to it after a one
+    row probe.
+    """
+    def test_redirect_same_slug(self):
+        Topic.objects.bulk_create([
+            Topic(topic_title='Lazy dog', topic_slug='lazy-dog'),
+            Topic(topic_title='Lazy cat', topic_slug='lazy-cat')])
+
+        client = Client()
+        with CaptureQueriesContext(connection) as context:
+            response = client.post('/topic/', {'topic_title' : 'lazy   DOG'})
+        self.assertEqual(response.status_code, 301)
+        self.assertTrue(response['Location'].endswith('/vote/lazy-dog'))
+        queries = [query['sql'] for query in context.captured_queries
+            if 'badmeter_topic' in query['sql']]
+        self.assertEqual(len(queries), 1)
+        self.assertTrue('LIMIT 1' in queries[0])
+
+
 class Test_main(TestCase):
 
     @classmethod
@@ -86,6 +362,10 @@ class Test_main(TestCase):
         cursor.execute(sql)
         cursor.connection.commit()
 
+    def setUp(self):
+        caches[settings.TOPIC_STATS_CACHE].clear()
+        caches[settings.SEARCH_CACHE].clear()
+
     # Create a topic
     def add_topic_test(self, topic_title,
         topic_slug, cookie_string):
@@ -111,6 +391,17 @@ class Test_main(TestCase):
         })
         self.assertTrue(vote)
 
+    # Add the vote counters of a topic's creator, for votes inserted
+    # directly into badmeter_vote.
+    def add_creator_cookie_test(self, topic_id):
+        cursor = connection.cursor()
+        cursor.execute('''
+            INSERT INTO badmeter_cookie (voter_id, topic_id, votes_positive, votes_negative,
+                    votes_total, counted, date_voted, date_created, date_updated)
+                SELECT voter_id, id, 0, 0, 0, TRUE, NULL, date_created, date_created
+                    FROM badmeter_topic
+                    WHERE id = %s''', [topic_id])
+
     def test_main_models(self):
         """
         Test save & retrieve of models.
@@ -154,9 +445,675 @@ class Test_main(TestCase):
         self.assertEqual(vote[0].vote, (opinion=='true'))
 
         # Search cookie test
-        cookie = Cookie.objects.filter(cookie_string=cookie_string, topic__topic_slug=topic_slug)
+        cookie = Cookie.objects.filter(voter__digest=voter_digest(cookie_string),
+            topic__topic_slug=topic_slug)
         self.assertTrue(cookie)
-        self.assertEqual(cookie[0].cookie_string, cookie_string)
+        self.assertEqual(str(cookie[0].voter.digest), voter_digest(cookie_string))
+
+    def test_search(self):
+        """
+        Test /search/ autocomplete finds a just added topic.
+        """
+        topic_title = 'Zebra stripes are a fashion statement'
+        self.add_topic_test(topic_title, slugify(unicode(topic_title)),
+            hash_md5_random_hexdigest())
+
+        client = Client()
+        response = client.get('/search/', {'term': 'zebra  STRIPES'})
+        self.assertEqual(response.status_code, 200)
+        rows = json.loads(response.content)
+        self.assertTrue(rows)
+        self.assertEqual(rows[0]['label'], topic_title)
+        self.assertEqual(rows[0]['link'], slugify(unicode(topic_title)))
+
+    def test_search_cache(self):
+        """
+        Test /search/ answers are cached and dropped when a matching
+        topic is added.
+        """
+        self.add_topic_test('Yodeling for beginners', 'yodeling-for-beginners',
+            hash_md5_random_hexdigest())
+
+        client = Client()
+        counts = (search_cache.hits.value, search_cache.misses.value)
+        response = client.get('/search/', {'term': 'yodel'})
+        self.assertTrue('public' in response['Cache-Control'])
+        response = client.get('/search/', {'term': 'YODEL '})
+        self.assertEqual([row['label'] for row in json.loads(response.content)],
+            ['Yodeling for beginners'])
+        self.assertEqual((search_cache.hits.value, search_cache.misses.value),
+            (counts[0] + 1, counts[1] + 1))
+
+        self.add_topic_test('Yodeling at dawn', 'yodeling-at-dawn', hash_md5_random_hexdigest())
+        response = client.get('/search/', {'term': 'yodel'})
+        self.assertEqual([row['label'] for row in json.loads(response.content)],
+            ['Yodeling at dawn', 'Yodeling for beginners'])
+
+    def test_vote_page_queries(self):
+        """
+        Pin the number of database round trips to render a vote page.
+        Session middleware queries and their savepoints are not counted.
+        """
+        topic_title = 'Counting queries is a lot of fun'
+        topic_slug = slugify(unicode(topic_title))
+        cookie_string = hash_md5_random_hexdigest()
+        self.add_topic_test(topic_title, topic_slug, cookie_string)
+        self.add_vote_test(topic_slug, cookie_string, 'first!', 'true')
+
+        client = Client()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/vote/%s/' % topic_slug)
+        self.assertContains(response, topic_title, status_code=200)
+        self.assertContains(response, 'first!')
+
+        queries = [query['sql'] for query in context.captured_queries
+            if 'django_session' not in query['sql'] and 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(queries), 1, queries)
+
+    def test_vote_page_not_modified(self):
+        """
+        Test a vote page revalidated with its ETag gets a 304 after one
+        light query, and a new vote changes the ETag.
+        """
+        topic_title = 'Nothing changed since last time'
+        topic_slug = slugify(unicode(topic_title))
+        cookie_string = hash_md5_random_hexdigest()
+        self.add_topic_test(topic_title, topic_slug, cookie_string)
+
+        client = Client()
+        client.get('/vote/%s/' % topic_slug)    # Shows the cookie message.
+        response = client.get('/vote/%s/' % topic_slug)
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/vote/%s/' % topic_slug, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        queries = [query['sql'] for query in context.captured_queries
+            if 'django_session' not in query['sql'] and 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(queries), 1, queries)
+
+        self.add_vote_test(topic_slug, hash_md5_random_hexdigest(), 'changed', 'true')
+        response = client.get('/vote/%s/' % topic_slug, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'changed', status_code=200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # The visitor's own vote changes its vote state and the ETag.
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session['cookie_string'] = hash_md5_random_hexdigest()
+        session.save()
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        etag = client.get('/vote/%s/' % topic_slug)['ETag']
+        self.add_vote_test(topic_slug, session['cookie_string'], 'mine', 'true')
+        response = client.get('/vote/%s/' % topic_slug, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'You have already voted today.', status_code=200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_vote_page_session_writes(self):
+        """
+        Reading vote pages writes no session; the first vote does.
+        """
+        topic_title = 'Readers leave no trace'
+        topic_slug = slugify(unicode(topic_title))
+        self.add_topic_test(topic_title, topic_slug, hash_md5_random_hexdigest())
+
+        client = Client()
+        for i in range(3):
+            with CaptureQueriesContext(connection) as context:
+                response = client.get('/vote/%s/' % topic_slug)
+            self.assertContains(response, topic_title, status_code=200)
+            writes = [query['sql'] for query in context.captured_queries
+                if 'django_session' in query['sql'] and
+                    query['sql'].split()[0].upper() in ('INSERT', 'UPDATE', 'DELETE')]
+            self.assertEqual(writes, [])
+        self.assertFalse(settings.SESSION_COOKIE_NAME in client.cookies)
+
+    def test_purgedate(self):
+        """
+        Test sliding-window get_purgedate() matches the legacy day-by-day
+        loop, including votes cast exactly at midnight.
+        """
+        topic_slug = 'purge-date-window-test'
+        cursor = connection.cursor()
+        cursor.execute(LEGACY_GET_PURGEDATE)
+        cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+            ['Purge date window test', topic_slug, hash_md5_random_hexdigest(), '2014-01-01'])
+        topic_id = cursor.fetchone()[0]
+        self.add_creator_cookie_test(topic_id)
+
+        # 6 counted votes a day for 50 days, one of them at midnight.
+        cursor.execute('''
+            INSERT INTO badmeter_vote (topic_id, cookie_id, comment, vote, counted, date_created)
+                SELECT topic_id, id, '', TRUE, TRUE,
+                        timestamp '2014-01-01 00:00' + g * interval '4 hours'
+                    FROM badmeter_cookie, generate_series(1, 300) g
+                    WHERE topic_id = %s''', [topic_id])
+        cursor.execute('SELECT rebuild_topic_daily(%s)', [topic_id])
+
+        for now in ('2014-01-02', '2014-01-31 12:00', '2014-02-01', '2014-02-10',
+                '2014-02-19', '2014-03-15', '2014-06-01'):
+            cursor.execute('SELECT purge_date, vote_needed FROM get_purgedate(%s, %s)',
+                [topic_slug, now])
+            window = cursor.fetchall()
+            cursor.execute('SELECT purge_date, vote_needed FROM pg_temp.get_purgedate_loop(%s, %s)',
+                [topic_slug, now])
+            self.assertEqual(window, cursor.fetchall(), now)
+
+        cursor.execute('SELECT purge_date, vote_needed FROM get_purgedate(%s)', ['no-such-topic'])
+        self.assertEqual(cursor.fetchall(), [(None, '100')])
+
+    def test_topic_daily(self):
+        """
+        Test add_vote() and purge_one() keep the badmeter_topic_daily
+        rollup in step with badmeter_vote.
+        """
+        topic_slug = 'daily-rollup-test'
+        cookie_string = hash_md5_random_hexdigest()
+        cursor = connection.cursor()
+        cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+            ['Daily rollup test', topic_slug, cookie_string, '2014-03-01'])
+        topic_id = cursor.fetchone()[0]
+
+        # 3rd vote activates the first 2, 4th is counted right away.
+        for now in ('2014-03-01 10:00', '2014-03-02', '2014-03-03 08:00', '2014-03-03 09:00',
+                '2014-03-04 00:00'):
+            cursor.execute('SELECT return_id FROM add_vote(%s, %s, %s, %s, %s)',
+                [topic_slug, cookie_string, 'daily', 'true', now])
+        cursor.execute('SELECT return_id FROM add_vote(%s, %s, %s, %s, %s)',
+            [topic_slug, hash_md5_random_hexdigest(), 'daily', 'false', '2014-03-04 12:00'])
+
+        cursor.execute('''SELECT day::text, votes_counted, votes_counted_midnight, votes_uncounted
+            FROM badmeter_topic_daily WHERE topic_id = %s ORDER BY day''', [topic_id])
+        self.assertEqual(cursor.fetchall(), [
+            ('2014-03-01', 1, 0, 0),
+            ('2014-03-02', 1, 1, 0),
+            ('2014-03-03', 1, 0, 0),
+            ('2014-03-04', 1, 1, 1)])
+
+        cursor.execute('SELECT count(*) FROM verify_topic_daily()')
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        cursor.execute('SELECT purge_one(%s)', [topic_id])
+        cursor.execute('SELECT count(*) FROM badmeter_topic_daily WHERE topic_id = %s', [topic_id])
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_counter_shards(self):
+        """
+        Test votes on a sharded topic add up to the same counters, read
+        through get_topic_page() before folding and from badmeter_topic
+        after.
+        """
+        cursor = connection.cursor()
+        cookie_strings = [hash_md5_random_hexdigest() for i in range(6)]
+        for topic_slug, shards in (('unsharded-test', 0), ('sharded-test', 4)):
+            cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+                [topic_slug, topic_slug, cookie_strings[0], '2014-03-01'])
+            cursor.execute('SELECT set_counter_shards(%s, %s)', [topic_slug, shards])
+            self.assertTrue(cursor.fetchone()[0])
+            for i, cookie_string in enumerate(cookie_strings):
+                for now in ('2014-03-01', '2014-03-02', '2014-03-03'):
+                    cursor.execute('SELECT return_id FROM add_vote(%s, %s, %s, %s, %s)',
+                        [topic_slug, cookie_string, 'shard', str(i < 4), now])
+
+        cursor.execute('SELECT set_counter_shards(%s, %s)', ['no-such-topic', 4])
+        self.assertFalse(cursor.fetchone()[0])
+
+        def counters(topic_slug):
+            cursor.execute('''SELECT P.topic_badmeter, P.topic_votes_positive,
+                    P.topic_votes_negative
+                FROM badmeter_topic T, get_topic_page(T.id, 1) P
+                WHERE T.topic_slug = %s''', [topic_slug])
+            return cursor.fetchone()
+
+        cursor.execute('''SELECT badmeter, votes_positive, votes_negative FROM badmeter_topic
+            WHERE topic_slug = %s''', ['sharded-test'])
+        self.assertEqual(cursor.fetchone(), (50, 0, 0))
+        cursor.execute('''SELECT count(*) FROM badmeter_topic_counter S, badmeter_topic T
+            WHERE T.topic_slug = %s AND S.topic_id = T.id''', ['sharded-test'])
+        self.assertTrue(cursor.fetchone()[0] > 1)
+        self.assertEqual(counters('sharded-test'), counters('unsharded-test'))
+        self.assertEqual(counters('sharded-test')[:3], (66, 12, 6))
+
+        cursor.execute('SELECT count(*) FROM verify_topic_daily()')
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('''SELECT P.purge_date, P.vote_needed
+            FROM badmeter_topic T, get_purgedate(T.id, '2014-03-03') P
+            WHERE T.topic_slug IN (%s, %s)''', ['sharded-test', 'unsharded-test'])
+        rows = cursor.fetchall()
+        self.assertEqual(rows[0], rows[1])
+
+        cursor.execute('SELECT fold_topic_counters(NULL)')
+        self.assertTrue(cursor.fetchone()[0] >= 1)
+        cursor.execute('SELECT count(*) FROM badmeter_topic_counter')
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('''SELECT count(*) FROM badmeter_topic_daily D, badmeter_topic T
+            WHERE T.topic_slug = %s AND D.topic_id = T.id AND D.shard > 0''', ['sharded-test'])
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('''SELECT badmeter, votes_positive, votes_negative FROM badmeter_topic
+            WHERE topic_slug = %s''', ['sharded-test'])
+        self.assertEqual(cursor.fetchone(), (66, 12, 6))
+        self.assertEqual(counters('sharded-test'), counters('unsharded-test'))
+        cursor.execute('SELECT count(*) FROM verify_topic_daily()')
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_seed_data(self):
+        """
+        Test the seeded votes keep the vote state rules of add_vote().
+        """
+        output = StringIO.StringIO()
+        call_command('seed_data', topics=5, cookies=50, votes=200, days=30, seed=1,
+            stdout=output)
+        self.assertTrue('topics=5 cookies=50' in output.getvalue())
+
+        cursor = connection.cursor()
+        cursor.execute("""SELECT count(*) FROM badmeter_cookie C
+            JOIN badmeter_topic T ON T.id = C.topic_id AND T.topic_slug LIKE 'seed-%'
+            WHERE C.votes_total <> (SELECT count(*) FROM badmeter_vote V WHERE V.cookie_id = C.id)
+                OR C.counted <> (C.votes_total >= 3)""")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        # One vote per day per cookie, all counted from the 3rd one on.
+        cursor.execute("""SELECT count(*) FROM badmeter_vote V
+            JOIN badmeter_cookie C ON C.id = V.cookie_id
+            JOIN badmeter_topic T ON T.id = V.topic_id AND T.topic_slug LIKE 'seed-%'
+            WHERE V.counted IS DISTINCT FROM (CASE WHEN C.counted THEN TRUE END)
+                OR V.date_created > now()""")
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute("""SELECT count(*) FROM (SELECT cookie_id, date_created::date
+            FROM badmeter_vote GROUP BY 1, 2 HAVING count(*) > 1) D""")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        cursor.execute("""SELECT count(*) FROM badmeter_topic T
+            WHERE T.topic_slug LIKE 'seed-%'
+                AND (T.votes_positive, T.votes_negative) <> (
+                    SELECT count(CASE WHEN V.counted AND V.vote THEN 1 END),
+                        count(CASE WHEN V.counted AND NOT V.vote THEN 1 END)
+                    FROM badmeter_vote V WHERE V.topic_id = T.id)""")
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('SELECT count(*) FROM verify_topic_daily()')
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_purge_stale_topics(self):
+        """
+        Test batched purge removes stale topics and their votes and
+        cookies but spares busy and young topics.
+        """
+        cursor = connection.cursor()
+        topic_ids = {}
+        for topic_slug, now in (('stale-one', '2014-01-01'), ('stale-two', '2014-01-02'),
+                ('busy-one', '2014-01-01'), ('young-one', '2014-02-20')):
+            cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+                [topic_slug, topic_slug, hash_md5_random_hexdigest(), now])
+            topic_ids[topic_slug] = cursor.fetchone()[0]
+
+        cursor.execute('SELECT return_id FROM add_vote(%s, %s, %s, %s, %s)',
+            ['stale-two', hash_md5_random_hexdigest(), 'meh', 'true', '2014-01-05'])
+
+        # 120 votes in February on busy-one.
+        self.add_creator_cookie_test(topic_ids['busy-one'])
+        cursor.execute('''
+            INSERT INTO badmeter_vote (topic_id, cookie_id, comment, vote, counted, date_created)
+                SELECT topic_id, id, '', TRUE, TRUE,
+                        timestamp '2014-02-01' + g * interval '4 hours'
+                    FROM badmeter_cookie, generate_series(1, 120) g
+                    WHERE topic_id = %s''', [topic_ids['busy-one']])
+        cursor.execute('SELECT rebuild_topic_daily(%s)', [topic_ids['busy-one']])
+
+        batches = list(purge_stale_topics('2014-03-01', 1))
+        self.assertEqual([batch.topics for batch in batches], [1, 1])
+        self.assertEqual(sum(batch.votes for batch in batches), 1)
+        self.assertEqual(sum(batch.cookies for batch in batches), 1)
+
+        remaining = Topic.objects.filter(id__in=topic_ids.values())
+        self.assertEqual(sorted(remaining.values_list('topic_slug', flat=True)),
+            ['busy-one', 'young-one'])
+        self.assertFalse(Vote.objects.filter(topic_id=topic_ids['stale-two']))
+        self.assertFalse(Cookie.objects.filter(topic_id=topic_ids['stale-one']))
+
+    def test_purge_worker(self):
+        """
+        Test the purge worker purges stale topics slice by slice and a new
+        worker resumes from the saved cursor.
+        """
+        cursor = connection.cursor()
+        topic_ids = []
+        for i, now in enumerate(('2014-01-01', '2014-01-01', '2014-02-20', '2014-01-01',
+                '2014-01-01')):
+            cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+                ['Worker %d' % i, 'worker-%d' % i, hash_md5_random_hexdigest(), now])
+            topic_ids.append(cursor.fetchone()[0])
+
+        worker = PurgeWorker('test', slice_size=2, slice_seconds=0, idle_seconds=0,
+            now='2014-03-01')
+        self.assertTrue(worker.lock())
+        result = list(worker.run(1))[0]
+        self.assertEqual((result.topic_ids, result.purged), (topic_ids[:2], 2))
+        self.assertEqual(PurgeCursor.objects.get(name='test').last_topic_id, topic_ids[1])
+        # The highest topic id of the progress gauge is read once a pass.
+        with CaptureQueriesContext(connection) as context:
+            worker.update_gauges()
+        self.assertEqual(len(context.captured_queries), 0)
+
+        # Restarted, it checks the rest and starts a new pass.
+        worker = PurgeWorker('test', slice_size=2, slice_seconds=0, idle_seconds=0,
+            now='2014-03-01')
+        results = list(worker.run(2))
+        self.assertEqual([r.topic_ids for r in results], [topic_ids[2:4], topic_ids[4:]])
+        self.assertEqual([r.purged for r in results], [1, 1])
+        self.assertTrue(results[-1].finished_pass)
+        state = PurgeCursor.objects.get(name='test')
+        self.assertEqual(state.last_topic_id, 0)
+        self.assertTrue(state.last_pass_finished)
+        self.assertEqual(list(Topic.objects.filter(id__in=topic_ids)
+            .values_list('topic_slug', flat=True)), ['worker-2'])
+        self.assertTrue('badmeter_purge_worker_lag_seconds' in metrics.render())
+
+    def test_vote_partitions(self):
+        """
+        Test monthly badmeter_vote partitions take in the votes of the
+        default partition and expired ones drop with their rollup days.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT partition_votes(1)')
+        cursor.execute('SELECT vote_partitioned()')
+        self.assertTrue(cursor.fetchone()[0])
+
+        topic_slug = 'partitioned-votes-test'
+        cookie_string = hash_md5_random_hexdigest()
+        cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+            ['Partitioned votes test', topic_slug, cookie_string, '2014-01-01'])
+        topic_id = cursor.fetchone()[0]
+        for now in ('2014-01-30', '2014-01-31', '2014-02-01', '2014-03-01'):
+            cursor.execute('SELECT return_id FROM add_vote(%s, %s, %s, %s, %s)',
+                [topic_slug, cookie_string, 'partitioned', 'true', now])
+        cursor.execute('SELECT count(*) FROM badmeter_vote_default')
+        self.assertEqual(cursor.fetchone()[0], 4)
+
+        cursor.execute('SELECT create_vote_partitions(%s, %s)', ['2014-01-15', '2014-03-01'])
+        self.assertEqual([row[0] for row in cursor.fetchall()],
+            ['badmeter_vote_201401', 'badmeter_vote_201402', 'badmeter_vote_201403'])
+        cursor.execute('SELECT count(*) FROM badmeter_vote_default')
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('SELECT count(*) FROM badmeter_vote_201401')
+        self.assertEqual(cursor.fetchone()[0], 2)
+
+        cursor.execute('SELECT partition_name FROM list_expired_vote_partitions(%s, %s)',
+            ['2014-04-15', 2])
+        self.assertEqual(cursor.fetchall(), [('badmeter_vote_201401',)])
+        cursor.execute('SELECT drop_vote_partition(%s)', ['badmeter_vote_201401'])
+
+        self.assertEqual(Vote.objects.filter(topic_id=topic_id).count(), 2)
+        cursor.execute('''SELECT min(day)::text FROM badmeter_topic_daily
+            WHERE topic_id = %s''', [topic_id])
+        self.assertEqual(cursor.fetchone()[0], '2014-02-01')
+        cursor.execute('SELECT count(*) FROM verify_topic_daily()')
+        self.assertEqual(cursor.fetchone()[0], 0)
+        topic = Topic.objects.get(id=topic_id)
+        self.assertEqual(topic.votes_positive, 4)
+
+    def test_cookie_vote_state(self):
+        """
+        Test add_vote() keeps the per cookie vote state on badmeter_cookie.
+        """
+        topic_slug = 'cookie-vote-state-test'
+        cookie_string = hash_md5_random_hexdigest()
+        cursor = connection.cursor()
+        cursor.execute('SELECT return_id FROM add_topic(%s, %s, %s, %s)',
+            ['Cookie vote state test', topic_slug, hash_md5_random_hexdigest(), '2014-03-01'])
+
+        results = []
+        for now, opinion in (('2014-03-01 10:00', 'true'), ('2014-03-01 23:00', 'true'),
+                ('2014-03-02 10:00', 'false'), ('2014-03-03 10:00', 'true'),
+                ('2014-03-04 10:00', 'true')):
+            cursor.execute('SELECT return_id FROM add_vote(%s, %s, %s, %s, %s)',
+                [topic_slug, cookie_string, 'state', opinion, now])
+            results.append(cursor.fetchone()[0] >= 0)
+        self.assertEqual(results, [True, False, True, True, True])
+
+        cookie = Cookie.objects.get(voter__digest=voter_digest(cookie_string),
+            topic__topic_slug=topic_slug)
+        self.assertEqual(cookie.votes_total, 4)
+        self.assertTrue(cookie.counted)
+        self.assertEqual(cookie.date_voted, datetime(2014, 3, 4, 10, 0))
+        self.assertEqual((cookie.votes_positive, cookie.votes_negative), (3, 1))
+
+        topic = Topic.objects.get(topic_slug=topic_slug)
+        self.assertEqual((topic.votes_positive, topic.votes_negative), (3, 1))
+        self.assertEqual(topic.badmeter, 75)
+        self.assertEqual(Vote.objects.filter(topic=topic, counted=True).count(), 4)
+
+    def test_vote_save_many(self):
+        """
+        Test batched Vote.save_many() applies the add_vote() rules and
+        returns per vote status.
+        """
+        topic_title = 'Saving many votes at once'
+        topic_slug = slugify(unicode(topic_title))
+        cookie_string = hash_md5_random_hexdigest()
+        self.add_topic_test(topic_title, topic_slug, hash_md5_random_hexdigest())
+
+        args = [{'topic_slug' : topic_slug, 'cookie_string' : cookie_string,
+            'comment' : 'batch', 'vote' : 'true', 'now' : now}
+            for now in ('2014-03-01', '2014-03-01 12:00', '2014-03-02', '2014-03-03')]
+        args.append({'topic_slug' : 'no-such-topic', 'cookie_string' : cookie_string,
+            'comment' : 'batch', 'vote' : 'true'})
+        args.append({'topic_slug' : topic_slug, 'cookie_string' : cookie_string,
+            'comment' : 'batch', 'vote' : 'maybe', 'now' : '2014-03-04'})
+
+        results = Vote.save_many(args)
+        self.assertEqual([result.if_error for result in results],
+            [False, True, False, False, True, True])
+        self.assertTrue('one vote per day' in results[1].get_error_msg)
+
+        self.assertEqual([result.get_error_code for result in results][4:], [-1, -1])
+
+        topic = Topic.objects.get(topic_slug=topic_slug)
+        self.assertEqual((topic.votes_positive, topic.votes_negative), (3, 0))
+        self.assertEqual(topic.badmeter, 100)
+        self.assertEqual(Vote.objects.filter(topic=topic, counted=True).count(), 3)
+
+        # Batches of 2 split the votes of a voter, a sharded topic keeps
+        # them in its counter rows.
+        cursor = connection.cursor()
+        cursor.execute('SELECT set_counter_shards(%s, %s)', [topic_slug, 4])
+        args = [{'topic_slug' : topic_slug, 'cookie_string' : cookie_string,
+            'comment' : 'batch', 'vote' : str(i % 2 == 0), 'now' : '2014-03-%02d' % day}
+            for i, cookie_string in enumerate([hash_md5_random_hexdigest() for i in range(3)])
+            for day in (5, 5, 6, 7, 8)]
+        results = Vote.save_many(args, 2)
+        self.assertEqual([result.if_error for result in results],
+            [False, True, False, False, False] * 3)
+        cursor.execute('SELECT count(*) FROM verify_vote_counters(ARRAY[%s])', [topic.id])
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('SELECT count(*) FROM verify_topic_daily()')
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('SELECT votes_positive, votes_negative FROM topic_counters(%s)', [topic.id])
+        self.assertEqual(cursor.fetchone(), (3 + 8, 4))
+
+    def test_votes_json(self):
+        """
+        Test the "Older votes" pages of votes_json() walk all votes of a
+        topic newest first without gaps or repeats, also when the last vote
+        of a page is gone by the time the next one is asked for.
+        """
+        topic_title = 'Paging through older votes'
+        topic_slug = slugify(unicode(topic_title))
+        self.add_topic_test(topic_title, topic_slug, hash_md5_random_hexdigest())
+        votes = settings.VOTES_PAGE_SIZE * 2 + 1
+        Vote.save_many([{'topic_slug' : topic_slug,
+            'cookie_string' : hash_md5_random_hexdigest(),
+            'comment' : 'page %d' % i, 'vote' : 'true'} for i in range(votes)])
+
+        client = Client()
+        response = client.get('/vote/%s/' % topic_slug)
+        before = response.context['topic_votes_before']
+        ids = [row[0] for row in response.context['topic_votes']]
+        self.assertEqual(len(ids), settings.VOTES_PAGE_SIZE)
+        Vote.objects.filter(id=ids.pop()).delete()
+        while before is not None:
+            response = client.get('/vote/%s/votes.json' % topic_slug, {'before' : before})
+            page = json.loads(response.content)
+            ids.extend(vote['id'] for vote in page['votes'])
+            before = page['before']
+
+        self.assertEqual(ids, list(Vote.objects.filter(topic__topic_slug=topic_slug)
+            .order_by('-date_created', '-id').values_list('id', flat=True)))
+        self.assertEqual(len(ids), votes - 1)
+
+    def test_configuration_cache(self):
+        """
+        Test the configuration cache matches get_configuration() and only
+        goes to the database again once invalidated or expired.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT interval_days::text, vote_quota FROM get_configuration()')
+        expected = cursor.fetchone()
+
+        cache = ConfigurationCache(ttl_seconds=300, listen=False)
+        self.assertEqual(cache.get(), expected)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual((cache.interval_days, cache.vote_quota), expected)
+        self.assertEqual(len(queries), 0)
+
+        cache.invalidate()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(cache.get(), expected)
+        self.assertEqual(len(queries), 1)
+
+        cache = ConfigurationCache(ttl_seconds=0, listen=False)
+        cache.get()
+        with CaptureQueriesContext(connection) as queries:
+            cache.get()
+        self.assertEqual(len(queries), 1)
+
+    def test_topic_stats_cache(self):
+        """
+        Test the topic stats cache serves current entries, is written
+        through by Vote.save() and dropped by Vote.save_many().
+        """
+        topic_title = 'Caching the stats of a topic'
+        topic_slug = slugify(unicode(topic_title))
+        cookie_string = hash_md5_random_hexdigest()
+        self.add_topic_test(topic_title, topic_slug, cookie_string)
+
+        counts = (hits.value, misses.value)
+        page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string)
+        self.assertEqual(page['topic'][0], topic_title)
+        self.assertEqual(page['votes'], [])
+        page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string)
+        self.assertEqual((hits.value, misses.value), (counts[0] + 1, counts[1] + 1))
+
+        self.add_vote_test(topic_slug, cookie_string, 'cached', 'true')
+        with CaptureQueriesContext(connection) as queries:
+            page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([vote[3] for vote in page['votes']], ['cached'])
+        self.assertTrue('already voted today' in visitor.status_message)
+        self.assertEqual((hits.value, misses.value), (counts[0] + 2, counts[1] + 1))
+
+        Vote.save_many([{'topic_slug' : topic_slug, 'cookie_string' : hash_md5_random_hexdigest(),
+            'comment' : 'batch', 'vote' : 'false'}])
+        self.assertEqual(caches[settings.TOPIC_STATS_CACHE].get(topic_stats_cache.key(topic_slug)), None)
+        page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string)
+        self.assertEqual(len(page['votes']), 2)
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT purge_one(%s::text)', [topic_slug])
+        page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string)
+        self.assertEqual(page['topic'], None)
+
+    def test_visitor_state_ids(self):
+        """
+        Test the visitor state resolves the topic and cookie ids once and
+        a cache miss with a known state loads the page by topic id.
+        """
+        topic_title = 'Resolving a topic once per request'
+        topic_slug = slugify(unicode(topic_title))
+        cookie_string = hash_md5_random_hexdigest()
+        self.add_topic_test(topic_title, topic_slug, cookie_string)
+        self.add_vote_test(topic_slug, cookie_string, 'resolved', 'true')
+        topic = Topic.objects.get(topic_slug=topic_slug)
+
+        state = topic_stats_cache.get_visitor_state(topic_slug, cookie_string)
+        self.assertEqual(state.topic_id, topic.id)
+        self.assertEqual(state.cookie_id,
+            Cookie.objects.get(topic=topic, voter__digest=voter_digest(cookie_string)).id)
+        self.assertTrue('already voted today' in state.status_message)
+
+        topic_stats_cache.delete(topic_slug)
+        with CaptureQueriesContext(connection) as context:
+            page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string, state)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertFalse('get_vote_page' in context.captured_queries[0]['sql'])
+        self.assertEqual(page['topic'][0], topic_title)
+        self.assertEqual([vote[3] for vote in page['votes']], ['resolved'])
+        self.assertEqual(visitor, state)
+
+        # The one round trip of a miss returns the same state.
+        topic_stats_cache.delete(topic_slug)
+        page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string)
+        self.assertEqual(visitor, state)
+
+        state = topic_stats_cache.get_visitor_state(topic_slug, hash_md5_random_hexdigest())
+        self.assertEqual((state.topic_id, state.cookie_id), (topic.id, None))
+        self.assertTrue('new to this topic' in state.status_message)
+        state = topic_stats_cache.get_visitor_state('no-such-topic', cookie_string)
+        self.assertEqual((state.topic_id, state.topic_date_updated), (None, None))
+        self.assertTrue('Non-existing topic' in state.status_message)
+
+    def test_voter(self):
+        """
+        Test a visitor is one voter across topics, with counters per topic
+        only once it votes, and is purged with its last topic.
+        """
+        cookie_string = hash_md5_random_hexdigest()
+        for title in ('Voters are kept once', 'Voters are kept once more'):
+            self.add_topic_test(title, slugify(unicode(title)), cookie_string)
+        voter = Voter.objects.get(digest=voter_digest(cookie_string))
+        topics = Topic.objects.filter(voter=voter)
+        self.assertEqual(topics.count(), 2)
+        self.assertFalse(Cookie.objects.filter(voter=voter))
+
+        self.add_vote_test('voters-are-kept-once', cookie_string, 'one voter', 'true')
+        self.add_vote_test('voters-are-kept-once-more', cookie_string, 'one voter', 'false')
+        self.assertEqual(Voter.objects.filter(digest=voter_digest(cookie_string)).count(), 1)
+        self.assertEqual(Cookie.objects.filter(voter=voter).count(), 2)
+
+        rows = db.fetchall('list_votes', ['voters-are-kept-once', None, None, 5])
+        self.assertEqual(rows[0][2], voter_hexdigest(cookie_string))
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT purge_one(%s::text)', ['voters-are-kept-once'])
+        self.assertTrue(Voter.objects.filter(id=voter.id))
+        cursor.execute('SELECT purge_voters(ARRAY[%s])', [voter.id])
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute('SELECT purge_one(%s::text)', ['voters-are-kept-once-more'])
+        self.assertFalse(Voter.objects.filter(id=voter.id))
+
+    def test_prepared_statements(self):
+        """
+        Test declared calls are prepared once per connection and then
+        run with EXECUTE only.
+        """
+        topic_title = 'Prepared statements save parsing'
+        self.add_topic_test(topic_title, slugify(unicode(topic_title)),
+            hash_md5_random_hexdigest())
+
+        db.fetchall('list_topics', ['Prepared'])
+        with CaptureQueriesContext(connection) as context:
+            rows = db.fetchall('list_topics', ['Prepared'])
+        self.assertEqual([row[2] for row in rows], [topic_title])
+        self.assertEqual([query['sql'].split('(')[0] for query in context.captured_queries],
+            ['EXECUTE badmeter_list_topics'])
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM pg_prepared_statements WHERE name = 'badmeter_list_topics'")
+        self.assertTrue(cursor.fetchone())
+
+        # A call without parameters is prepared without a type list.
+        self.assertEqual(db.fetchall('get_configuration'), db.fetchall('get_configuration'))
+        cursor.execute("SELECT name FROM pg_prepared_statements WHERE name = 'badmeter_get_configuration'")
+        self.assertTrue(cursor.fetchone())
 
     def test_model_forms(self):
         """
@@ -284,3 +1241,30 @@ class Test_main(TestCase):
         self.assertTemplateUsed(response, template_name='base.html')
         self.assertTemplateUsed(response, template_name='stats_table.html')
         self.assertTemplateUsed(response, template_name='google_gauge.html')
+
+
+class Test_concurrency(TransactionTestCase):
+    """
+    The worker processes of stress_votes need committed topics and votes,
+    so these tests commit and the tables are flushed after each.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        Test_main.setUpClass()
+
+    def test_stress_votes(self):
+        """
+        Test the same topics and votes added from several processes at once
+        keep one topic per slug, add no voter for the topic adds that lose
+        the race, one vote per voter a day and the counters in step with the
+        raw votes.
+        """
+        output = StringIO.StringIO()
+        call_command('stress_votes', processes=4, topics=2, voters=10, days=4, shards=3,
+            stdout=output)
+        self.assertTrue('counters consistent' in output.getvalue())
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT count(*) FROM badmeter_topic WHERE topic_slug LIKE %s', ['stress-%'])
+        self.assertEqual(cursor.fetchone()[0], 0)
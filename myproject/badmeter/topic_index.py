@@ -0,0 +1,159 @@
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from django.db.models import Q
+from myproject import settings
+from .models import Topic, TopicEvent
+from .misc import strip_extra_spaces
+import threading
+import time
+
+# Process-local prefix index over topic titles for the /search/ autocomplete.
+#
+# Topic titles are kept in a sorted list of (normalized_title, topic_title,
+# id, topic_slug) tuples. A prefix search is a bisect to the first candidate
+# followed by a short forward walk, so answering the top 25 matches costs no
+# database round trip.
+#
+# The index stays fresh incrementally. Topic.save() adds its own topic right
+# away. Topics added or purged by other processes (or by the purge cron) are
+# picked up from the badmeter_topic_event log, written by the add_topic()
+# and purge_one() stored functions, at most once every
+# TOPIC_INDEX_REFRESH_SECONDS. A full reload only happens on first use and
+# when the index is older than TOPIC_INDEX_MAX_AGE_SECONDS, which must stay
+# below the event log retention used in purge_scan().
+#
+# Event ids are taken when the event is written, not when it commits. An
+# event of a transaction still running, e.g. of a long purge, is not yet
+# seen when later ids are. The ids missing below the last one read are
+# kept as gaps and read again on each refresh, until they show up or are
+# older than TOPIC_INDEX_GAP_SECONDS. Ids of rolled back events never do.
+
+
+def normalize_title(title):
+    return strip_extra_spaces(title).lower()
+
+
+class TopicPrefixIndex(object):
+    """
+    Sorted array of normalized topic titles searched with bisect.
+    """
+    def __init__(self, refresh_seconds=None, max_age_seconds=None, gap_seconds=None):
+        self.refresh_seconds = (settings.TOPIC_INDEX_REFRESH_SECONDS
+            if refresh_seconds is None else refresh_seconds)
+        self.max_age_seconds = (settings.TOPIC_INDEX_MAX_AGE_SECONDS
+            if max_age_seconds is None else max_age_seconds)
+        self.gap_seconds = (settings.TOPIC_INDEX_GAP_SECONDS
+            if gap_seconds is None else gap_seconds)
+        self._lock = threading.RLock()
+        self._keys = []
+        self._by_id = {}
+        self._event_id = None
+        # Event ids not seen below _event_id, and since when.
+        self._gaps = {}
+        self._loaded_at = 0
+        self._checked_at = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, topic_id, topic_title, topic_slug):
+        key = (normalize_title(topic_title), topic_title, topic_id, topic_slug)
+        with self._lock:
+            if topic_id in self._by_id:
+                self._remove(topic_id)
+            insort(self._keys, key)
+            self._by_id[topic_id] = key
+
+    def remove(self, topic_id):
+        with self._lock:
+            self._remove(topic_id)
+
+    def _remove(self, topic_id):
+        key = self._by_id.pop(topic_id, None)
+        if key is not None:
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def load(self, rows, event_id=0):
+        """
+        Replace the whole index with rows of (id, topic_title, topic_slug).
+        """
+        keys = sorted((normalize_title(title), title, topic_id, slug)
+            for topic_id, title, slug in rows)
+        with self._lock:
+            self._keys = keys
+            self._by_id = dict((key[2], key) for key in keys)
+            self._event_id = event_id
+            self._gaps = {}
+            self._loaded_at = self._checked_at = time.time()
+
+    def _add_gaps(self, event_ids, low, high, now):
+        """
+        Keep the ids in (low, high] missing from event_ids as gaps.
+        """
+        for event_id in set(range(low + 1, high + 1)).difference(event_ids):
+            self._gaps.setdefault(event_id, now)
+
+    def search(self, term, limit=25):
+        """
+        Return up to limit (id, topic_slug, topic_title) whose normalized
+        title starts with the normalized term.
+        """
+        prefix = normalize_title(term)
+        rows = []
+        with self._lock:
+            i = bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(rows) < limit:
+                normalized, title, topic_id, slug = self._keys[i]
+                if not normalized.startswith(prefix):
+                    break
+                rows.append((topic_id, slug, title))
+                i += 1
+        return rows
+
+    def refresh(self):
+        """
+        Bring the index up to date with the database. Reads only the
+        topic events logged since the last refresh and the gaps.
+        """
+        now = time.time()
+        if self._event_id is not None and now - self._checked_at < self.refresh_seconds:
+            return
+
+        with self._lock:
+            if self._event_id is None or now - self._loaded_at > self.max_age_seconds:
+                # Grab the event high-water mark before the topics so no
+                # add/purge between the two reads is missed.
+                event_id = TopicEvent.objects.order_by('-id').values_list('id', flat=True)[:1]
+                event_id = event_id[0] if event_id else 0
+                self.load(Topic.objects.values_list('id', 'topic_title', 'topic_slug').iterator(),
+                    event_id)
+                # The gaps among the recent events below the high-water mark.
+                since = datetime.now() - timedelta(seconds=self.gap_seconds)
+                low = list(TopicEvent.objects.filter(date_created__gte=since).order_by('id')
+                    .values_list('id', flat=True)[:1])
+                if low:
+                    self._add_gaps(TopicEvent.objects.filter(id__gte=low[0], id__lte=event_id)
+                        .values_list('id', flat=True), low[0] - 1, event_id, now)
+
+            events = (TopicEvent.objects.filter(Q(id__gt=self._event_id) | Q(id__in=list(self._gaps)))
+                .order_by('id').values_list('id', 'event', 'topic_id', 'topic_title', 'topic_slug'))
+            new_ids = []
+            for event_id, event, topic_id, topic_title, topic_slug in events:
+                if event == TopicEvent.ADD:
+                    self.add(topic_id, topic_title, topic_slug)
+                else:
+                    self.remove(topic_id)
+                if self._gaps.pop(event_id, None) is None:
+                    new_ids.append(event_id)
+            if new_ids:
+                self._add_gaps(new_ids, self._event_id, new_ids[-1], now)
+                self._event_id = new_ids[-1]
+            self._gaps = dict((event_id, missing_since)
+                for event_id, missing_since in self._gaps.items()
+                if now - missing_since < self.gap_seconds)
+            self._checked_at = now
+
+
+topic_index = TopicPrefixIndex()
@@ -0,0 +1,22 @@
+
+-- Upgrade an existing database for the per cookie vote state kept on
+-- badmeter_cookie by add_vote(). Run once in psql before reloading
+-- all.sql:
+--     badmeter=> \i badmeter/upgrade/001_cookie_vote_state.sql
+ALTER TABLE badmeter_cookie
+    ADD COLUMN votes_total integer NOT NULL DEFAULT 0,
+    ADD COLUMN counted boolean NOT NULL DEFAULT FALSE,
+    ADD COLUMN date_voted timestamp with time zone NULL;
+
+UPDATE badmeter_cookie C
+    SET votes_total = V.votes_total,
+        counted = (V.votes_total >= 3),
+        date_voted = V.date_voted
+    FROM (
+        SELECT cookie_id, count(*) AS votes_total, max(date_created) AS date_voted
+            FROM badmeter_vote
+            GROUP BY cookie_id) V
+    WHERE V.cookie_id = C.id;
+
+CREATE INDEX CONCURRENTLY badmeter_vote_topic_id_cookie_id_date_created
+    ON badmeter_vote (topic_id, cookie_id, date_created);
@@ -0,0 +1,6 @@
+
+-- Upgrade an existing database for the keyset paged vote history of
+-- list_votes(). Run once in psql:
+--     badmeter=> \i badmeter/upgrade/002_vote_keyset_index.sql
+CREATE INDEX CONCURRENTLY badmeter_vote_topic_id_date_created_id
+    ON badmeter_vote (topic_id, date_created, id);
@@ -0,0 +1,96 @@
+-- Upgrade an existing database for the badmeter_voter table. Each visitor
+-- id is kept once as its 16-byte md5 digest instead of a 100 character
+-- cookie_string on every badmeter_cookie row, and badmeter_cookie keeps
+-- the counters per (voter_id, topic_id). Topics point at their creator
+-- voter instead of a zero vote badmeter_cookie row. Run once in psql
+-- before reloading all.sql:
+--     badmeter=> \i badmeter/upgrade/003_voter.sql
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS badmeter_voter (
+    id serial PRIMARY KEY,
+    digest bytea NOT NULL UNIQUE,
+    date_created timestamp with time zone NOT NULL
+);
+
+INSERT INTO badmeter_voter (digest, date_created)
+    SELECT decode(md5(cookie_string), 'hex'), min(date_created)
+        FROM badmeter_cookie
+        GROUP BY 1;
+
+ALTER TABLE badmeter_cookie
+    ADD COLUMN voter_id integer;
+
+UPDATE badmeter_cookie C
+    SET voter_id = W.id
+    FROM badmeter_voter W
+    WHERE W.digest = decode(md5(C.cookie_string), 'hex');
+
+-- The creator of a topic was its first badmeter_cookie row.
+ALTER TABLE badmeter_topic
+    ADD COLUMN voter_id integer NULL
+        REFERENCES badmeter_voter (id) DEFERRABLE INITIALLY DEFERRED;
+
+UPDATE badmeter_topic T
+    SET voter_id = C.voter_id
+    FROM badmeter_cookie C
+    WHERE C.id = T.cookie_id;
+
+ALTER TABLE badmeter_topic
+    DROP COLUMN cookie_id;
+
+CREATE INDEX badmeter_topic_voter_id
+    ON badmeter_topic (voter_id);
+
+-- Zero vote rows of topic creators are no longer kept.
+DELETE FROM badmeter_cookie C
+    WHERE NOT EXISTS (SELECT 1 FROM badmeter_vote V WHERE V.cookie_id = C.id);
+
+-- Racing first votes may have left two rows of a cookie on a topic.
+-- Move their votes to the oldest one and recount its vote state.
+CREATE TEMPORARY TABLE upgrade_cookie_merge ON COMMIT DROP AS
+    SELECT id, keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY voter_id, topic_id) AS keep_id
+            FROM badmeter_cookie) K
+        WHERE id <> keep_id;
+
+UPDATE badmeter_vote V
+    SET cookie_id = M.keep_id
+    FROM upgrade_cookie_merge M
+    WHERE V.cookie_id = M.id;
+
+DELETE FROM badmeter_cookie C
+    USING upgrade_cookie_merge M
+    WHERE C.id = M.id;
+
+UPDATE badmeter_cookie C
+    SET votes_total = V.votes_total,
+        counted = (V.votes_total >= 3),
+        date_voted = V.date_voted,
+        votes_positive = V.votes_positive,
+        votes_negative = V.votes_negative
+    FROM (
+        SELECT cookie_id, count(*) AS votes_total, max(date_created) AS date_voted,
+                sum(CASE WHEN counted IS TRUE AND vote IS TRUE THEN 1 ELSE 0 END) AS votes_positive,
+                sum(CASE WHEN counted IS TRUE AND vote IS NOT TRUE THEN 1 ELSE 0 END) AS votes_negative
+            FROM badmeter_vote
+            GROUP BY cookie_id) V
+    WHERE V.cookie_id = C.id
+        AND C.id IN (SELECT DISTINCT keep_id FROM upgrade_cookie_merge);
+
+ALTER TABLE badmeter_cookie
+    ALTER COLUMN voter_id SET NOT NULL,
+    ADD CONSTRAINT badmeter_cookie_voter_id_fk
+        FOREIGN KEY (voter_id) REFERENCES badmeter_voter (id) DEFERRABLE INITIALLY DEFERRED,
+    ADD CONSTRAINT badmeter_cookie_voter_id_topic_id_uniq
+        UNIQUE (voter_id, topic_id),
+    DROP COLUMN cookie_string;
+
+-- Visitor ids that only ever created topics which are gone since.
+DELETE FROM badmeter_voter W
+    WHERE NOT EXISTS (SELECT 1 FROM badmeter_cookie C WHERE C.voter_id = W.id)
+        AND NOT EXISTS (SELECT 1 FROM badmeter_topic T WHERE T.voter_id = W.id);
+
+COMMIT;
+
+VACUUM FULL ANALYZE badmeter_cookie;
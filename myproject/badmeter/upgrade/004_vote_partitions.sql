@@ -0,0 +1,26 @@
+-- Upgrade badmeter_vote to monthly range partitions on date_created.
+-- Needs PostgreSQL 11 or later. Run once in psql from the myproject
+-- folder, also on new databases after "python manage.py migrate":
+--     badmeter=> \i badmeter/upgrade/004_vote_partitions.sql
+-- Then keep the partitions with "python manage.py vote_partitions".
+\i badmeter/sql/vote_partitions.sql
+
+BEGIN;
+
+-- add_vote() reads the earlier votes of a cookie from its date_created
+-- on. Cookie rows merged by 003_voter.sql may be younger than their
+-- first vote.
+UPDATE badmeter_cookie C
+    SET date_created = V.date_first
+    FROM (
+        SELECT cookie_id, min(date_created) AS date_first
+            FROM badmeter_vote
+            GROUP BY cookie_id) V
+    WHERE V.cookie_id = C.id
+        AND V.date_first < C.date_created;
+
+SELECT partition_votes(3);
+
+COMMIT;
+
+ANALYZE badmeter_vote;
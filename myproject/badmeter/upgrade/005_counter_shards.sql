@@ -0,0 +1,35 @@
+-- Upgrade an existing database for sharded topic vote counters, see
+-- badmeter/sql/topic_counters.sql. The badmeter_topic_counter table is
+-- created by "python manage.py migrate". Run once in psql before
+-- reloading all.sql:
+--     badmeter=> \i badmeter/upgrade/005_counter_shards.sql
+BEGIN;
+
+ALTER TABLE badmeter_topic
+    ADD COLUMN counter_shards smallint NULL;
+
+-- The daily rollup gets a row per shard per day. Existing rows are
+-- shard 0.
+ALTER TABLE badmeter_topic_daily
+    ADD COLUMN shard smallint NOT NULL DEFAULT 0;
+
+DO $$
+DECLARE
+    t_constraint text;
+BEGIN
+    FOR t_constraint IN
+        SELECT conname
+            FROM pg_constraint
+            WHERE conrelid = 'badmeter_topic_daily'::regclass
+                AND contype = 'u'
+    LOOP
+        EXECUTE format('ALTER TABLE badmeter_topic_daily DROP CONSTRAINT %I', t_constraint);
+    END LOOP;
+END;
+$$;
+
+ALTER TABLE badmeter_topic_daily
+    ADD CONSTRAINT badmeter_topic_daily_topic_id_day_shard_uniq
+        UNIQUE (topic_id, day, shard);
+
+COMMIT;
@@ -0,0 +1,31 @@
+-- Upgrade an existing database for the unique badmeter_topic.topic_slug
+-- that add_topic() relies on under concurrent requests. Run once in psql
+-- before reloading all.sql:
+--     badmeter=> \i badmeter/upgrade/006_topic_slug_unique.sql
+BEGIN;
+
+-- Racing adds of a topic may have left several topics with one slug.
+-- The oldest keeps it, the others get their id appended and are
+-- re-logged for the in-process search indexes.
+CREATE TEMPORARY TABLE upgrade_topic_slug ON COMMIT DROP AS
+    SELECT id, left(topic_slug, 99 - length(id::text)) || '-' || id AS topic_slug
+        FROM (SELECT id, topic_slug,
+                    min(id) OVER (PARTITION BY topic_slug) AS keep_id
+                FROM badmeter_topic) K
+        WHERE id <> keep_id;
+
+UPDATE badmeter_topic T
+    SET topic_slug = S.topic_slug
+    FROM upgrade_topic_slug S
+    WHERE T.id = S.id;
+
+INSERT INTO badmeter_topic_event (topic_id, topic_title, topic_slug, event, date_created)
+    SELECT T.id, T.topic_title, T.topic_slug, 'add', now()
+        FROM badmeter_topic T, upgrade_topic_slug S
+        WHERE T.id = S.id;
+
+ALTER TABLE badmeter_topic
+    ADD CONSTRAINT badmeter_topic_topic_slug_uniq
+        UNIQUE (topic_slug);
+
+COMMIT;
@@ -1,39 +1,137 @@
 
-from django.http import HttpResponse
-from django.db import connection
+from django.http import HttpResponse, Http404
 from django.shortcuts import redirect
 from django.views.generic import TemplateView
 from django.views.generic.edit import FormView
 from django.contrib import messages
 from django.core.urlresolvers import reverse_lazy
 from django.utils.text import slugify
+from django.utils import dateformat
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from myproject import settings
 from .models import Topic, Vote, Cookie, CheckModelSave
 from .forms import TopicModelForm, VoteModelForm
-from .misc import print_info, strip_extra_spaces, ageindays_string
+from .misc import (print_info, strip_extra_spaces, ageindays_string, get_cookie_string,
+    voter_hexdigest, vote_cursor, parse_vote_cursor)
+from .topic_index import topic_index
+from .configuration import configuration
+from .stats_cache import topic_stats_cache
+from .search_cache import search_cache
+from . import db
+from . import metrics
+from datetime import date
 import sys
 import json
 import re
+import hashlib
 
 
 def search(request):
     search_str = strip_extra_spaces(request.GET.get('term', ''))
-    cursor = connection.cursor()
-    cursor.execute('SELECT id, topic_slug, topic_title FROM list_topics(%s)', [search_str])
-    rows = [{'id':row[0],'link':row[1],'label':row[2],'value':row[2]} for row in cursor.fetchall()]
-    return HttpResponse(json.dumps(rows), content_type="application/json")
+    rows = search_cache.get(search_str)
+    if rows is None:
+        if settings.TOPIC_INDEX_ENABLED:
+            # Answered from the in-process prefix index, no database round trip.
+            topic_index.refresh()
+            topics = topic_index.search(search_str, 25)
+        else:
+            topics = db.fetchall('list_topics', [search_str])
+        rows = [{'id':row[0],'link':row[1],'label':row[2],'value':row[2]} for row in topics]
+        search_cache.set(search_str, rows)
+    response = HttpResponse(json.dumps(rows), content_type="application/json")
+    # Same answer for everyone so proxies may keep it too.
+    patch_cache_control(response, public=True, max_age=settings.SEARCH_CACHE_SECONDS)
+    return response
+
+
+def metrics_text(request):
+    """
+    badmeter.metrics in the Prometheus text format, for local scrapers
+    only. Proxied requests are refused even from a local proxy.
+    """
+    if (request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS or
+            'HTTP_X_FORWARDED_FOR' in request.META):
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
+
+
+def votes_json(request, slug):
+    """
+    Page of votes of a topic older than the vote_cursor() in ?before=,
+    for the "Older votes" button of the vote page.
+    """
+    before_date, before_id = parse_vote_cursor(request.GET.get('before', ''))
+    topic_votes = db.fetchall('list_votes',
+        [slug, before_date, before_id, settings.VOTES_PAGE_SIZE + 1])
+
+    # Votes show the voter digest, not the visitor id.
+    voter = voter_hexdigest(get_cookie_string(request))
+    votes = [{
+        'id' : row[0],
+        'counted' : bool(row[1]),
+        'cookie_string' : row[2],
+        'mine' : (voter is not None and row[2] == voter),
+        'comment' : row[3],
+        'vote' : bool(row[4]),
+        'date_created' : dateformat.format(row[5], settings.VOTES_DATE_FORMAT),
+        'votes_negative' : row[6],
+        'votes_positive' : row[7]} for row in topic_votes[:settings.VOTES_PAGE_SIZE]]
+    return HttpResponse(json.dumps({
+        'votes' : votes,
+        'before' : (vote_cursor(topic_votes[settings.VOTES_PAGE_SIZE - 1][5],
+            topic_votes[settings.VOTES_PAGE_SIZE - 1][0])
+            if len(topic_votes) > settings.VOTES_PAGE_SIZE else None)}),
+        content_type="application/json")
+
+
+def visitor_state(request, slug):
+    """
+    VisitorState of the vote page, queried once per request. It carries
+    the topic and cookie ids the rest of the request uses instead of the
+    slug and cookie string.
+    """
+    if not hasattr(request, 'visitor_state'):
+        request.visitor_state = topic_stats_cache.get_visitor_state(
+            slug, get_cookie_string(request))
+    return request.visitor_state
+
+
+def vote_page_etag(request, slug):
+    """
+    Validator of a vote page: it only changes with the topic (its
+    date_updated, which every vote moves forward), the visitor's vote
+    state and the day. The visitor's counters and status message, which
+    tells the votes left until they count and whether they voted today,
+    are part of it.
+    """
+    if len(messages.get_messages(request)):
+        # Pending messages are shown once so never answer 304.
+        return None
+    return hashlib.md5(repr((slug, get_cookie_string(request),
+        request.META.get('CSRF_COOKIE'), visitor_state(request, slug),
+        date.today()))).hexdigest()
 
 
 class SessionViewMixin(object):
+    # Plain cookie telling a returning browser keeps cookies. Checking
+    # for it replaces the session test cookie, which wrote the session
+    # on every page view.
+    seen_cookie_name = 'badmeter_seen'
+
     def dispatch(self, request, *args, **kwargs):
         messages.set_level(request, messages.DEBUG)
-        if request.session.test_cookie_worked():
-            request.session.delete_test_cookie()
-        else:
+        seen = (self.seen_cookie_name in request.COOKIES
+            or settings.SESSION_COOKIE_NAME in request.COOKIES)
+        if not seen:
             messages.info(request, 'This website uses cookies.')
 
-        request.session.set_test_cookie()
-        return super(SessionViewMixin, self).dispatch(request, *args, **kwargs)
+        response = super(SessionViewMixin, self).dispatch(request, *args, **kwargs)
+        if not seen:
+            response.set_cookie(self.seen_cookie_name, '1',
+                max_age=settings.SESSION_COOKIE_AGE, httponly=True)
+        return response
 
 
 class StatsTableMixin(object):
@@ -42,19 +140,24 @@ class StatsTableMixin(object):
         cookie_string = self.initial.get('cookie_string','')
         topic_slug = self.initial.get('topic_slug','')
 
-        topic = Topic.objects.filter(topic_slug=topic_slug)
-        cookie = Cookie.objects.filter(cookie_string=cookie_string, topic=topic)
+        # The topic part comes from the topic stats cache when current.
+        # See badmeter/stats_cache.py.
+        page, visitor = topic_stats_cache.get_vote_page(topic_slug, cookie_string,
+            getattr(self.request, 'visitor_state', None))
+        topic = page['topic']
+        topic_votes = page['votes']
 
-        if cookie:
+        # Shown as in the vote list, see misc.voter_hexdigest().
+        context['cookie_string'] = voter_hexdigest(cookie_string)
+        if visitor.cookie_date_created:
             context.update({
-                'cookie_string' : cookie[0].cookie_string,
-                'cookie_ageindays_string' : ageindays_string(cookie[0].date_created),
-                'cookie_total_votes' : (cookie[0].votes_positive + cookie[0].votes_negative),
-                'cookie_votes_positive' : cookie[0].votes_positive,
-                'cookie_votes_negative' : cookie[0].votes_negative})
+                'cookie_ageindays_string' : ageindays_string(visitor.cookie_date_created),
+                'cookie_total_votes' : (visitor.cookie_votes_positive +
+                    visitor.cookie_votes_negative),
+                'cookie_votes_positive' : visitor.cookie_votes_positive,
+                'cookie_votes_negative' : visitor.cookie_votes_negative})
         else:
             context.update({
-                'cookie_string' : cookie_string,
                 'cookie_ageindays_string' : 0,
                 'cookie_total_votes' : 0,
                 'cookie_votes_positive' : 0,
@@ -62,14 +165,16 @@ class StatsTableMixin(object):
 
         if topic:
             context.update({
-                'topic_ageindays_string' : ageindays_string(topic[0].date_created),
-                'topic_total_votes' : (topic[0].votes_positive + topic[0].votes_negative),
-                'topic_votes_positive' : topic[0].votes_positive,
-                'topic_votes_negative' : topic[0].votes_negative,
-                'topic_badmeter' : topic[0].badmeter,
-                'topic_created' : topic[0].date_created})
+                'topic_title' : topic[0],
+                'topic_ageindays_string' : ageindays_string(topic[5]),
+                'topic_total_votes' : (topic[3] + topic[4]),
+                'topic_votes_positive' : topic[3],
+                'topic_votes_negative' : topic[4],
+                'topic_badmeter' : topic[2],
+                'topic_created' : topic[5]})
         else:
             context.update({
+                'topic_title' : '',
                 'topic_ageindays_string' : 0,
                 'topic_total_votes' : 0,
                 'topic_votes_positive' : 0,
@@ -77,43 +182,39 @@ class StatsTableMixin(object):
                 'topic_badmeter' : 50,
                 'topic_created' : '0000-00-00'})
 
-        cursor = connection.cursor()
-        cursor.execute('SELECT purge_date, vote_needed FROM get_purgedate(%s)', [topic_slug,])
-        topic_purge = cursor.fetchall()
-
-        if topic_purge[0][0]:
-            context.update({
-                'topic_purgedate' : '%s, needed votes: %s' % (topic_purge[0][0], topic_purge[0][1])})
-        else:
-            # New topic so no purge-date yet then just get from configuration setting.
-            cursor.execute('SELECT interval_days::text, vote_quota FROM get_configuration()')
-            topic_purge = cursor.fetchall()
-            context.update({
-                'topic_purgedate' : '%s, needed votes: %s' % (topic_purge[0][0], topic_purge[0][1])})
-
-        cursor.execute('SELECT status_message FROM get_status_message(%s, %s)',
-            [topic_slug, cookie_string])
-        status_message = cursor.fetchall()
         context.update({
-            'status_message' : status_message[0][0],
-            'allow_vote' : (re.search('can vote today.', status_message[0][0]) is not None)})
+            'topic_purgedate' : '%s, needed votes: %s' % (page['purge_date'], page['vote_needed']),
+            'topic_votes' : topic_votes[:settings.VOTES_PAGE_SIZE],
+            # Older votes are lazy-loaded from votes_json().
+            'topic_votes_before' : (vote_cursor(topic_votes[settings.VOTES_PAGE_SIZE - 1][5],
+                topic_votes[settings.VOTES_PAGE_SIZE - 1][0])
+                if len(topic_votes) > settings.VOTES_PAGE_SIZE else None),
+            'votes_date_format' : settings.VOTES_DATE_FORMAT,
+            'status_message' : visitor.status_message,
+            'allow_vote' : (re.search('can vote today.', visitor.status_message) is not None)})
         return context
 
 
 class HomeTemplateView(SessionViewMixin, TemplateView):
     template_name = 'home.html'
 
+    def get(self, request, *args, **kwargs):
+        has_messages = len(messages.get_messages(request))
+        response = super(HomeTemplateView, self).get(request, *args, **kwargs)
+        if not has_messages:
+            # Static apart from the configuration values. Private since
+            # the topic form carries the visitor's CSRF token.
+            patch_cache_control(response, private=True,
+                max_age=settings.HOME_PAGE_CACHE_SECONDS)
+        return response
+
     def get_context_data(self, **kwargs):
         context = super(HomeTemplateView, self).get_context_data(**kwargs)
         context['topic_badmeter'] = 50
 
         if not settings.TESTING:
-            # Grab from configuration setting.
-            cursor = connection.cursor()
-            cursor.execute('SELECT interval_days::text, vote_quota FROM get_configuration()')
-            topic_purge = cursor.fetchall()
-            context['interval_days'] = topic_purge[0][0]
-            context['vote_quota'] = topic_purge[0][1]
+            # Grab from the cached configuration setting.
+            context['interval_days'], context['vote_quota'] = configuration.get()
 
         return context
 
@@ -128,18 +229,40 @@ class TopicFormView(SessionViewMixin, StatsTableMixin, FormView):
         topic_title = strip_extra_spaces(request.POST.get('topic_title'))
         topic_slug = slugify(unicode(topic_title))
 
-        topic = self.model.objects.filter(topic_title__istartswith=topic_title).order_by('topic_title')
-        if topic and topic_slug:
-            topic_slug = topic[0].topic_slug
-            return redirect('/vote/%s' % topic_slug, permanent=True)
+        existing_slug = self.find_topic_slug(topic_title, topic_slug)
+        if existing_slug:
+            return redirect('/vote/%s' % existing_slug, permanent=True)
 
         self.initial = {
             'topic_title' : topic_title,
             'topic_slug' : topic_slug,
-            'cookie_string' : request.session.session_key,
+            'cookie_string' : get_cookie_string(request),
             'public_key' : settings.PUBLIC_KEY}
         return super(TopicFormView, self).dispatch(request, *args, **kwargs)
 
+    def find_topic_slug(self, topic_title, topic_slug):
+        """
+        Slug of the existing topic to redirect to: the one with the same
+        slug, else the first whose title starts with topic_title. Probes
+        at most one row, and none for a blank title.
+        """
+        if not topic_slug:
+            return None
+
+        slugs = self.model.objects.filter(topic_slug=topic_slug).values_list(
+            'topic_slug', flat=True)[:1]
+        if slugs:
+            return slugs[0]
+
+        if settings.TOPIC_INDEX_ENABLED:
+            topic_index.refresh()
+            topics = topic_index.search(topic_title, 1)
+            return topics[0][1] if topics else None
+
+        slugs = self.model.objects.filter(topic_title__istartswith=topic_title).order_by(
+            'topic_title').values_list('topic_slug', flat=True)[:1]
+        return slugs[0] if slugs else None
+
     def get_form_kwargs(self):
         kwargs = super(TopicFormView, self).get_form_kwargs()
         if not settings.TESTING:
@@ -163,24 +286,25 @@ class VoteFormView(SessionViewMixin, StatsTableMixin, FormView):
     form_class = VoteModelForm
 
     def dispatch(self, request, *args, **kwargs):
-        topic_slug = self.kwargs.get('slug', '')
-        topic = Topic.objects.filter(topic_slug=topic_slug)
-        self.initial['cookie_string'] = request.session.session_key
-        if topic:
-            self.initial.update({
-                'topic_title' : topic[0].topic_title,
-                'topic_slug' : topic[0].topic_slug,
-                'recaptcha_public_key' : settings.PUBLIC_KEY,
-                'comment' : request.POST.get('comment', '')})
-        else:
-            self.initial.update({
-                'topic_title' : '',
-                'topic_slug' : '',
-                'recaptcha_public_key' : settings.PUBLIC_KEY,
-                'comment' : ''})
-
+        #~ Topic title and existence are resolved later in
+        #~ topic_stats_cache.get_vote_page() of StatsTableMixin.get_context_data().
+        self.initial = {
+            'topic_title' : '',
+            'topic_slug' : self.kwargs.get('slug', ''),
+            'cookie_string' : get_cookie_string(request),
+            'recaptcha_public_key' : settings.PUBLIC_KEY,
+            'comment' : request.POST.get('comment', '')}
         return super(VoteFormView, self).dispatch(request, *args, **kwargs)
 
+    # No Last-Modified: its whole seconds miss the second vote within
+    # the same second, date_updated does not.
+    @method_decorator(condition(etag_func=vote_page_etag))
+    def get(self, request, *args, **kwargs):
+        response = super(VoteFormView, self).get(request, *args, **kwargs)
+        # Browsers revalidate with If-None-Match.
+        patch_cache_control(response, private=True, max_age=0)
+        return response
+
     def get_form_kwargs(self):
         kwargs = super(VoteFormView, self).get_form_kwargs()
         if not settings.TESTING:
@@ -189,11 +313,11 @@ class VoteFormView(SessionViewMixin, StatsTableMixin, FormView):
 
     def get_context_data(self, **kwargs):
         context = super(VoteFormView, self).get_context_data(**kwargs)
-        cursor = connection.cursor()
-        cursor.execute('''SELECT id, counted, cookie_string, comment, vote,
-            date_created, votes_negative, votes_positive FROM list_votes(%s)''',
-            [self.initial.get('topic_slug',''),])
-        context['topic_votes'] = cursor.fetchall()
+        form = context['form']
+        form.initial['topic_title'] = context['topic_title']
+        if not context['topic_title']:
+            # Non-existing topic.
+            form.initial.update({'topic_slug' : '', 'comment' : ''})
         ########## debugger on ##########
         #~ from pudb import set_trace; set_trace()
         return context
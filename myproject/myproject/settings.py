@@ -26,6 +26,15 @@ SECRET_KEY = local_settings.SECRET_KEY
 PUBLIC_KEY = local_settings.PUBLIC_KEY
 PRIVATE_KEY = local_settings.PRIVATE_KEY
 
+# Recaptcha verifier, see badmeter/captcha.py. For tests and load runs
+# use the stub of "python manage.py recaptcha_stub":
+#     RECAPTCHA_VERIFY_URL = 'http://127.0.0.1:8001/recaptcha/api/verify'
+RECAPTCHA_VERIFY_URL = 'http://www.google.com/recaptcha/api/verify'
+RECAPTCHA_TIMEOUT_SECONDS = 3
+RECAPTCHA_POOL_SIZE = 4
+RECAPTCHA_BREAKER_FAILURES = 5
+RECAPTCHA_BREAKER_RESET_SECONDS = 30
+
 
 TESTING = ("test" in sys.argv)
 
@@ -53,6 +62,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'badmeter.middleware.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -89,9 +99,17 @@ DATABASES = {
         'PASSWORD': local_settings.DB_PASSWORD,
         'HOST': 'localhost',
         'PORT': '5432',
+        # Keep connections, and their prepared statements, across requests.
+        'CONN_MAX_AGE': 600,
     }
 }
 
+# Clients allowed to read /metrics.
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+# Run the stored function calls of badmeter/db.py as prepared statements.
+DB_PREPARED_STATEMENTS = True
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -111,12 +129,96 @@ USE_L10N = True
 # USE_TZ = False is needed to prevent conflict with "non-naive dates" in postgresql.
 USE_TZ = False
 
+SESSION_COOKIE_NAME = 'sessionid'
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 SESSION_COOKIE_AGE = 31536000   # 365 days
 SESSION_COOKIE_HTTPONLY = True
 #~ SESSION_COOKIE_DOMAIN = '.badmeter.com'
 SESSION_COOKIE_DOMAIN = None
 
+CSRF_COOKIE_NAME = 'csrftoken'
+
+# Sessions are only written on a visitor's first vote or new topic, see
+# badmeter.misc.get_cookie_string(). To keep them out of the database use
+# 'django.contrib.sessions.backends.cached_db' or
+# 'django.contrib.sessions.backends.signed_cookies'.
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+# In-process prefix index used by the /search/ autocomplete view.
+# Topic add/purge events are polled at most every REFRESH seconds. The
+# index reloads in full when older than MAX_AGE seconds, which must stay
+# below the 1-day topic event retention in purge_scan(). Events of
+# transactions that commit after later ones are waited for GAP seconds.
+TOPIC_INDEX_ENABLED = True
+TOPIC_INDEX_REFRESH_SECONDS = 5
+TOPIC_INDEX_MAX_AGE_SECONDS = 43200   # 12 hours
+TOPIC_INDEX_GAP_SECONDS = 3600
+
+# Topics purged per transaction by "python manage.py purge_topics".
+PURGE_BATCH_SIZE = 100
+
+# "python manage.py purge_worker" checks the topics for staleness in id
+# ordered slices of up to PURGE_WORKER_SLICE_SIZE topics, one slice per
+# PURGE_WORKER_SLICE_SECONDS, and rests PURGE_WORKER_IDLE_SECONDS after
+# each full pass. See badmeter/purge.py.
+PURGE_WORKER_SLICE_SIZE = 200
+PURGE_WORKER_SLICE_SECONDS = 1.0
+PURGE_WORKER_IDLE_SECONDS = 60
+
+# Monthly badmeter_vote partitions kept by "python manage.py
+# vote_partitions", see badmeter/sql/vote_partitions.sql. Partitions are
+# created VOTE_PARTITION_MONTHS_AHEAD months ahead. Months of votes older
+# than VOTE_RETENTION_MONTHS are dropped, None keeps them all. The vote
+# counters of topics and cookies stay, older votes drop off the vote
+# page lists.
+VOTE_PARTITION_MONTHS_AHEAD = 3
+VOTE_RETENTION_MONTHS = 24
+
+# Votes per add_votes() call of Vote.save_many().
+VOTES_BATCH_SIZE = 1000
+
+# Votes per page on the vote page and votes.json, and their date format.
+VOTES_PAGE_SIZE = 20
+VOTES_DATE_FORMAT = 'F d, Y h:i:s'
+
+# Seconds the process-local get_configuration() cache is trusted when
+# no badmeter_configuration notification arrives. See
+# badmeter/configuration.py.
+CONFIGURATION_CACHE_SECONDS = 300
+CONFIGURATION_LISTEN = True
+
+# Caches. 'topic_stats' keeps the topic part of the vote pages (see
+# badmeter/stats_cache.py) and 'search' the /search/ answers in bounded
+# per process LRUs. To share one between processes point it at e.g.
+# memcached:
+#     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#     'LOCATION': '127.0.0.1:11211',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'topic_stats': {
+        'BACKEND': 'badmeter.cache.LRUCache',
+        'LOCATION': 'topic-stats',
+        'TIMEOUT': 86400,
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'search': {
+        'BACKEND': 'badmeter.cache.LRUCache',
+        'LOCATION': 'search',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+TOPIC_STATS_CACHE = 'topic_stats'
+
+# /search/ answers are cached here and by browsers and proxies for
+# SEARCH_CACHE_SECONDS. See badmeter/search_cache.py.
+SEARCH_CACHE = 'search'
+SEARCH_CACHE_SECONDS = 60
+
+# Browser cache lifetime of the home page.
+HOME_PAGE_CACHE_SECONDS = 3600
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.6/howto/static-files/
 
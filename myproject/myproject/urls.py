@@ -13,7 +13,9 @@ urlpatterns = patterns('',
     url(r'^index/$', HomeTemplateView.as_view(), name='home'),
     url(r'^home/$', HomeTemplateView.as_view(), name='home_main'),
     url(r'^search/', 'badmeter.views.search'),
+    url(r'^metrics$', 'badmeter.views.metrics_text', name='metrics'),
     url(r'^topic/', TopicFormView.as_view(), name='topic-form-view'),
+    url(r'^vote/(?P<slug>[-\w]+)/votes\.json$', 'badmeter.views.votes_json', name='votes-json'),
     url(r'^vote/(?P<slug>[-\w]+)/', VoteFormView.as_view(), name='vote-form-view'),
     url(r'^admin/', include(admin.site.urls)),
 )